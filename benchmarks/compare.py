@@ -0,0 +1,89 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+"""
+Compare the results of two benchmarks saved by run.py
+
+    python benchmarks/compare.py before.json after.json
+"""
+
+import argparse
+import json
+import sys
+
+
+def metrics(run):
+    """
+    Flatten the measures of a run
+
+    :param run: run of the results of run.py
+    :type run: dict
+    :returns metrics: dict of metric name: value
+    """
+    values = {"wall (s)": run.get("wall"),
+              "import (s)": run.get("import"),
+              "peak RSS (kB)": run.get("peak_rss_kb"),
+              "workers peak RSS (kB)": run.get("workers_peak_rss_kb")}
+    for phase, seconds in run.get("phases", {}).items():
+        values[phase + " (s)"] = seconds
+    for service, nb in run.get("requests", {}).items():
+        values[service + " requests"] = nb
+    return values
+
+
+def format_value(value):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return "{:.3f}".format(value)
+    return str(value)
+
+
+def compare(before, after):
+    """
+    Print the metrics of each run of two benchmarks side by side
+
+    :param before: results of the reference benchmark
+    :param after: results of the compared benchmark
+    """
+    if before.get("params") != after.get("params"):
+        print("Warning: the benchmarks were run with different parameters\n")
+    print("{:<32} {:>12} {:>12} {:>8}".format(
+        "", before.get("commit") or "before", after.get("commit") or "after",
+        "ratio"
+    ))
+    after_runs = {run["name"]: run for run in after["runs"]}
+    for run in before["runs"]:
+        if run["name"] not in after_runs:
+            continue
+        print(run["name"])
+        before_metrics = metrics(run)
+        after_metrics = metrics(after_runs[run["name"]])
+        for name in sorted(set(before_metrics) | set(after_metrics)):
+            old = before_metrics.get(name)
+            new = after_metrics.get(name)
+            ratio = ""
+            if old and new is not None:
+                ratio = "{:.2f}x".format(new / old)
+            print("  {:<30} {:>12} {:>12} {:>8}".format(
+                name, format_value(old), format_value(new), ratio
+            ))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the results of two benchmarks"
+    )
+    parser.add_argument("before", help="results of the reference benchmark")
+    parser.add_argument("after", help="results of the compared benchmark")
+    args = parser.parse_args()
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    compare(before, after)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
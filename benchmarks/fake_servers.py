@@ -0,0 +1,368 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+"""
+Local stand-ins of MPD, Muspy and MusicBrainz, serving a synthetic library
+"""
+
+import json
+import random
+import shlex
+import socketserver
+import threading
+import time
+import urllib.parse
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+MB_XML = ('<?xml version="1.0" encoding="UTF-8"?>'
+          '<metadata xmlns="http://musicbrainz.org/ns/mmd-2.0#">{}</metadata>')
+
+
+class Library():
+    """
+    Synthetic music library, and what MusicBrainz knows about it
+
+    Artists are named "Artist <n>", with albums named "Album <n>-<m>".
+    """
+    def __init__(self, artists=1000, albums=3, tagged=0.5, ambiguous=0.2,
+                 unknown=0.0, local_albums=0.0, seed=1):
+        """
+        :param artists: number of artists
+        :param albums: number of albums by artist
+        :param tagged: ratio of artists tagged with their musicbrainz id
+        :param ambiguous: ratio of artists sharing their name with another
+            artist on musicbrainz
+        :param unknown: ratio of artists unknown by musicbrainz
+        :param local_albums: ratio of albums unknown by musicbrainz
+        :param seed: seed of the random generator, to get the same library
+            for the same parameters
+        """
+        self._rnd = random.Random(seed)
+        self.ratios = {"tagged": tagged, "ambiguous": ambiguous,
+                       "unknown": unknown, "local_albums": local_albums}
+        self.nb_albums = albums
+        self._next = 0
+        self.artists = []
+        self.by_name = dict()
+        self.by_mbid = dict()
+        self.by_album = dict()
+        self.db_update = 1700000000
+        self.changed = threading.Event()
+        self.add_artists(artists)
+
+    def add_artists(self, nb):
+        """
+        Add artists to the library, and mark the database as updated
+        """
+        rnd = self._rnd
+        for i in range(self._next, self._next + nb):
+            artist = {
+                "name": "Artist {}".format(i),
+                "mbid": str(uuid.UUID(int=rnd.getrandbits(128))),
+                "albums": ["Album {}-{}".format(i, j)
+                           for j in range(self.nb_albums)],
+                "tagged": rnd.random() < self.ratios["tagged"],
+                "ambiguous": rnd.random() < self.ratios["ambiguous"],
+                "unknown": rnd.random() < self.ratios["unknown"],
+            }
+            artist["mb_albums"] = [
+                album for album in artist["albums"]
+                if rnd.random() >= self.ratios["local_albums"]
+            ]
+            if artist["unknown"]:
+                artist["tagged"] = False
+            self.artists.append(artist)
+            self._next += 1
+            self.by_name[artist["name"].lower()] = artist
+            self.by_mbid[artist["mbid"]] = artist
+            for album in artist["mb_albums"]:
+                self.by_album.setdefault(album.lower(), []).append(artist)
+        self.touch()
+
+    def remove_artists(self, nb):
+        """
+        Remove the last artists of the library, and mark the database as
+        updated
+        """
+        for artist in self.artists[len(self.artists) - nb:]:
+            del self.by_name[artist["name"].lower()]
+        del self.artists[len(self.artists) - nb:]
+        self.touch()
+
+    def touch(self):
+        self.db_update += 1
+        self.changed.set()
+
+
+class _Mpd_handler(socketserver.StreamRequestHandler):
+    """
+    Subset of the MPD protocol used by mpd-muspy
+    """
+    def handle(self):
+        self.wfile.write(b"OK MPD 0.23.5\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = shlex.split(line.decode().strip())
+            if not args:
+                continue
+            self.server.count("mpd")
+            command, args = args[0], args[1:]
+            if command == "close":
+                return
+            try:
+                pairs = getattr(self, "_" + command)(self.server.lib, *args)
+            except (AttributeError, TypeError):
+                self.wfile.write(
+                    "ACK [5@0] {{{}}} unknown command\n".format(command)
+                    .encode()
+                )
+                continue
+            if pairs is None:
+                continue
+            self.wfile.write("".join(
+                "{}: {}\n".format(k, v) for k, v in pairs
+            ).encode() + b"OK\n")
+
+    def _ping(self, lib):
+        return ()
+
+    def _status(self, lib):
+        return ()
+
+    def _stats(self, lib):
+        return (("artists", len(lib.artists)), ("db_update", lib.db_update))
+
+    def _idle(self, lib, *subsystems):
+        lib.changed.wait()
+        lib.changed.clear()
+        return (("changed", "database"), )
+
+    def _noidle(self, lib):
+        return None
+
+    def _list(self, lib, tag, *args):
+        tag = tag.lower()
+        group = None
+        if len(args) == 2 and args[0] == "group":
+            group = args[1].lower()
+        pairs = []
+        for artist in lib.artists:
+            if group is not None:
+                pairs.append((group.title(), artist["name"]))
+                if tag == "album":
+                    pairs += [("Album", a) for a in artist["albums"]]
+                elif tag.startswith("musicbrainz_") and artist["tagged"]:
+                    pairs.append((tag.upper(), artist["mbid"]))
+            elif tag in ("artist", "albumartist"):
+                pairs.append((tag.title(), artist["name"]))
+            elif tag == "album" and args[1:] == (artist["name"], ):
+                pairs += [("Album", a) for a in artist["albums"]]
+        return pairs
+
+    def _search(self, lib, tag, name):
+        artist = lib.by_name.get(name.lower())
+        if artist is None:
+            return ()
+        return (("file", "x"), (tag.title(), artist["name"]))
+
+
+class _Mpd_server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Http_handler(BaseHTTPRequestHandler):
+    """
+    Subset of the Muspy API and of the MusicBrainz web service
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, body=b"", content_type="application/json",
+               headers=()):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        server = self.server
+        if self.headers.get("Content-Length"):
+            self.rfile.read(int(self.headers["Content-Length"]))
+        time.sleep(server.latency)
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if url.path.startswith("/ws/2/"):
+            self._musicbrainz(url.path[len("/ws/2/"):].strip("/"), query)
+        else:
+            self._muspy(method, url.path)
+
+    def _musicbrainz(self, entity, query):
+        server = self.server
+        lib = server.lib
+        server.count("musicbrainz")
+        if server.throttled():
+            server.count("throttled")
+            return self._reply(503, headers=(("Retry-After", "1"), ))
+        if entity == "artist":
+            artist = lib.by_name.get(query.get("query", "").lower())
+            artists = []
+            if artist is not None and not artist["unknown"]:
+                artists = [artist]
+                if artist["ambiguous"]:
+                    homonym = {"name": artist["name"], "mbid": str(
+                        uuid.uuid5(uuid.NAMESPACE_DNS, artist["name"])
+                    )}
+                    artists.insert(0, homonym)
+            body = ('<artist-list count="{}" offset="0">{}'
+                    '</artist-list>').format(
+                len(artists), "".join(
+                    '<artist id="{0}"><name>{1}</name>'
+                    '<sort-name>{1}</sort-name></artist>'.format(
+                        a["mbid"], escape(a["name"])
+                    ) for a in artists
+                )
+            )
+        elif entity == "release":
+            title = query.get("query", "")
+            artists = lib.by_album.get(title.lower(), [])
+            body = ('<release-list count="{}" offset="0">{}'
+                    '</release-list>').format(
+                len(artists), "".join(
+                    '<release id="{}"><title>{}</title><artist-credit>'
+                    '<name-credit><artist id="{}"><name>{}</name></artist>'
+                    '</name-credit></artist-credit></release>'.format(
+                        uuid.uuid4(), escape(title), a["mbid"],
+                        escape(a["name"])
+                    ) for a in artists
+                )
+            )
+        elif entity == "release-group":
+            artist = lib.by_mbid.get(query.get("artist"))
+            titles = artist["mb_albums"] if artist is not None else []
+            offset = int(query.get("offset", 0))
+            limit = int(query.get("limit", 25))
+            body = ('<release-group-list count="{}" offset="{}">{}'
+                    '</release-group-list>').format(
+                len(titles), offset, "".join(
+                    '<release-group id="{}"><title>{}</title>'
+                    '</release-group>'.format(uuid.uuid4(), escape(t))
+                    for t in titles[offset:offset + limit]
+                )
+            )
+        else:
+            return self._reply(404)
+        self._reply(200, MB_XML.format(body).encode(), "application/xml")
+
+    def _muspy(self, method, path):
+        server = self.server
+        server.count("muspy")
+        if method == "GET":
+            return self._reply(200, json.dumps([
+                {"name": name, "mbid": mbid, "sort_name": name,
+                 "disambiguation": ""}
+                for mbid, name in list(server.followed.items())
+            ]).encode())
+        mbid = path.strip("/").split("/")[-1]
+        if method == "PUT":
+            artist = server.lib.by_mbid.get(mbid)
+            server.followed[mbid] = artist["name"] if artist else mbid
+        elif method == "DELETE":
+            server.followed.pop(mbid, None)
+        self._reply(200)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+class _Http_server(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class Fake_servers():
+    """
+    MPD server and HTTP server (Muspy and MusicBrainz) serving a library, in
+    background threads
+
+    The requests received by each service are counted in `requests`.
+    """
+    def __init__(self, lib, latency=0, mb_rate=0):
+        """
+        :param lib: library served
+        :type lib: Library
+        :param latency: delay added to each HTTP request, in seconds
+        :param mb_rate: requests by second allowed by MusicBrainz, before
+            answering with a 503 and a Retry-After. 0 to never throttle.
+        """
+        self.lib = lib
+        self.requests = Counter()
+        self._lock = threading.Lock()
+        self._mb_last = 0
+        self.mpd = _Mpd_server(("127.0.0.1", 0), _Mpd_handler)
+        self.http = _Http_server(("127.0.0.1", 0), _Http_handler)
+        for server in (self.mpd, self.http):
+            server.lib = lib
+            server.count = self.count
+        self.http.latency = latency
+        self.http.followed = dict()
+        self.http.throttled = self.throttled
+        self.mb_rate = mb_rate
+
+    @property
+    def mpd_port(self):
+        return self.mpd.server_address[1]
+
+    @property
+    def http_address(self):
+        return "127.0.0.1:{}".format(self.http.server_address[1])
+
+    @property
+    def followed(self):
+        """
+        Artists followed on the muspy account, by musicbrainz id
+        """
+        return self.http.followed
+
+    def count(self, service):
+        with self._lock:
+            self.requests[service] += 1
+
+    def throttled(self):
+        """
+        Check if a MusicBrainz request comes too early after the previous one
+        """
+        if not self.mb_rate:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            # Tolerate some jitter of the client rate limiter
+            if now - self._mb_last < 0.9 / self.mb_rate:
+                return True
+            self._mb_last = now
+            return False
+
+    def start(self):
+        for server in (self.mpd, self.http):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        for server in (self.mpd, self.http):
+            server.shutdown()
+            server.server_close()
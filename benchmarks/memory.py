@@ -0,0 +1,154 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+"""
+Memory benchmark of the artists database
+
+A synthetic artists.json is loaded twice: as the dicts returned by json.load,
+which is how the artists used to be kept in memory, and by Artist_db. The
+memory allocated by each one is measured with tracemalloc and printed in
+bytes by artist, with the peak memory of a query of the non-uploaded artists:
+
+    python benchmarks/memory.py --artists 1000000
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+import uuid
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+
+def write_db(path, nb, tagged, uploaded, failed, seed=0):
+    """
+    Write a synthetic artists database in the json format
+
+    :param nb: number of artists
+    :param tagged: ratio of artists with a musicbrainz id
+    :param uploaded: ratio of the tagged artists uploaded on muspy
+    :param failed: ratio of the untagged artists which failed to be searched
+    """
+    rng = random.Random(seed)
+    artists = dict()
+    for i in range(nb):
+        fields = {"uploaded": False}
+        if rng.random() < tagged:
+            fields["mbid"] = str(uuid.UUID(int=rng.getrandbits(128),
+                                           version=4))
+            fields["uploaded"] = rng.random() < uploaded
+            fields["lookup_status"] = "found"
+        elif rng.random() < failed:
+            fields["lookup_status"] = "not_found"
+            fields["lookup_attempts"] = rng.randint(1, 5)
+            fields["next_lookup"] = 1.7e9 + rng.random() * 1e7
+        artists["Artist {} {:x}".format(i, rng.getrandbits(32))] = fields
+    with open(path, "w") as f:
+        json.dump(artists, f, indent=4)
+
+
+def measure(func):
+    """
+    Measure the memory allocated by a function
+
+    :returns (result, size, peak): result of the function, memory still
+        allocated after it and peak memory during it, in bytes
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func()
+        size, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, size, peak
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Measure the memory used by the artists database"
+    )
+    parser.add_argument("-n", "--artists", type=int, default=100000,
+                        help="number of artists in the database")
+    parser.add_argument("--tagged", type=float, default=0.8,
+                        help="ratio of artists with a musicbrainz id")
+    parser.add_argument("--uploaded", type=float, default=0.9,
+                        help="ratio of the tagged artists already uploaded")
+    parser.add_argument("--failed", type=float, default=0.5,
+                        help="ratio of the untagged artists which failed to "
+                        "be searched")
+    parser.add_argument("-o", "--output",
+                        help="JSON file where the results are saved")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = {"params": vars(args)}
+    with tempfile.TemporaryDirectory(prefix="mpd-muspy-bench-") as tmp:
+        # Artist_db needs a configuration to be imported
+        config_dir = os.path.join(tmp, "config", "mpd-muspy")
+        os.makedirs(config_dir)
+        with open(os.path.join(REPO_DIR, "config.py.default")) as f:
+            content = f.read()
+        with open(os.path.join(config_dir, "config.py"), "w") as f:
+            f.write(content)
+        os.environ["XDG_CONFIG_HOME"] = os.path.join(tmp, "config")
+        from mpd_muspy.artist_db import Artist_db
+
+        jsonpath = os.path.join(tmp, "artists.json")
+        write_db(jsonpath, args.artists, args.tagged, args.uploaded,
+                 args.failed)
+
+        def load_json():
+            with open(jsonpath) as f:
+                return json.load(f)
+
+        artists, size, peak = measure(load_json)
+        results["json_dicts"] = {"size": size, "peak": peak}
+        del artists
+
+        artist_db, size, peak = measure(
+            lambda: Artist_db(jsonpath=jsonpath, journal=False)
+        )
+        results["artist_db"] = {"size": size, "peak": peak}
+
+        _, _, peak = measure(lambda: artist_db.get_artists(
+            fields=("mbid", ), uploaded=False
+        ))
+        results["get_artists_peak"] = peak
+
+        def iterate():
+            for _ in artist_db.iter_artists(fields=("mbid", ),
+                                            uploaded=False):
+                pass
+        _, _, peak = measure(iterate)
+        results["iter_artists_peak"] = peak
+
+    nb = args.artists
+    print("{} artists, bytes by artist:".format(nb))
+    for name, label in (("json_dicts", "dicts of json.load (before)"),
+                        ("artist_db", "Artist_db")):
+        print("    {:<30} {:7.1f} (peak while loading {:.1f})".format(
+            label, results[name]["size"] / nb, results[name]["peak"] / nb
+        ))
+    print("Non-uploaded artists query, peak bytes by artist:")
+    print("    {:<30} {:7.1f}".format("get_artists",
+                                      results["get_artists_peak"] / nb))
+    print("    {:<30} {:7.1f}".format("iter_artists",
+                                      results["iter_artists_peak"] / nb))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+"""
+End-to-end benchmark of the synchronization
+
+A synthetic library is served by local stand-ins of MPD, Muspy and
+MusicBrainz (see fake_servers), and `sync.run` is timed against them: a first
+synchronization on an empty database, a second one with nothing changed, and
+optionally a third one after some artists were added and removed.
+
+Each synchronization runs in a new process, to measure its peak memory. The
+results are saved as JSON, to be compared between commits with compare.py:
+
+    python benchmarks/run.py --artists 10000 -o before.json
+"""
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import multiprocessing.forkserver
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from functools import wraps
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from fake_servers import Fake_servers, Library  # noqa: E402
+
+#: functions timed in each synchronization: module, object, attribute and
+#: name of the phase. Nested phases are included in their parents.
+PHASES = (
+    ("mpd_muspy.sync", None, "open_artist_db", "open_db"),
+    ("mpd_muspy.sync", None, "presync", "presync"),
+    ("mpd_muspy.artist_db", "Artist_db", "merge", "presync.mpd_artists"),
+    ("mpd_muspy.artist_db_sqlite", "Artist_db_sqlite", "merge",
+     "presync.mpd_artists"),
+    ("mpd_muspy.muspy_api", "Muspy_api", "get_artists",
+     "presync.muspy_artists"),
+    ("mpd_muspy.presync", None, "fetch_missing_mbid", "presync.mbids"),
+    ("mpd_muspy.presync", None, "update_artists_from_muspy",
+     "presync.muspy_merge"),
+    ("mpd_muspy.muspy_async", "Upload_stream", "close", "upload"),
+    ("mpd_muspy.sync", None, "start_pool_add", "upload"),
+    ("mpd_muspy.sync", None, "start_pool_del", "remove"),
+)
+
+
+def write_config(path, servers, overrides):
+    """
+    Write the configuration of mpd-muspy, pointing to the local servers
+
+    :param path: directory of the configuration file
+    :param servers: running servers
+    :type servers: Fake_servers
+    :param overrides: options replacing the default configuration
+    :type overrides: dict
+    """
+    options = {
+        "SERVER": "127.0.0.1",
+        "PORT": servers.mpd_port,
+        "MUSPY_ADDR": "http://{}/api/1/".format(servers.http_address),
+        "MUSICBRAINZ_SERVER": servers.http_address,
+        "MUSICBRAINZ_HTTPS": False,
+        "MUSICBRAINZ_RATE_LIMIT": servers.mb_rate or 1000,
+        "MUSICBRAINZ_BURST": 1 if servers.mb_rate else 50,
+    }
+    options.update(overrides)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(REPO_DIR, "config.py.default")) as f:
+        content = f.read()
+    with open(os.path.join(path, "config.py"), "w") as f:
+        f.write(content)
+        f.write("\n# Benchmark\n")
+        for key, value in options.items():
+            f.write("{} = {!r}\n".format(key, value))
+
+
+def time_phases(phases):
+    """
+    Wrap the functions of PHASES to sum the time spent in each of them
+
+    :param phases: dict receiving the time of each phase, in seconds
+    :type phases: defaultdict
+    """
+    for module, obj, attr, name in PHASES:
+        try:
+            owner = importlib.import_module(module)
+        except ImportError:
+            continue
+        if obj is not None:
+            owner = getattr(owner, obj)
+
+        def timed(func, name=name):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    phases[name] += time.perf_counter() - start
+            return wrapper
+        setattr(owner, attr, timed(getattr(owner, attr)))
+
+
+def run_sync(conn, quiet):
+    """
+    Run a synchronization, in a new process
+
+    Sends back to `conn` the time of each phase, and the peak memory of this
+    process and of its workers.
+    """
+    if quiet:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+    result = {}
+    phases = defaultdict(float)
+    try:
+        start = time.perf_counter()
+        importlib.import_module("mpd_muspy.tools")
+        result["import"] = time.perf_counter() - start
+        time_phases(phases)
+        from mpd_muspy import sync
+        start = time.perf_counter()
+        sync.run()
+        result["wall"] = time.perf_counter() - start
+    except Exception as e:
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+    result["phases"] = dict(phases)
+    # Workers started by a fork server are its children: they are only
+    # counted in RUSAGE_CHILDREN once it is stopped
+    forkserver = getattr(multiprocessing.forkserver, "_forkserver", None)
+    if forkserver is not None and hasattr(forkserver, "_stop"):
+        forkserver._stop()
+    # ru_maxrss is in kilobytes on Linux
+    result["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result["workers_peak_rss_kb"] = resource.getrusage(
+        resource.RUSAGE_CHILDREN
+    ).ru_maxrss
+    conn.send(result)
+    conn.close()
+
+
+def bench_run(name, servers, quiet=True):
+    """
+    Run and measure a synchronization
+
+    :param name: name of the run in the results
+    :param servers: running servers, whose requests are counted
+    :type servers: Fake_servers
+    """
+    ctx = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    requests = Counter(servers.requests)
+    process = ctx.Process(target=run_sync, args=(child_conn, quiet))
+    process.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = {"error": "the process exited with code {}".format(
+            process.exitcode
+        )}
+    process.join()
+    result = dict(name=name, **result)
+    result["requests"] = dict(Counter(servers.requests) - requests)
+    result["followed"] = len(servers.followed)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"], cwd=REPO_DIR,
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_run(run):
+    print("{}: {:.2f}s".format(run["name"], run.get("wall", 0)), end="")
+    if "error" in run:
+        print(" ({})".format(run["error"]), end="")
+    print(", peak RSS {} kB (workers {} kB)".format(
+        run.get("peak_rss_kb"), run.get("workers_peak_rss_kb")
+    ))
+    for phase, seconds in sorted(run["phases"].items()):
+        print("    {:<24} {:8.3f}s".format(phase, seconds))
+    print("    requests:", ", ".join(
+        "{} {}".format(service, nb)
+        for service, nb in sorted(run["requests"].items())
+    ))
+
+
+def parse_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the synchronization against local servers"
+    )
+    parser.add_argument("-n", "--artists", type=int, default=1000,
+                        help="number of artists in the library")
+    parser.add_argument("--albums", type=int, default=3,
+                        help="number of albums by artist")
+    parser.add_argument("--tagged", type=float, default=0.5,
+                        help="ratio of artists tagged with their id")
+    parser.add_argument("--ambiguous", type=float, default=0.2,
+                        help="ratio of artists with a homonym")
+    parser.add_argument("--unknown", type=float, default=0,
+                        help="ratio of artists unknown by musicbrainz")
+    parser.add_argument("--local-albums", type=float, default=0,
+                        help="ratio of albums unknown by musicbrainz")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="latency of each HTTP request, in seconds")
+    parser.add_argument("--mb-rate", type=float, default=0,
+                        help=("requests by second allowed by musicbrainz "
+                              "before throttling, 0 to never throttle"))
+    parser.add_argument("--changes", type=int, default=0,
+                        help=("artists added and removed before a last "
+                              "synchronization, 0 to skip it"))
+    parser.add_argument("--backend", choices=("json", "binary", "sqlite"),
+                        default="json", help="artist database backend")
+    parser.add_argument("--set", action="append", default=[],
+                        metavar="OPTION=VALUE",
+                        help=("set an option of the configuration, the value "
+                              "being read as JSON if possible"))
+    parser.add_argument("-o", "--output",
+                        help="JSON file where the results are saved")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="show the output of the synchronizations")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    overrides = {"ARTISTS_DB_BACKEND": args.backend}
+    for option in args.set:
+        key, _, value = option.partition("=")
+        overrides[key] = parse_value(value)
+
+    lib = Library(args.artists, args.albums, args.tagged, args.ambiguous,
+                  args.unknown, args.local_albums)
+    servers = Fake_servers(lib, args.latency, args.mb_rate).start()
+    results = {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "params": {k: v for k, v in vars(args).items()
+                   if k not in ("set", "output", "verbose")},
+        "config": overrides,
+        "runs": [],
+    }
+    try:
+        with tempfile.TemporaryDirectory(prefix="mpd-muspy-bench-") as tmp:
+            for xdg in ("CONFIG", "DATA", "CACHE"):
+                os.environ["XDG_{}_HOME".format(xdg)] = os.path.join(
+                    tmp, xdg.lower()
+                )
+            write_config(os.path.join(tmp, "config", "mpd-muspy"), servers,
+                         overrides)
+            runs = [("cold", None), ("warm", None)]
+            if args.changes:
+                runs.append(("changes", args.changes))
+            for name, changes in runs:
+                if changes:
+                    lib.remove_artists(changes)
+                    lib.add_artists(changes)
+                run = bench_run(name, servers, not args.verbose)
+                print_run(run)
+                results["runs"].append(run)
+    finally:
+        servers.stop()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Results saved in", args.output)
+    return 1 if any("error" in run for run in results["runs"]) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
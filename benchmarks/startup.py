@@ -0,0 +1,147 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+"""
+Startup benchmark: time of a synchronization with nothing to do
+
+After a first synchronization against the local servers of fake_servers,
+`mpd-muspy` is run several times while nothing changes, each time in a new
+interpreter like from cron. The startup of an empty interpreter is measured
+too: it depends on the installed packages (like their .pth files), not on
+mpd-muspy. The run fails if the median time above it is more than --max-ms
+(250 ms by default), to catch regressions of the startup time. About 100 ms
+of it is the import of requests, for the request fetching the muspy
+account:
+
+    python benchmarks/startup.py --runs 20
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_servers import Fake_servers, Library
+from run import REPO_DIR, write_config
+
+
+def run_cli(env, *args):
+    """
+    Run mpd-muspy in a new interpreter
+
+    :returns (seconds, stderr): wall time of the run and its error output
+    """
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-m", "mpd_muspy"] + list(args), env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    elapsed = time.perf_counter() - start
+    if process.returncode:
+        raise RuntimeError("mpd-muspy failed:\n" + process.stderr.decode())
+    return elapsed, process.stderr.decode()
+
+
+def interpreter_startup(env, runs):
+    """
+    Measure the median time of an empty interpreter
+
+    :returns seconds: median wall time of `python -c pass`
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], env=env, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def slowest_imports(env, nb=10):
+    """
+    Get the modules which took the most time to import during a run
+
+    :returns imports: list of (cumulative microseconds, module name)
+    """
+    env = dict(env, PYTHONPROFILEIMPORTTIME="1")
+    imports = []
+    for line in run_cli(env)[1].splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        try:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            imports.append((int(cumulative), name[1:].rstrip()))
+        except ValueError:
+            continue
+    # Only the modules imported directly, their children are included
+    top = [(us, name) for us, name in imports if not name.startswith(" ")]
+    return sorted(top, reverse=True)[:nb]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Measure the time of a synchronization with nothing to do"
+    )
+    parser.add_argument("-n", "--artists", type=int, default=1000,
+                        help="number of artists in the library")
+    parser.add_argument("--runs", type=int, default=10,
+                        help="number of measured runs")
+    parser.add_argument("--max-ms", type=float, default=250,
+                        help="fail if the median time above the startup of "
+                        "an empty interpreter is more than it")
+    parser.add_argument("--backend", choices=("json", "binary", "sqlite"),
+                        default="json", help="artist database backend")
+    parser.add_argument("-o", "--output",
+                        help="JSON file where the results are saved")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    servers = Fake_servers(Library(args.artists)).start()
+    try:
+        with tempfile.TemporaryDirectory(prefix="mpd-muspy-bench-") as tmp:
+            env = dict(os.environ, PYTHONPATH=REPO_DIR)
+            for xdg in ("CONFIG", "DATA", "CACHE"):
+                env["XDG_{}_HOME".format(xdg)] = os.path.join(
+                    tmp, xdg.lower()
+                )
+            write_config(os.path.join(tmp, "config", "mpd-muspy"), servers,
+                         {"ARTISTS_DB_BACKEND": args.backend})
+            first, _ = run_cli(env)
+            times = [run_cli(env)[0] for _ in range(args.runs)]
+            interpreter = interpreter_startup(env, args.runs)
+            imports = slowest_imports(env)
+    finally:
+        servers.stop()
+
+    median = statistics.median(times) * 1000
+    overhead = median - interpreter * 1000
+    print("First synchronization: {:.0f} ms".format(first * 1000))
+    print("Nothing to do: median {:.0f} ms, min {:.0f} ms, max {:.0f} ms "
+          "({} runs)".format(median, min(times) * 1000, max(times) * 1000,
+                             len(times)))
+    print("Empty interpreter: median {:.0f} ms, mpd-muspy adds {:.0f} "
+          "ms".format(interpreter * 1000, overhead))
+    print("Slowest imports:")
+    for us, name in imports:
+        print("    {:<32} {:6.1f} ms".format(name, us / 1000))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"params": vars(args), "first": first, "times": times,
+                       "interpreter": interpreter, "imports": imports}, f,
+                      indent=2)
+    if args.max_ms is not None and overhead > args.max_ms:
+        print("Regression: mpd-muspy adds more than {:.0f} ms".format(
+            args.max_ms
+        ))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -19,6 +19,30 @@ def parse_args():
         ), dest="clean", action="store_true"
     )
 
+    parser.add_argument(
+        "-f", "--force",
+        help=(
+            "synchronize everything, even if mpd and the muspy account did "
+            "not change since the last synchronization"
+        ), dest="force", action="store_true"
+    )
+
+    parser.add_argument(
+        "-d", "--daemon",
+        help=(
+            "keep running, and synchronize the artists each time the mpd "
+            "database is updated"
+        ), dest="daemon", action="store_true"
+    )
+
+    parser.add_argument(
+        "-r", "--retry-lookups",
+        help=(
+            "search again on musicbrainz the artists which were not found, "
+            "without waiting for their next retry"
+        ), dest="retry_lookups", action="store_true"
+    )
+
     parser.add_argument(
         "--version", action="version",
         version="{} {}".format(_release_name, _version)
@@ -26,6 +50,35 @@ def parse_args():
 
     parser.set_defaults(func=sync)
 
+    subparsers = parser.add_subparsers(title="commands")
+    parser_build_index = subparsers.add_parser(
+        "build-index",
+        help=(
+            "build the offline musicbrainz index, used to find the artists "
+            "ids without querying musicbrainz"
+        )
+    )
+    parser_build_index.add_argument(
+        "dumps", metavar="DUMP", nargs="+",
+        help=(
+            "musicbrainz JSON dump of artists or release groups (like "
+            "artist.tar.xz), or TSV dump of the artist table"
+        )
+    )
+    parser_build_index.add_argument(
+        "-r", "--refresh",
+        help=(
+            "update the existing index with the dumps which changed since "
+            "the last build, instead of building a new one"
+        ), dest="refresh", action="store_true"
+    )
+    parser_build_index.add_argument(
+        "-o", "--output",
+        help="path of the index, MUSICBRAINZ_INDEX by default",
+        dest="output"
+    )
+    parser_build_index.set_defaults(func=build_index)
+
     args = parser.parse_args()
     args.func(parsed_args=args)
 
@@ -33,8 +86,23 @@ def parse_args():
 def sync(parsed_args):
     check_config_exists()
 
+    if parsed_args.daemon:
+        from mpd_muspy.daemon import run as run_daemon
+        return run_daemon(clean=parsed_args.clean, force=parsed_args.force,
+                          retry_lookups=parsed_args.retry_lookups)
+
     from mpd_muspy.sync import run as run_sync
-    return run_sync(clean=parsed_args.clean)
+    return run_sync(clean=parsed_args.clean, force=parsed_args.force,
+                    retry_lookups=parsed_args.retry_lookups)
+
+
+def build_index(parsed_args):
+    check_config_exists()
+
+    from mpd_muspy.mb_index import MUSICBRAINZ_INDEX
+    from mpd_muspy.mb_index import build_index as build
+    return build(parsed_args.dumps, parsed_args.output or MUSICBRAINZ_INDEX,
+                 refresh=parsed_args.refresh)
 
 
 def check_config_exists():
@@ -2,16 +2,335 @@
 import appdirs
 import json
 import os
+import sys
+import threading
+import time
+from contextlib import nullcontext
 from .tools import get_config
 
 config = get_config()
+try:
+    from config import ARTISTS_DB_JOURNAL
+except:
+    ARTISTS_DB_JOURNAL = False
+
+#: the journal is folded into the json file when it gets bigger than the json
+#: file itself, or than this size (in bytes)
+JOURNAL_MIN_COMPACT_SIZE = 64 * 1024
+
+#: minimum delay (in seconds) between two saves of a Db_saver
+DB_SAVE_INTERVAL = 1
+
+#: fields of an artist, in the order they are saved
+FIELDS = ("uploaded", "mbid", "lookup_status", "lookup_attempts",
+          "next_lookup")
+
+
+def retry_delay(attempts, delay, max_delay):
+    """
+    Delay before searching again an artist, which doubles with each failed
+    attempt
+
+    :param attempts: number of failed attempts
+    :param delay: delay after the first failed attempt, in seconds
+    :param max_delay: maximum delay, in seconds
+    """
+    return min(delay * 2 ** min(attempts - 1, 32), max_delay)
+
+
+def _pack_mbid(mbid):
+    """
+    Pack a musicbrainz id in 16 bytes
+
+    Ids which would not be unpacked identically are kept as they are.
+    """
+    try:
+        packed = bytes.fromhex(mbid.replace("-", ""))
+    except (AttributeError, ValueError):
+        return mbid
+    if len(packed) != 16 or _unpack_mbid(packed) != mbid:
+        return mbid
+    return packed
+
+
+def _unpack_mbid(packed):
+    """
+    Format a musicbrainz id packed by _pack_mbid()
+    """
+    if type(packed) is not bytes:
+        return packed
+    h = packed.hex()
+    return "-".join((h[:8], h[8:12], h[12:16], h[16:20], h[20:]))
+
+
+class _Artist_record():
+    """
+    Fields of an artist in an Artist_db
+
+    Millions of them can be loaded, so they are slotted, the musicbrainz id is
+    packed in 16 bytes and the lookup status is interned. Fields set to None
+    are considered as missing.
+    """
+    __slots__ = ("uploaded", "_mbid", "lookup_status", "lookup_attempts",
+                 "next_lookup")
+
+    def __init__(self):
+        self.uploaded = False
+        self._mbid = None
+        self.lookup_status = None
+        self.lookup_attempts = None
+        self.next_lookup = None
+
+    @classmethod
+    def from_dict(cls, fields):
+        """
+        :param fields: fields of the artist, in the json format
+        :type fields: dict
+        """
+        record = cls()
+        for field, value in fields.items():
+            if field in FIELDS:
+                record.set(field, value)
+        return record
+
+    @property
+    def mbid(self):
+        return _unpack_mbid(self._mbid)
+
+    @mbid.setter
+    def mbid(self, mbid):
+        self._mbid = _pack_mbid(mbid)
+
+    def get(self, field, default=None):
+        """
+        Get a field, like dict.get()
+        """
+        value = getattr(self, field) if field in FIELDS else None
+        return default if value is None else value
+
+    def set(self, field, value):
+        if field == "lookup_status" and value is not None:
+            value = sys.intern(value)
+        setattr(self, field, value)
+
+    def to_dict(self, fields=FIELDS):
+        """
+        Get the fields which are set
+
+        :param fields: fields to get
+        :returns fields: dict
+        """
+        result = dict()
+        for field in fields:
+            value = self.get(field)
+            if value is not None:
+                result[field] = value
+        return result
+
+
+def _decode_object(pairs):
+    """
+    Build the artists records while decoding the json file, without keeping
+    the fields of every artist in dicts
+
+    Objects are decoded from the innermost: the ones containing records are
+    the artists list.
+    """
+    if pairs and not isinstance(pairs[0][1], (_Artist_record, dict)):
+        record = _Artist_record()
+        for field, value in pairs:
+            if field in FIELDS:
+                record.set(field, value)
+        return record
+    return {sys.intern(name): (_Artist_record.from_dict(val)
+                               if isinstance(val, dict) else val)
+            for name, val in pairs}
+
+
+def convert_db(src, dst, binary):
+    """
+    Convert an artists database between the json format and the binary
+    snapshot, with its journal and its metadata
+
+    :param src: path of the database to convert
+    :param dst: path of the converted database
+    :param binary: convert the json database src to a binary snapshot, or the
+        binary snapshot src to json
+    :type binary: bool
+    """
+    src_db = Artist_db(jsonpath=src, binary=not binary)
+    dst_db = Artist_db(jsonpath=dst, artists=dict(), binary=binary)
+    dst_db._artists = src_db._artists
+    dst_db._meta = src_db._meta
+    dst_db.close()
+    src_db.close()
+    if not os.path.exists(dst):
+        return
+    # Moved aside, so it is converted again instead of being loaded as it was
+    # before this conversion when switching back
+    for suffix in ("", ".journal", ".meta"):
+        if os.path.exists(src + suffix):
+            os.replace(src + suffix, src + suffix + ".bak")
+
+
+class _Journal():
+    """
+    Append-only log of the mutations of an Artist_db
+
+    Records are queued by the caller and written by a background thread, which
+    coalesces all the pending records in one write and fsync.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._pending = []
+        self._writing = False
+        self._closed = False
+        self._cond = threading.Condition()
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        try:
+            self.size = os.path.getsize(path)
+        except FileNotFoundError:
+            self.size = 0
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending and self._closed:
+                    return
+                records, self._pending = self._pending, []
+                self._writing = True
+            try:
+                data = "".join(
+                    json.dumps(r, separators=(",", ":")) + "\n"
+                    for r in records
+                ).encode()
+                with open(self.path, "ab") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                self.size += len(data)
+            except Exception as e:
+                print("Error when writing the database journal")
+                print(e)
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+
+    def append(self, record):
+        """
+        Queue a record to write in the journal
+
+        :param record: mutation to log, serializable in json
+        :type record: list
+        """
+        with self._cond:
+            self._pending.append(record)
+            self._cond.notify_all()
+
+    def flush(self):
+        """
+        Wait until all queued records are written on the disk
+        """
+        with self._cond:
+            while self._pending or self._writing:
+                self._cond.wait()
+
+    def truncate(self):
+        """
+        Drop all records of the journal. Queued records are written first.
+        """
+        with self._cond:
+            while self._pending or self._writing:
+                self._cond.wait()
+            with open(self.path, "wb") as f:
+                os.fsync(f.fileno())
+            self.size = 0
+
+    def close(self):
+        """
+        Write the queued records and stop the writer thread
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def replay(self, artists):
+        """
+        Apply the journal records on a dict of artists
+
+        A truncated last record, left by a crash during a write, is dropped of
+        the journal.
+
+        :param artists: artists records loaded from the json file
+        :type artists: dict
+        """
+        try:
+            f = open(self.path, "rb+")
+        except FileNotFoundError:
+            return
+        with f:
+            valid_size = 0
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError
+                    record = json.loads(line.decode())
+                except ValueError:
+                    f.truncate(valid_size)
+                    self.size = valid_size
+                    break
+                valid_size += len(line)
+                op, artist = record[0], record[1]
+                if op == "add":
+                    artists.setdefault(sys.intern(artist), _Artist_record())
+                elif op == "del":
+                    artists.pop(artist, None)
+                elif (op == "set" and artist in artists and
+                        record[2] in FIELDS):
+                    artists[artist].set(record[2], record[3])
 
 
 class Artist_db():
-    def __init__(self, jsonpath=None, artists=None):
-        self._artists = artists if artists is not None else dict()
+    def __init__(self, jsonpath=None, artists=None, journal=None,
+                 binary=False):
+        """
+        :param jsonpath: path of the json file, or of the binary snapshot
+        :param artists: replace the content of the database by these artists
+        :type artists: dict of artist name: fields
+        :param journal: log the mutations in a journal, ARTISTS_DB_JOURNAL by
+            default
+        :param binary: store the database in a binary snapshot (see
+            artist_snapshot) instead of json
+        :type binary: bool
+        """
+        self.binary = binary
         self.ignore_list = set(i.lower() for i in config.IGNORE_LIST) or set()
+        self._snapshot = None
+        self._artists = dict()
+        if artists is not None:
+            self._artists = {
+                sys.intern(name): _Artist_record.from_dict(val)
+                for name, val in artists.items()
+            }
         self.jsonpath = jsonpath
+        # A fresh db has to replace the json file
+        self._dirty = artists is not None
+        self._meta = dict()
+        self._meta_dirty = artists is not None
+        journal = ARTISTS_DB_JOURNAL if journal is None else journal
+        self._journal = None
+        if jsonpath is not None and journal:
+            self._journal = _Journal(jsonpath + ".journal")
+            # A fresh db has to replace the json file and the journal
+            self._compact_needed = artists is not None
         if jsonpath is not None:
             try:
                 if artists is None:
@@ -23,57 +342,231 @@ class Artist_db():
                       "one...")
                 pass
 
-    def _diff_artists(self, artists):
+    @property
+    def _artists(self):
         """
-        Compare keys of self._artists with artists
+        Artists records by name
 
-        :param artists: list of artists to compare with
-        :type artists: list
-        :returns keys: list of artists differents between self._artists and
-            artists
+        With a binary snapshot, they are only read the first time they are
+        needed: until then, self._records is None and the queries which can be
+        answered by self._snapshot do not read every artist.
         """
+        if self._records is None:
+            # The iterations started before keep reading the snapshot, which
+            # stays open until it is replaced (see _close_snapshot())
+            self._artists = self._snapshot.to_dict()
+        return self._records
+
+    @_artists.setter
+    def _artists(self, artists):
+        self._records = artists
+        self._build_indexes()
+
+    def _close_snapshot(self):
+        """
+        Unmap the binary snapshot, once its file is replaced or the database
+        closed
+        """
+        if self._snapshot is not None:
+            self._snapshot.close()
+            self._snapshot = None
+
+    def load(self):
+        """
+        Refresh the artists list from the json file, or open the binary
+        snapshot
+        """
+        try:
+            if self.binary:
+                from .artist_snapshot import Artist_snapshot
+                snapshot = Artist_snapshot(self.jsonpath)
+                self._close_snapshot()
+                self._records = None
+                self._snapshot = snapshot
+                self._build_indexes()
+            else:
+                with open(self.jsonpath, "r") as f:
+                    self._artists = json.load(f,
+                                              object_pairs_hook=_decode_object)
+        except FileNotFoundError:
+            if self._journal is None:
+                raise
+            self._artists = dict()
+        if self._journal is not None and self._journal.size:
+            self._journal.replay(self._artists)
+            self._build_indexes()
         try:
-            db_keys = set(self._artists.keys())
-        except:
-            db_keys = set()
-        set_artists = set(artists)
-        return db_keys.difference(set_artists).symmetric_difference(
-            set_artists.difference(db_keys))
+            with open(self.jsonpath + ".meta", "r") as f:
+                self._meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self._meta = dict()
 
-    def _get_fields(self):
+    def _log(self, *record):
         """
-        Get the database fields/columns
+        Mark the database as modified, and log the mutation in the journal if
+        it is enabled
 
-        :returns fields
+        :param record: operation, artist name and operation arguments
         """
+        self._dirty = True
+        if self._journal is not None:
+            self._journal.append(record)
+
+    def _save_meta(self):
+        """
+        Save the metadata into a json file next to the database
+
+        It is saved after the artists, so the metadata never describe a state
+        of the database which is not on the disk.
+        """
+        if not self._meta_dirty:
+            return
+        tmp_path = self.jsonpath + ".meta.tmp"
         try:
-            fields = list(next(iter(self._artists.values())).keys())
-        except StopIteration:
-            fields = []
-        return fields
+            with open(tmp_path, "w") as f:
+                json.dump(self._meta, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.jsonpath + ".meta")
+            self._meta_dirty = False
+        except Exception as e:
+            print("Error when saving the database")
+            print(e)
 
-    def load(self):
+    def get_meta(self, key):
         """
-        Refresh the artists list from the json file
+        Get a metadata of the database, like the state of the last
+        synchronization
+
+        :param key: name of the metadata
+        :returns value: value of the metadata, None if it is not set
         """
-        with open(self.jsonpath, "r") as f:
-            self._artists = json.load(f)
+        return self._meta.get(key)
+
+    def set_meta(self, key, value):
+        """
+        Set a metadata of the database. It is saved with the database.
+
+        :param key: name of the metadata
+        :param value: value of the metadata, serializable in json
+        """
+        if self._meta.get(key) != value:
+            self._meta[key] = value
+            self._meta_dirty = True
+
+    def _dump(self, f):
+        """
+        Write the artists in json into a file, or in a binary snapshot
+
+        The fields of each artist are converted to a dict only while it is
+        written.
+        """
+        if self.binary:
+            from .artist_snapshot import write_snapshot
+            return write_snapshot(f, self._artists)
+        json.dump(self._artists, f, indent=4,
+                  default=_Artist_record.to_dict)
+
+    def _replace_file(self):
+        """
+        Write the artists in a new file, which atomically replaces the
+        database
+
+        The binary snapshot is always replaced, never rewritten: it can still
+        be mapped.
+        """
+        tmp_path = self.jsonpath + ".tmp"
+        with open(tmp_path, "wb" if self.binary else "w") as f:
+            self._dump(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.jsonpath)
+        # Every artist was read to write the new file
+        self._close_snapshot()
 
     def save(self):
         """
         Save the artists list into the json file
+
+        With the journal enabled, the mutations are already logged, so the json
+        file is only rewritten when the journal has grown too much.
         """
+        if self._journal is not None:
+            snapshot_size = 0
+            if os.path.exists(self.jsonpath):
+                snapshot_size = os.path.getsize(self.jsonpath)
+            compact_size = max(snapshot_size, JOURNAL_MIN_COMPACT_SIZE)
+            if self._compact_needed or self._journal.size > compact_size:
+                self.compact()
+            return
+
         new_db = not os.path.exists(self.jsonpath)
+        if not (self._dirty or new_db):
+            self._save_meta()
+            return
         fmode = "a" if new_db else "w"
         try:
             artist_db_dirname = os.path.dirname(self.jsonpath)
             if not os.path.exists(artist_db_dirname):
                 os.makedirs(artist_db_dirname)
-            with open(self.jsonpath, fmode) as f:
-                json.dump(self._artists, f, indent=4)
+            if self.binary:
+                self._replace_file()
+            else:
+                with open(self.jsonpath, fmode) as f:
+                    self._dump(f)
+            self._dirty = False
         except Exception as e:
             print("Error when saving the database")
             print(e)
+            return
+        self._save_meta()
+
+    def compact(self):
+        """
+        Fold the journal into the json file (or the binary snapshot)
+
+        The json file is atomically replaced before truncating the journal.
+        Replaying the journal on the new json file gives the same state, so a
+        crash between both steps is harmless.
+        """
+        if self._journal is None:
+            return self.save()
+        self._journal.flush()
+        if not (self._compact_needed or self._journal.size or
+                not os.path.exists(self.jsonpath)):
+            return self._save_meta()
+        try:
+            artist_db_dirname = os.path.dirname(self.jsonpath)
+            if not os.path.exists(artist_db_dirname):
+                os.makedirs(artist_db_dirname)
+            self._replace_file()
+            self._journal.truncate()
+            self._compact_needed = False
+            self._dirty = False
+        except Exception as e:
+            print("Error when saving the database")
+            print(e)
+            return
+        self._save_meta()
+
+    def close(self):
+        """
+        Write everything pending on the disk and stop the journal writer
+        """
+        if self._journal is not None:
+            self.compact()
+            self._journal.close()
+            self._journal = None
+        else:
+            self.save()
+        self._close_snapshot()
+
+    def needs_lock(self):
+        """
+        The database is not thread safe: the threads have to hold a shared
+        lock when writing it
+        """
+        return True
 
     def add(self, artists):
         """
@@ -90,8 +583,13 @@ class Artist_db():
             except:
                 pass
 
-        if artists not in self._artists.keys():
-            self._artists[str(artists)] = {"uploaded": False, }
+        if artists not in self._artists:
+            artist = sys.intern(str(artists))
+            self._artists[artist] = _Artist_record()
+            self._index(artist)
+            if artist in self.ignore_list:
+                self._ignored.add(artist)
+            self._log("add", artist)
 
     def remove(self, artists):
         """
@@ -108,35 +606,115 @@ class Artist_db():
             except:
                 pass
 
-        if artists in self._artists.keys():
+        if artists in self._artists:
             self._artists.pop(artists)
+            self._non_uploaded.pop(artists, None)
+            self._without_mbid.pop(artists, None)
+            self._ignored.discard(artists)
+            self._log("del", artists)
 
-    def _artists_grouped_by(self, artists, group_by, fields=None):
+    def _build_indexes(self):
         """
-        Return artists grouped by a field. The get_artists function would
-        already have done the filters
+        Build the sets of the non-uploaded artists, of the artists without
+        musicbrainz id and of the ignored artists
+
+        Each change then keeps them up to date (see _index()), so the queries
+        on these sets and their counts do not go through every artist. The
+        first two are dicts with None values, to keep the order of the
+        artists.
+
+        Until the artists of a binary snapshot are read, the snapshot has its
+        own sets and only the ignored artists are looked up.
+        """
+        if self._records is None:
+            self._non_uploaded = self._without_mbid = None
+            self._ignored = {a for a in self.ignore_list
+                             if a in self._snapshot}
+            return
+        artists = self._records
+        self._non_uploaded = {artist: None
+                              for artist, record in artists.items()
+                              if not record.uploaded}
+        self._without_mbid = {artist: None
+                              for artist, record in artists.items()
+                              if record._mbid is None}
+        self._ignored = {a for a in self.ignore_list if a in artists}
+
+    def _index(self, artist):
+        """
+        Update the sets of _build_indexes() after a change of an artist
+
+        :param artist: artist name
+        """
+        record = self._artists[artist]
+        if record.uploaded:
+            self._non_uploaded.pop(artist, None)
+        else:
+            self._non_uploaded[artist] = None
+        if record._mbid is None:
+            self._without_mbid[artist] = None
+        else:
+            self._without_mbid.pop(artist, None)
+
+    def _artists_grouped_by(self, group_by, fields=None, uploaded=None):
+        """
+        Return artists grouped by a field
 
-        :param artists: artists to group by
-        :type artists: dict
         :param group_by: field use to grouping
         :param fields: get other fields, like musicbrainz id. By default, will
                        just the names will be returned
+        :param uploaded: filter on the uploaded field
         """
         artists_grouped = dict()
-        for artist, val in artists.items():
+        for artist, record in self._artists.items():
+            if uploaded is not None and record.uploaded != uploaded:
+                continue
+            if artist in self._ignored:
+                continue
             if fields is None:
                 artist_insert = artist
             else:
-                artist_insert = {field: self._artists[artist][field]
-                                 for field in fields if field in
-                                 self._artists[artist].keys()}
+                artist_insert = record.to_dict(fields)
                 artist_insert["name"] = artist
+            artists_grouped.setdefault(record.get(group_by), []).append(
+                artist_insert
+            )
+        return artists_grouped
+
+    def iter_artists(self, fields=None, uploaded=None):
+        """
+        Iterate over the artists, like get_artists() without grouping
+
+        Nothing is copied beforehand, except the names of the non-uploaded
+        artists: each artist is read when it is reached, so no artist must be
+        added or removed during the iteration.
 
-            if val[group_by] in artists_grouped.keys():
-                artists_grouped[val[group_by]].append(artist_insert)
+        :param fields: fields to select
+        :type fields: tuple
+        :param uploaded: filter on the uploaded field
+        :type uploaded: bool
+        """
+        if self._records is None:
+            artists = self._snapshot.items(
+                "non_uploaded" if uploaded is False else None
+            )
+        elif uploaded is False:
+            # They can be uploaded during the iteration
+            artists = [(artist, self._records[artist])
+                       for artist in self._non_uploaded]
+        else:
+            artists = self._records.items()
+        for artist, record in artists:
+            if uploaded is not None and record.uploaded != uploaded:
+                continue
+            if artist in self._ignored:
+                continue
+            if fields is None:
+                yield artist
             else:
-                artists_grouped[val[group_by]] = [artist_insert, ]
-        return artists_grouped
+                artist_insert = record.to_dict(fields)
+                artist_insert["name"] = artist
+                yield artist_insert
 
     def get_artists(self, fields=None, uploaded=None, group_by=None):
         """
@@ -148,6 +726,7 @@ class Artist_db():
         artist, it will not ignored (for this artist).
         If group_by is not None, will return a list of artist names group by
         the wanted field.
+        Ignored artists are left out, but are kept in the database.
 
         :param fields: fields to select
         :type fields: tuple
@@ -157,33 +736,58 @@ class Artist_db():
         :type group_by: str
         :returns artists
         """
-        artists = self._artists
-
-        for ignore_artist in self.ignore_list:
-            try:
-                artists.pop(ignore_artist)
-            except KeyError:
-                continue
-
-        if uploaded is not None:
-            artists = {artist: val for artist, val in self._artists.items()
-                       if val["uploaded"] == uploaded}
+        if group_by in FIELDS:
+            return self._artists_grouped_by(group_by, fields, uploaded)
+        return list(self.iter_artists(fields, uploaded))
 
-        if group_by is not None and group_by in self._get_fields():
-            return self._artists_grouped_by(artists, group_by, fields)
+    def count_artists(self, uploaded=None):
+        """
+        Count the artists, like len(get_artists(uploaded=uploaded)) without
+        building the list
 
-        if fields is None:
-            artist_list = [artist for artist in artists.keys()]
+        :param uploaded: filter on the uploaded field
+        :type uploaded: bool
+        """
+        if self._records is None:
+            total = len(self._snapshot)
+            non_uploaded = self._snapshot.count("non_uploaded")
+            ignored_non_uploaded = sum(
+                1 for a in self._ignored if not self._snapshot.get(a).uploaded
+            )
         else:
-            artist_list = []
-            for artist in artists:
-                artist_insert = {field: self._artists[artist][field]
-                                 for field in fields if field in
-                                 self._artists[artist].keys()}
-                artist_insert["name"] = artist
-                artist_list.append(artist_insert)
-
-        return artist_list
+            total = len(self._records)
+            non_uploaded = len(self._non_uploaded)
+            ignored_non_uploaded = sum(1 for a in self._ignored
+                                       if a in self._non_uploaded)
+        if uploaded is None:
+            return total - len(self._ignored)
+        elif uploaded:
+            return (total - non_uploaded -
+                    (len(self._ignored) - ignored_non_uploaded))
+        return non_uploaded - ignored_non_uploaded
+
+    def get_artists_without_mbid(self, due=None, failed=False):
+        """
+        Get the list of artists name that do not have a musicbrainz id
+
+        :param due: only get the artists which can be searched again at this
+            time (unix timestamp), see mark_lookup_failed()
+        :type due: float
+        :param failed: only get the artists which were already searched
+            without success
+        :type failed: bool
+        """
+        if self._records is None:
+            artists = self._snapshot.items("without_mbid")
+        else:
+            artists = ((artist, self._records[artist])
+                       for artist in self._without_mbid)
+        return [
+            artist for artist, record in artists
+            if artist not in self._ignored and
+            (due is None or (record.next_lookup or 0) <= due) and
+            (not failed or record.lookup_status is not None)
+        ]
 
     def get_mbid(self, artist):
         """
@@ -191,11 +795,11 @@ class Artist_db():
 
         :param artist: artist name
         """
-        try:
-            mbid = self._artists[artist]["mbid"]
-        except KeyError:
-            mbid = None
-        return mbid
+        if self._records is None:
+            record = self._snapshot.get(artist)
+        else:
+            record = self._artists.get(artist)
+        return record.mbid if record is not None else None
 
     def is_ignored(self, artist):
         """
@@ -209,13 +813,28 @@ class Artist_db():
         """
         Mark an artist as uploaded
         """
-        self._artists[artist]["uploaded"] = True
+        self._artists[artist].uploaded = True
+        self._non_uploaded.pop(artist, None)
+        self._log("set", artist, "uploaded", True)
 
     def mark_as_non_uploaded(self, artist):
         """
         Mark an artist as non uploaded
         """
-        self._artists[artist]["uploaded"] = False
+        self._artists[artist].uploaded = False
+        self._non_uploaded[artist] = None
+        self._log("set", artist, "uploaded", False)
+
+    def _set_field(self, artist, field, value):
+        """
+        Set a field of an artist, and log it
+
+        Fields set to None are considered as missing.
+        """
+        self._artists[artist].set(field, value)
+        if field in ("uploaded", "mbid"):
+            self._index(artist)
+        self._log("set", artist, field, value)
 
     def set_mbid(self, artist, mbid):
         """
@@ -224,27 +843,114 @@ class Artist_db():
         :param artist: artist name
         :param mbid: Musicbrainz id
         """
-        self._artists[artist]["mbid"] = mbid
+        self._set_field(artist, "mbid", mbid)
+        status = "found" if mbid is not None else None
+        if self._artists[artist].get("lookup_status") != status:
+            self._set_field(artist, "lookup_status", status)
+        if self._artists[artist].get("next_lookup") is not None:
+            self._set_field(artist, "lookup_attempts", 0)
+            self._set_field(artist, "next_lookup", None)
+
+    def mark_lookup_failed(self, artist, status, delay, max_delay):
+        """
+        Postpone the next search of an artist's id after a failed one
+
+        The delay doubles with each failed attempt.
+
+        :param artist: artist name
+        :param status: cause of the failure, "not_found" or "error"
+        :param delay: delay before searching again after the first failure, in
+            seconds
+        :param max_delay: maximum delay before searching again, in seconds
+        """
+        attempts = (self._artists[artist].get("lookup_attempts") or 0) + 1
+        self._set_field(artist, "lookup_status", status)
+        self._set_field(artist, "lookup_attempts", attempts)
+        self._set_field(artist, "next_lookup",
+                        time.time() + retry_delay(attempts, delay, max_delay))
+
+    def reset_lookups(self):
+        """
+        Forget the delays of the failed searches, to search again every artist
+        without id
+
+        The status of the last search is kept: the cached responses of these
+        artists are not used by their next search.
+        """
+        for artist, record in self._artists.items():
+            if record.next_lookup is not None:
+                self._set_field(artist, "lookup_attempts", 0)
+                self._set_field(artist, "next_lookup", None)
 
     def merge(self, artists):
         """
-        Merge artists in the db with a list of artists name sent in parameter
+        Merge artists in the db with the artists of the mpd library
+
+        The artists are read in one pass, so they can be streamed from mpd (see
+        tools.mpd_iter_artists()). Meanwhile, only the artists seen are kept,
+        as references to the names of the db.
 
-        :param artists: list of artists to compare the db with
-        :type artists: list
-        :returns (added, deleted): tuple of removed and added artists list
+        :param artists: artists names, which can have duplicates
+        :type artists: iterable
+        :returns (added, removed): number of artists added and removed
         :rtype: tuple
         """
-        a_diff = self._diff_artists(artists)
-        added = []
-        removed = []
-        for a in a_diff:
+        seen = set()
+        added = 0
+        for a in artists:
             if a in self.ignore_list:
                 continue
-            elif a in self._artists:
-                self.remove(a)
-                removed.append(a)
-            else:
+            # The names of the db are interned: the same string is kept
+            a = sys.intern(a)
+            if a not in self._artists:
                 self.add(a)
-                added.append(a)
-        return (added, removed)
+                added += 1
+            seen.add(a)
+        removed = [a for a in self._artists
+                   if a not in seen and a not in self.ignore_list]
+        del seen
+        self.remove(removed)
+        return (added, len(removed))
+
+
+class Db_saver():
+    """
+    Apply changes on an artists database, and save it at most every
+    `interval` seconds
+
+    The process owning the database applies with it the results of the
+    workers, without rewriting the database for every artist.
+    """
+    def __init__(self, artist_db, db_lock=None, interval=DB_SAVE_INTERVAL):
+        """
+        :param artist_db: database of artists
+        :param db_lock: lock to hold when writing the database, if other
+            threads write it at the same time
+        :type db_lock: threading.Lock
+        :param interval: minimum delay between two saves, in seconds
+        """
+        self.artist_db = artist_db
+        self.db_lock = db_lock
+        self.interval = interval
+        self._last_save = time.monotonic()
+
+    def update(self, method, *args):
+        """
+        Call a method changing the database, and save it if it was not saved
+        recently
+
+        :param method: name of the method, like "set_mbid"
+        :param args: arguments of the method
+        """
+        with self.db_lock or nullcontext():
+            getattr(self.artist_db, method)(*args)
+            if time.monotonic() - self._last_save > self.interval:
+                self._save()
+
+    def save(self):
+        with self.db_lock or nullcontext():
+            self._save()
+
+    def _save(self):
+        self.artist_db.save()
+        self._last_save = time.monotonic()
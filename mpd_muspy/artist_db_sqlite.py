@@ -0,0 +1,452 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from .artist_db import Artist_db, retry_delay
+from .tools import get_config
+
+config = get_config()
+
+#: artist fields stored as columns. Other fields are not supported.
+FIELDS = ("uploaded", "mbid", "lookup_status", "lookup_attempts",
+          "next_lookup")
+
+#: columns added after the first version of the schema, with their definition
+ADDED_COLUMNS = (
+    ("lookup_attempts", "INTEGER NOT NULL DEFAULT 0"),
+    ("next_lookup", "REAL"),
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artists (
+    name TEXT PRIMARY KEY NOT NULL,
+    uploaded INTEGER NOT NULL DEFAULT 0,
+    mbid TEXT,
+    lookup_status TEXT,
+    lookup_attempts INTEGER NOT NULL DEFAULT 0,
+    next_lookup REAL
+);
+CREATE INDEX IF NOT EXISTS artists_uploaded ON artists (uploaded);
+CREATE INDEX IF NOT EXISTS artists_mbid ON artists (mbid);
+CREATE INDEX IF NOT EXISTS artists_lookup_status ON artists (lookup_status);
+CREATE INDEX IF NOT EXISTS artists_missing_mbid ON artists (name)
+    WHERE mbid IS NULL;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY NOT NULL,
+    value TEXT
+);
+"""
+
+
+class Artist_db_sqlite():
+    """
+    Artists database stored in SQLite, with the same interface as Artist_db
+
+    The database is in WAL mode and every process and thread opens its own
+    connection, so workers can read and write it concurrently: this object can
+    be sent to the processes of a pool instead of being shared through a
+    manager.
+    """
+    #: time (in seconds) to wait for the lock of another writer
+    timeout = 60
+
+    def __init__(self, dbpath, artists=None, jsonpath=None):
+        """
+        :param dbpath: path of the sqlite database
+        :param artists: replace the content of the database by these artists
+        :type artists: dict
+        :param jsonpath: json database to import if the sqlite database is new
+        """
+        self.dbpath = dbpath
+        self.ignore_list = set(i.lower() for i in config.IGNORE_LIST) or set()
+        self._local = threading.local()
+
+        new_db = not os.path.exists(dbpath)
+        if artists is not None:
+            self.clear()
+            self._import(artists)
+        elif new_db and jsonpath is not None and os.path.exists(jsonpath):
+            print("Migrating the database from", jsonpath, "...")
+            json_db = Artist_db(jsonpath=jsonpath)
+            self._import(json_db._artists)
+            json_db.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        """
+        Connection to the database, opened once by process and by thread
+        """
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            dirname = os.path.dirname(self.dbpath)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            local.conn = sqlite3.connect(
+                self.dbpath, timeout=self.timeout, isolation_level=None
+            )
+            local.conn.execute("PRAGMA journal_mode=WAL")
+            local.conn.execute("PRAGMA synchronous=NORMAL")
+            local.conn.executescript(SCHEMA)
+            self._migrate(local.conn)
+            local.pid = os.getpid()
+        return local.conn
+
+    def _migrate(self, conn):
+        """
+        Add the columns missing in a database created by an older version
+        """
+        columns = {row[1]
+                   for row in conn.execute("PRAGMA table_info(artists)")}
+        for name, definition in ADDED_COLUMNS:
+            if name not in columns:
+                try:
+                    conn.execute("ALTER TABLE artists ADD COLUMN {} {}".format(
+                        name, definition
+                    ))
+                except sqlite3.OperationalError:
+                    # Added by another connection in the meantime
+                    pass
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Group the statements in one transaction
+        """
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _import(self, artists):
+        """
+        Insert artists from a dict of the Artist_db format
+
+        :param artists: dict of artist name: fields
+        :type artists: dict
+        """
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO artists (name, uploaded, mbid, "
+                "lookup_status, lookup_attempts, next_lookup) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                ((name, bool(val.get("uploaded")), val.get("mbid"),
+                  val.get("lookup_status"), val.get("lookup_attempts") or 0,
+                  val.get("next_lookup"))
+                 for name, val in artists.items())
+            )
+
+    def _ignore_filter(self):
+        """
+        Build the sql filter to exclude ignored artists
+
+        :returns (sql, params): condition and its parameters
+        """
+        if not self.ignore_list:
+            return "1", ()
+        return (
+            "name NOT IN ({})".format(", ".join("?" * len(self.ignore_list))),
+            tuple(self.ignore_list)
+        )
+
+    def _row_to_artist(self, row, fields):
+        """
+        Convert a row (name, *fields) to the Artist_db format, without the
+        empty fields
+        """
+        artist = {field: value for field, value in zip(fields, row[1:])
+                  if value is not None}
+        if "uploaded" in artist:
+            artist["uploaded"] = bool(artist["uploaded"])
+        artist["name"] = row[0]
+        return artist
+
+    def load(self):
+        pass
+
+    def save(self):
+        """
+        Every change is committed immediately, nothing to do
+        """
+        pass
+
+    def compact(self):
+        """
+        Fold the write-ahead log into the database
+        """
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        """
+        Close the connection of this process and thread
+        """
+        if getattr(self._local, "pid", None) == os.getpid():
+            self.compact()
+            self._local.conn.close()
+        self._local = threading.local()
+
+    def needs_lock(self):
+        """
+        Concurrent writes are handled by sqlite, no shared lock is needed
+        """
+        return False
+
+    def clear(self):
+        """
+        Remove all artists and metadata of the database
+        """
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM artists")
+            conn.execute("DELETE FROM meta")
+
+    def get_meta(self, key):
+        """
+        Get a metadata of the database, like the state of the last
+        synchronization
+
+        :param key: name of the metadata
+        :returns value: value of the metadata, None if it is not set
+        """
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?",
+                                (key, )).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def set_meta(self, key, value):
+        """
+        Set a metadata of the database
+
+        :param key: name of the metadata
+        :param value: value of the metadata, serializable in json
+        """
+        self.conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            (key, json.dumps(value))
+        )
+
+    def add(self, artists):
+        """
+        Add artist(s) in the db
+
+        :param artist: artist(s) to add into the db
+        :type artists: str or list
+        """
+        if type(artists) is str:
+            artists = (artists, )
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO artists (name) VALUES (?)",
+                ((str(a), ) for a in artists)
+            )
+
+    def remove(self, artists):
+        """
+        Remove artist off the db
+
+        :param artist: artist(s) to remove off the db
+        :type artists: str or list
+        """
+        if type(artists) is str:
+            artists = (artists, )
+        with self._transaction() as conn:
+            conn.executemany("DELETE FROM artists WHERE name = ?",
+                             ((a, ) for a in artists))
+
+    def get_artists(self, fields=None, uploaded=None, group_by=None):
+        """
+        Get the list of artists name, with optional filter and group by.
+
+        See Artist_db.get_artists()
+        """
+        with_fields = fields is not None
+        fields = tuple(f for f in fields or () if f in FIELDS)
+        where, params = self._ignore_filter()
+        if uploaded is not None:
+            where += " AND uploaded = ?"
+            params += (bool(uploaded), )
+        columns = ("name", ) + fields
+        if group_by in FIELDS:
+            columns += (group_by, )
+        rows = self.conn.execute(
+            "SELECT {} FROM artists WHERE {}".format(", ".join(columns),
+                                                     where),
+            params
+        )
+
+        if group_by in FIELDS:
+            artists_grouped = dict()
+            for row in rows:
+                key = row[-1]
+                if group_by == "uploaded":
+                    key = bool(key)
+                if with_fields:
+                    artist = self._row_to_artist(row[:-1], fields)
+                else:
+                    artist = row[0]
+                artists_grouped.setdefault(key, []).append(artist)
+            return artists_grouped
+        if not with_fields:
+            return [row[0] for row in rows]
+        return [self._row_to_artist(row, fields) for row in rows]
+
+    def iter_artists(self, fields=None, uploaded=None):
+        """
+        Iterate over the artists, like get_artists() without grouping
+
+        The rows are fetched before the iteration, as the database can be
+        written meanwhile.
+
+        See Artist_db.iter_artists()
+        """
+        return iter(self.get_artists(fields, uploaded))
+
+    def count_artists(self, uploaded=None):
+        """
+        Count the artists
+
+        See Artist_db.count_artists()
+        """
+        where, params = self._ignore_filter()
+        if uploaded is not None:
+            where += " AND uploaded = ?"
+            params += (bool(uploaded), )
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM artists WHERE " + where, params
+        ).fetchone()[0]
+
+    def get_artists_without_mbid(self, due=None, failed=False):
+        """
+        Get the list of artists name that do not have a musicbrainz id
+
+        See Artist_db.get_artists_without_mbid()
+        """
+        where, params = self._ignore_filter()
+        if due is not None:
+            where += " AND (next_lookup IS NULL OR next_lookup <= ?)"
+            params += (due, )
+        if failed:
+            where += " AND lookup_status IS NOT NULL"
+        return [row[0] for row in self.conn.execute(
+            "SELECT name FROM artists WHERE mbid IS NULL AND " + where, params
+        )]
+
+    def get_mbid(self, artist):
+        """
+        Get the musicbrainz id of an artist
+
+        :param artist: artist name
+        """
+        row = self.conn.execute("SELECT mbid FROM artists WHERE name = ?",
+                                (artist, )).fetchone()
+        return row[0] if row is not None else None
+
+    def is_ignored(self, artist):
+        """
+        Check if artist is ignored or not
+
+        :param artist: artist name
+        """
+        return artist.lower() in self.ignore_list
+
+    def mark_as_uploaded(self, artist):
+        """
+        Mark an artist as uploaded
+        """
+        self.conn.execute("UPDATE artists SET uploaded = 1 WHERE name = ?",
+                          (artist, ))
+
+    def mark_as_non_uploaded(self, artist):
+        """
+        Mark an artist as non uploaded
+        """
+        self.conn.execute("UPDATE artists SET uploaded = 0 WHERE name = ?",
+                          (artist, ))
+
+    def set_mbid(self, artist, mbid):
+        """
+        Update the musicbrainz id of an artist
+
+        :param artist: artist name
+        :param mbid: Musicbrainz id
+        """
+        self.conn.execute(
+            "UPDATE artists SET mbid = ?, lookup_status = ?, "
+            "lookup_attempts = 0, next_lookup = NULL WHERE name = ?",
+            (mbid, "found" if mbid is not None else None, artist)
+        )
+
+    def mark_lookup_failed(self, artist, status, delay, max_delay):
+        """
+        Postpone the next search of an artist's id after a failed one
+
+        See Artist_db.mark_lookup_failed()
+        """
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT lookup_attempts FROM artists WHERE name = ?",
+                (artist, )
+            ).fetchone()
+            if row is None:
+                return
+            attempts = row[0] + 1
+            conn.execute(
+                "UPDATE artists SET lookup_status = ?, lookup_attempts = ?, "
+                "next_lookup = ? WHERE name = ?",
+                (status, attempts,
+                 time.time() + retry_delay(attempts, delay, max_delay),
+                 artist)
+            )
+
+    def reset_lookups(self):
+        """
+        Forget the delays of the failed searches, to search again every artist
+        without id
+
+        See Artist_db.reset_lookups()
+        """
+        self.conn.execute(
+            "UPDATE artists SET lookup_attempts = 0, next_lookup = NULL "
+            "WHERE next_lookup IS NOT NULL"
+        )
+
+    def merge(self, artists):
+        """
+        Merge artists in the db with the artists of the mpd library
+
+        See Artist_db.merge()
+        """
+        with self._transaction() as conn:
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS merged_artists "
+                         "(name TEXT PRIMARY KEY NOT NULL)")
+            conn.execute("DELETE FROM merged_artists")
+            conn.executemany(
+                "INSERT OR IGNORE INTO merged_artists (name) VALUES (?)",
+                ((a, ) for a in artists if a not in self.ignore_list)
+            )
+            added = conn.execute(
+                "INSERT INTO artists (name) SELECT name FROM merged_artists "
+                "WHERE name NOT IN (SELECT name FROM artists)"
+            ).rowcount
+            where, params = self._ignore_filter()
+            removed = conn.execute(
+                "DELETE FROM artists WHERE name NOT IN "
+                "(SELECT name FROM merged_artists) AND " + where, params
+            ).rowcount
+            conn.execute("DELETE FROM merged_artists")
+        return (added, removed)
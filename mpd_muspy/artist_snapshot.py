@@ -0,0 +1,266 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+import json
+import mmap
+import struct
+import sys
+import zlib
+from array import array
+from .artist_db import _Artist_record
+
+#: first bytes of a snapshot, with the version of its format
+MAGIC = b"MMSPADB1"
+
+#: header: magic, size of the json metadata
+HEADER = struct.Struct("<8sI")
+#: records section: name offset and size in the strings section, flags,
+#: lookup status, lookup attempts, next lookup and musicbrainz id
+RECORD = struct.Struct("<IIBBHd16s")
+#: offset and size in the strings section of a musicbrainz id which is not
+#: packed, stored in the musicbrainz id of the record
+TEXT = struct.Struct("<II")
+#: subsets and hash table sections: index of a record
+POSTING = struct.Struct("<I")
+
+#: maximum number of lookup attempts stored in a record. The delay before the
+#: next lookup stops growing long before, so more attempts are stored as it.
+MAX_LOOKUP_ATTEMPTS = 2 ** 16 - 1
+
+#: number of records read at once when reading all of them
+CHUNK = 4096
+
+# flags of a record
+UPLOADED = 1
+MBID = 2
+MBID_TEXT = 4
+LOOKUP_ATTEMPTS = 8
+NEXT_LOOKUP = 16
+
+#: subsets of the artists indexed in a snapshot, with their condition
+SUBSETS = (
+    ("non_uploaded", lambda record: not record.uploaded),
+    ("without_mbid", lambda record: record._mbid is None),
+)
+
+
+def _name_hash(name):
+    return zlib.crc32(name)
+
+
+def write_snapshot(f, artists):
+    """
+    Write artists in a binary snapshot
+
+    Records have a fixed size, so the nth one is read without decoding the
+    others. The snapshot also has the list of the records of each subset (see
+    SUBSETS) and a hash table of the names, to look an artist up.
+
+    :param f: file opened in binary mode
+    :param artists: artists records by name
+    :type artists: dict
+    """
+    records = bytearray()
+    strings = bytearray()
+    statuses = []
+    subsets = {name: array("I") for name, _ in SUBSETS}
+    hashes = array("I")
+    for i, (name, record) in enumerate(artists.items()):
+        name = name.encode(errors="surrogatepass")
+        name_offset = len(strings)
+        strings += name
+        hashes.append(_name_hash(name))
+
+        flags = UPLOADED if record.uploaded else 0
+        mbid = record._mbid
+        if type(mbid) is bytes:
+            flags |= MBID
+        elif mbid is not None:
+            flags |= MBID_TEXT
+            mbid = mbid.encode()
+            text = TEXT.pack(len(strings), len(mbid))
+            strings += mbid
+            mbid = text
+        status = 0
+        if record.lookup_status is not None:
+            if record.lookup_status not in statuses:
+                statuses.append(record.lookup_status)
+            status = statuses.index(record.lookup_status) + 1
+        if record.lookup_attempts is not None:
+            flags |= LOOKUP_ATTEMPTS
+        if record.next_lookup is not None:
+            flags |= NEXT_LOOKUP
+        records += RECORD.pack(
+            name_offset, len(name), flags, status,
+            min(record.lookup_attempts or 0, MAX_LOOKUP_ATTEMPTS),
+            record.next_lookup or 0,
+            mbid or b""
+        )
+        for subset, condition in SUBSETS:
+            if condition(record):
+                subsets[subset].append(i)
+
+    # Open addressing, with at most one half of the slots used. Slots contain
+    # the index of a record + 1, 0 if they are empty.
+    table_size = 1
+    while table_size < 2 * len(hashes):
+        table_size *= 2
+    table = array("I", bytes(POSTING.size * table_size))
+    mask = table_size - 1
+    for i, name_hash in enumerate(hashes):
+        slot = name_hash & mask
+        while table[slot]:
+            slot = (slot + 1) & mask
+        table[slot] = i + 1
+
+    meta = {"artists": len(hashes), "statuses": statuses,
+            "table": table_size, "strings": len(strings),
+            "subsets": [[name, len(subsets[name])] for name, _ in SUBSETS]}
+    meta = json.dumps(meta).encode()
+    f.write(HEADER.pack(MAGIC, len(meta)))
+    f.write(meta)
+    f.write(records)
+    for name, _ in SUBSETS:
+        f.write(_to_little_endian(subsets[name]))
+    f.write(_to_little_endian(table))
+    f.write(strings)
+
+
+def _to_little_endian(postings):
+    if sys.byteorder != "little":
+        postings = array("I", postings)
+        postings.byteswap()
+    return postings.tobytes()
+
+
+class Artist_snapshot():
+    """
+    Artists database written by write_snapshot()
+
+    The snapshot is memory-mapped: opening it is instantaneous, and only the
+    records which are read are decoded, like the ones of a subset.
+    """
+    def __init__(self, path):
+        """
+        :param path: path of the snapshot
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, meta_size = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError("Not an artists snapshot: " + path)
+        offset = HEADER.size
+        self.meta = json.loads(
+            self._mmap[offset:offset + meta_size].decode()
+        )
+        offset += meta_size
+        self.nb_artists = self.meta["artists"]
+        self._statuses = [None] + [sys.intern(status)
+                                   for status in self.meta["statuses"]]
+        self._records = offset
+        offset += self.nb_artists * RECORD.size
+        #: subset name: (offset, number of records)
+        self._subsets = dict()
+        for name, count in self.meta["subsets"]:
+            self._subsets[name] = (offset, count)
+            offset += count * POSTING.size
+        self._table = offset
+        self._table_size = self.meta["table"]
+        self._strings = offset + self._table_size * POSTING.size
+
+    def __len__(self):
+        return self.nb_artists
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def close(self):
+        self._mmap.close()
+
+    def count(self, subset):
+        """
+        Number of artists of a subset of SUBSETS
+        """
+        return self._subsets[subset][1]
+
+    def _decode(self, values):
+        """
+        Build the name and the record of unpacked RECORD values
+        """
+        (name_offset, name_size, flags, status, attempts, next_lookup,
+         mbid) = values
+        start = self._strings + name_offset
+        name = self._mmap[start:start + name_size].decode(
+            errors="surrogatepass"
+        )
+        record = _Artist_record()
+        record.uploaded = bool(flags & UPLOADED)
+        if flags & MBID:
+            record._mbid = mbid
+        elif flags & MBID_TEXT:
+            offset, size = TEXT.unpack_from(mbid)
+            start = self._strings + offset
+            record._mbid = self._mmap[start:start + size].decode()
+        record.lookup_status = self._statuses[status]
+        if flags & LOOKUP_ATTEMPTS:
+            record.lookup_attempts = attempts
+        if flags & NEXT_LOOKUP:
+            record.next_lookup = next_lookup
+        return name, record
+
+    def _read(self, i):
+        return self._decode(
+            RECORD.unpack_from(self._mmap, self._records + i * RECORD.size)
+        )
+
+    def items(self, subset=None):
+        """
+        Yield the artists of the snapshot, or of one of its subsets
+
+        :param subset: name of a subset of SUBSETS, None for every artist
+        :returns artists: iterator of (name, record)
+        """
+        if subset is None:
+            # Read by chunks, without copying the whole section
+            for first in range(0, self.nb_artists, CHUNK):
+                start = self._records + first * RECORD.size
+                end = start + min(CHUNK, self.nb_artists - first) * RECORD.size
+                for values in RECORD.iter_unpack(self._mmap[start:end]):
+                    yield self._decode(values)
+            return
+        offset, count = self._subsets[subset]
+        for (i, ) in POSTING.iter_unpack(
+                self._mmap[offset:offset + count * POSTING.size]):
+            yield self._read(i)
+
+    def get(self, name):
+        """
+        Look an artist up in the hash table
+
+        :param name: artist name
+        :returns record: record of the artist, None if it is not in the
+            snapshot
+        """
+        if not self._table_size:
+            return None
+        encoded = name.encode(errors="surrogatepass")
+        mask = self._table_size - 1
+        slot = _name_hash(encoded) & mask
+        while True:
+            (i, ) = POSTING.unpack_from(self._mmap,
+                                        self._table + slot * POSTING.size)
+            if not i:
+                return None
+            artist, record = self._read(i - 1)
+            if artist == name:
+                return record
+            slot = (slot + 1) & mask
+
+    def to_dict(self):
+        """
+        Read every artist
+
+        :returns artists: artists records by name
+        """
+        return {sys.intern(name): record for name, record in self.items()}
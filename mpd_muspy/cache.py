@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+import json
+import os
+import sqlite3
+import time
+import unicodedata
+from collections import Counter
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY NOT NULL,
+    response BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+CREATE TABLE IF NOT EXISTS cache_size (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    size INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO cache_size (id, size) VALUES (0, 0);
+"""
+
+
+class Response_cache():
+    """
+    Persistent cache of musicbrainz responses
+
+    Responses are stored in a sqlite database, shared by all processes, and
+    expire after `ttl` seconds. When the cache is bigger than `max_size` bytes,
+    the least recently used responses are evicted.
+    """
+    #: time (in seconds) to wait for the lock of another writer
+    timeout = 60
+
+    def __init__(self, path, ttl, max_size):
+        """
+        :param path: path of the sqlite database
+        :param ttl: lifetime of a response, in seconds
+        :param max_size: maximum size of the stored responses, in bytes
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.stats = Counter()
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        state["_pid"] = None
+        state["stats"] = Counter()
+        return state
+
+    @property
+    def conn(self):
+        """
+        Connection to the database, opened once by process
+        """
+        if self._conn is None or self._pid != os.getpid():
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                # The workers can open the cache at the same time
+                os.makedirs(dirname, exist_ok=True)
+            self._conn = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+            self._pid = os.getpid()
+            self.stats = Counter()
+        return self._conn
+
+    @staticmethod
+    def key(endpoint, query, limit, offset=0):
+        """
+        Build the key of a request
+
+        :param endpoint: name of the request, like "search_artists"
+        :param query: searched text, normalized in the key
+        :param limit: maximum number of results
+        :param offset: index of the first result, for paged requests
+        """
+        query = unicodedata.normalize("NFKC", query).casefold()
+        query = " ".join(query.split())
+        if offset:
+            return json.dumps([endpoint, query, limit, offset])
+        return json.dumps([endpoint, query, limit])
+
+    def get(self, key):
+        """
+        Get a response of the cache
+
+        :param key: key of the request, see key()
+        :returns response: the cached response, or None if it is missing or
+            expired
+        """
+        now = time.time()
+        row = self.conn.execute(
+            "SELECT response, created FROM responses WHERE key = ?", (key, )
+        ).fetchone()
+        if row is None or row[1] + self.ttl < now:
+            self.stats["misses"] += 1
+            return None
+        self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?",
+                          (now, key))
+        self.stats["hits"] += 1
+        return json.loads(row[0])
+
+    def set(self, key, response):
+        """
+        Store a response in the cache, and evict the least recently used ones
+        if the cache is full
+
+        :param key: key of the request, see key()
+        :param response: response to store, serializable in json
+        """
+        data = json.dumps(response, separators=(",", ":")).encode()
+        now = time.time()
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            old = conn.execute("SELECT size FROM responses WHERE key = ?",
+                               (key, )).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(key, response, size, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data), now, now)
+            )
+            conn.execute("UPDATE cache_size SET size = size + ?",
+                         (len(data) - (old[0] if old else 0), ))
+            size = conn.execute("SELECT size FROM cache_size").fetchone()[0]
+            if size > self.max_size:
+                self._evict(size - self.max_size)
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _evict(self, nbytes):
+        """
+        Remove the least recently used responses, to free at least nbytes
+
+        Has to be called in a transaction.
+        """
+        freed = 0
+        evicted = []
+        rows = self.conn.execute(
+            "SELECT key, size FROM responses ORDER BY accessed"
+        )
+        while freed < nbytes:
+            row = rows.fetchone()
+            if row is None:
+                break
+            evicted.append((row[0], ))
+            freed += row[1]
+        rows.close()
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self.conn.execute("UPDATE cache_size SET size = size - ?", (freed, ))
+        self.stats["evictions"] += len(evicted)
+
+    def clear(self):
+        """
+        Remove all responses of the cache
+        """
+        self.conn.execute("DELETE FROM responses")
+        self.conn.execute("UPDATE cache_size SET size = 0")
@@ -0,0 +1,203 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+import signal
+import sys
+import time
+from .metrics import metrics
+from .mpd_pool import CONNECTION_ERRORS, Mpd_pool
+from .muspy_api import Muspy_api
+from .musicbrainz import Rate_limiter
+from .presync import (
+    MUSICBRAINZ_BURST, MUSICBRAINZ_RATE_LIMIT, build_muspy_index,
+    fetch_missing_mbid, init_process, muspy_fingerprint, open_cache,
+    update_artists_from_muspy, update_muspy_fingerprint
+)
+from .sync import (
+    export_metrics, import_muspy_async, open_artist_db,
+    print_connection_stats, run as run_sync, start_pool_add, start_pool_del
+)
+from .tools import get_config, mpd_get_db_update, mpd_iter_artists
+
+config = get_config()
+try:
+    from config import DAEMON_DEBOUNCE
+except:
+    DAEMON_DEBOUNCE = 2
+
+#: maximum delay (in seconds) between two attempts to reconnect to MPD
+MAX_RECONNECT_DELAY = 60
+
+
+def wait_db_update(mpd_pool, last_db_update):
+    """
+    Block until the mpd database is updated
+
+    Updates often come in bursts (a library scan, files copied one by one), so
+    the database has to stay unchanged during DAEMON_DEBOUNCE seconds before
+    being synchronized.
+
+    :param mpd_pool: connections with MPD. One is kept during the wait.
+    :type mpd_pool: Mpd_pool
+    :param last_db_update: time of the last synchronized update of the
+        database
+    :returns db_update: time of the new update of the database
+    """
+    while True:
+        with mpd_pool.connection() as mpdclient:
+            mpdclient.idle("database")
+            db_update = mpd_get_db_update(mpdclient)
+            while True:
+                time.sleep(DAEMON_DEBOUNCE)
+                updating = "updating_db" in mpdclient.status()
+                new_db_update = mpd_get_db_update(mpdclient)
+                if not updating and new_db_update == db_update:
+                    break
+                db_update = new_db_update
+        if db_update != last_db_update:
+            return db_update
+
+
+def send_changes(non_uploaded_artists, remove_of_muspy, artist_db):
+    """
+    Upload and remove artists of muspy in this process
+
+    With MUSPY_ASYNC, the requests are sent concurrently by an event loop,
+    otherwise one by one.
+
+    :param non_uploaded_artists: artists to upload, with their musicbrainz id
+    :type non_uploaded_artists: list
+    :param remove_of_muspy: artists name and musicbrainz id to remove
+    :type remove_of_muspy: list
+    :param artist_db: database of artists, updated with the uploads
+    :returns error: number of artists which failed to be synchronized
+    """
+    muspy_async = import_muspy_async()
+    if muspy_async is None:
+        error = 0
+        if non_uploaded_artists:
+            error += start_pool_add(non_uploaded_artists, artist_db,
+                                    workers=0)
+        if remove_of_muspy:
+            error += start_pool_del(remove_of_muspy, workers=0)
+        return error
+
+    error = 0
+    if non_uploaded_artists:
+        with metrics.phase("add_artists"):
+            added_error, stats = muspy_async.add_artists(
+                non_uploaded_artists, artist_db
+            )
+        print_connection_stats(stats)
+        error += added_error
+    if remove_of_muspy:
+        with metrics.phase("del_artists"):
+            removed_error, stats = muspy_async.del_artists(remove_of_muspy)
+        print_connection_stats(stats)
+        error += removed_error
+    return error
+
+
+def sync_changes(artist_db, mpdclient):
+    """
+    Synchronize the artists added or removed of mpd since the last
+    synchronization
+
+    Everything is done in the current process, so the musicbrainz cache and the
+    muspy connections stay open between two synchronizations.
+
+    :param artist_db: database of artists, opened in this process
+    :param mpdclient: connections with MPD
+    :type mpdclient: Mpd_pool
+    :returns sync_state: state to save in the database once synchronized
+    """
+    sync_state = {"mpd_db_update": mpd_get_db_update(mpdclient)}
+    artists_added, artists_removed = artist_db.merge(mpd_iter_artists(
+        mpdclient, lambda artist: artist_db.get_mbid(artist) is None
+    ))
+    print(artists_added, "artist(s) added,", artists_removed,
+          "artist(s) removed")
+
+    muspy_artists = Muspy_api().get_artists()
+    sync_state["muspy_fingerprint"] = muspy_fingerprint(muspy_artists)
+    # Also searches the artists missed by a previous synchronization, and
+    # the ones due to be searched again
+    error = fetch_missing_mbid(
+        artist_db, build_muspy_index(muspy_artists), mpdclient,
+        in_process=True
+    )
+    remove_of_muspy = update_artists_from_muspy(artist_db, muspy_artists)
+
+    # Also retries the artists which failed to be uploaded before
+    non_uploaded_artists = [
+        a for a in artist_db.iter_artists(fields=("mbid",), uploaded=False)
+        if "mbid" in a
+    ]
+    error += send_changes(non_uploaded_artists, remove_of_muspy, artist_db)
+    if error:
+        print("Done with", error, "error(s)")
+    else:
+        print("Done")
+    update_muspy_fingerprint(sync_state, error,
+                             non_uploaded_artists or remove_of_muspy)
+    return sync_state
+
+
+def run(clean=False, force=False, retry_lookups=False):
+    """
+    Synchronize everything, then keep synchronizing the changes of the mpd
+    database until being interrupted
+
+    :param clean: drop the database before the first synchronization
+    :type clean: boolean
+    :param force: synchronize everything at the start, even if mpd and the
+        muspy account did not change since the last synchronization
+    :type force: boolean
+    :param retry_lookups: search on musicbrainz all the artists without id at
+        the start, even the ones which recently failed to be found
+    :type retry_lookups: boolean
+    """
+    # Stop cleanly, to save the database
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    run_sync(clean=clean, force=force, retry_lookups=retry_lookups)
+
+    init_process(Rate_limiter(MUSICBRAINZ_RATE_LIMIT, MUSICBRAINZ_BURST),
+                 open_cache())
+    artist_db = open_artist_db()
+    mpdclient = Mpd_pool()
+    reconnect_delay = 1
+    print("\nWaiting for changes of the mpd database...")
+    try:
+        while True:
+            try:
+                wait_db_update(mpdclient,
+                               artist_db.get_meta("mpd_db_update"))
+                print("\nMPD database updated, synchronizing...")
+                metrics.reset()
+                try:
+                    sync_state = sync_changes(artist_db, mpdclient)
+                except Exception:
+                    export_metrics(success=False)
+                    raise
+                export_metrics()
+            except CONNECTION_ERRORS as e:
+                # The broken connections are replaced by the pool
+                print("Connection to MPD lost:", e)
+                time.sleep(reconnect_delay)
+                reconnect_delay = min(reconnect_delay * 2,
+                                      MAX_RECONNECT_DELAY)
+                continue
+            except Exception as e:
+                # The added artists are already in the database, their ids
+                # are searched with the next update
+                print("Error:", e)
+                continue
+            reconnect_delay = 1
+            for key, value in sync_state.items():
+                artist_db.set_meta(key, value)
+            artist_db.save()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        artist_db.close()
+        mpdclient.close()
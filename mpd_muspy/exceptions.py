@@ -4,3 +4,10 @@
 
 class ArtistNotFoundException(Exception):
     pass
+
+
+class ThrottledException(Exception):
+    def __init__(self, *args, retry_after=None):
+        super().__init__(*args)
+        #: delay (in seconds) before the next request
+        self.retry_after = retry_after
@@ -0,0 +1,473 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+import appdirs
+import bz2
+import gzip
+import hashlib
+import json
+import lzma
+import mmap
+import os
+import struct
+import tarfile
+import uuid
+from . import _release_name
+from .tools import get_config, normalize_name, normalize_title
+
+config = get_config()
+try:
+    from config import MUSICBRAINZ_INDEX
+except:
+    MUSICBRAINZ_INDEX = os.path.join(
+        appdirs.user_data_dir(_release_name), "musicbrainz.index"
+    )
+
+#: first bytes of an index file, with the version of its format
+MAGIC = b"MMSPIDX1"
+
+#: header: magic, size of the json metadata
+HEADER = struct.Struct("<8sI")
+#: names section: hash of the normalized name, first posting, postings count
+NAME = struct.Struct("<QII")
+#: postings section: index of an artist
+POSTING = struct.Struct("<I")
+#: artists section: musicbrainz id, first title, titles count
+ARTIST = struct.Struct("<16sII")
+#: titles section: hash of the normalized title of a release group
+TITLE = struct.Struct("<Q")
+
+#: names of the dump files, in the MusicBrainz archives
+DUMP_MEMBERS = ("artist", "release-group")
+
+
+def text_hash(text):
+    """
+    Hash of a normalized text, as stored in the index
+
+    :param text: normalized name or title
+    :returns hash: 64 bits integer
+    """
+    return int.from_bytes(
+        hashlib.blake2b(text.encode(), digest_size=8).digest(), "little"
+    )
+
+
+def _open_compressed(path):
+    """
+    Open a file in binary mode, decompressed according to its extension
+    """
+    if path.endswith(".xz"):
+        return lzma.open(path, "rb")
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rb")
+    return open(path, "rb")
+
+
+def _read_dump_lines(path):
+    """
+    Yield the lines of a dump file, or of the dump files of an archive
+
+    MusicBrainz archives (like artist.tar.xz) are tar files which contain the
+    dump as mbdump/artist or mbdump/release-group.
+    """
+    if tarfile.is_tarfile(path):
+        with tarfile.open(path, "r:*") as archive:
+            for member in archive:
+                if os.path.basename(member.name) in DUMP_MEMBERS:
+                    yield from archive.extractfile(member)
+        return
+    with _open_compressed(path) as f:
+        yield from f
+
+
+def read_dump(path):
+    """
+    Parse the records of a MusicBrainz dump
+
+    Two formats are supported:
+      - the JSON dumps of artists and of release groups, with one object by
+        line
+      - the artist table of the database dumps, in TSV (id, mbid, name, sort
+        name, ...)
+
+    Malformed lines, like a truncated last line, are not parsed.
+
+    :param path: path of the dump, compressed or not, or of a tar archive
+    :returns records: iterator of ("artist", mbid, names), of
+        ("release-group", artist mbids, title), and of ("invalid", line,
+        None) for the lines which could not be parsed
+    """
+    for line in _read_dump_lines(path):
+        try:
+            record = _parse_dump_line(line)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            record = ("invalid", line, None)
+        if record is not None:
+            yield record
+
+
+def _parse_dump_line(line):
+    """
+    Parse a line of a dump, see read_dump()
+
+    :returns record: the record of the line, or None if it has no record
+    :raises ValueError: if the line is malformed
+    """
+    line = line.decode("utf-8").rstrip("\n")
+    if not line:
+        return None
+    if not line.startswith("{"):
+        columns = line.split("\t")
+        if len(columns) < 4:
+            raise ValueError("Missing columns")
+        return "artist", str(uuid.UUID(columns[1])), [columns[2], columns[3]]
+    record = json.loads(line)
+    if "artist-credit" in record:
+        artists = [str(uuid.UUID(credit["artist"]["id"]))
+                   for credit in record["artist-credit"]
+                   if isinstance(credit, dict) and "artist" in credit]
+        return "release-group", artists, record.get("title", "")
+    elif "id" in record and "name" in record:
+        names = [record["name"], record.get("sort-name", "")]
+        sort_name = record.get("sort-name", "")
+        if ", " in sort_name:
+            names.append(" ".join(reversed(sort_name.split(", ", 1))))
+        names += [alias["name"] for alias in record.get("aliases") or ()
+                  if alias.get("name")]
+        return "artist", str(uuid.UUID(record["id"])), names
+    return None
+
+
+class Index_builder():
+    """
+    Build an Artist_index in memory, then write it on the disk
+
+    Each artist is identified by its musicbrainz id (as 16 bytes), and stored
+    with the hashes of its normalized names and release group titles.
+    """
+    def __init__(self):
+        #: name hash: list of artist ids, in order of insertion
+        self.names = dict()
+        #: artist id: list of name hashes
+        self.artist_names = dict()
+        #: artist id: set of title hashes
+        self.titles = dict()
+        self.sources = dict()
+        #: number of invalid records skipped in the dumps
+        self.invalid = 0
+
+    def load(self, index):
+        """
+        Load the content of an existing index, to refresh it
+
+        :param index: opened index
+        :type index: Artist_index
+        """
+        artists = [index.get_artist(i) for i in range(index.nb_artists)]
+        for mbid, titles in artists:
+            self.titles[mbid] = set(titles)
+        for name_hash, postings in index.iter_names():
+            for i in postings:
+                self._add_name(artists[i][0], name_hash)
+        self.sources = dict(index.meta.get("sources", {}))
+
+    def _add_name(self, mbid, name_hash):
+        ids = self.names.setdefault(name_hash, [])
+        if mbid not in ids:
+            ids.append(mbid)
+            self.artist_names.setdefault(mbid, []).append(name_hash)
+
+    def add_artist(self, mbid, names):
+        """
+        Add an artist, or replace its names
+
+        :param mbid: musicbrainz id of the artist
+        :param names: name, sort name and aliases of the artist
+        """
+        mbid = uuid.UUID(mbid).bytes
+        for name_hash in self.artist_names.pop(mbid, ()):
+            self.names[name_hash].remove(mbid)
+            if not self.names[name_hash]:
+                del self.names[name_hash]
+        self.titles.setdefault(mbid, set())
+        for name in names:
+            name = normalize_name(name)
+            if name:
+                self._add_name(mbid, text_hash(name))
+
+    def add_release_group(self, artists, title):
+        """
+        Add the title of a release group to its artists
+
+        :param artists: musicbrainz ids of the credited artists
+        :param title: title of the release group
+        """
+        title = normalize_title(title)
+        if not title:
+            return
+        title_hash = text_hash(title)
+        for mbid in artists:
+            self.titles.setdefault(uuid.UUID(mbid).bytes, set()).add(
+                title_hash
+            )
+
+    def add_dump(self, path, refresh=False):
+        """
+        Add the records of a dump file
+
+        :param path: path of the dump, see read_dump()
+        :param refresh: skip the dump if it did not change since it was added
+            in the index
+        :returns added: False if the dump was skipped
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        source = [stat.st_size, stat.st_mtime]
+        if refresh and self.sources.get(path) == source:
+            return False
+        for record in read_dump(path):
+            if record[0] == "artist":
+                self.add_artist(record[1], record[2])
+            elif record[0] == "release-group":
+                self.add_release_group(record[1], record[2])
+            else:
+                self.invalid += 1
+        self.sources[path] = source
+        return True
+
+    def write(self, path):
+        """
+        Write the index, replacing atomically the previous one
+
+        Processes which already opened the previous index keep reading it.
+
+        :param path: path of the index
+        """
+        artists = sorted(self.titles)
+        artist_ids = {mbid: i for i, mbid in enumerate(artists)}
+        name_hashes = sorted(self.names)
+        nb_postings = sum(len(ids) for ids in self.names.values())
+        nb_titles = sum(len(titles) for titles in self.titles.values())
+        meta = {"sources": self.sources, "names": len(name_hashes),
+                "artists": len(artists), "postings": nb_postings,
+                "titles": nb_titles}
+        meta = json.dumps(meta).encode()
+
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(meta)))
+            f.write(meta)
+            posting = 0
+            for name_hash in name_hashes:
+                ids = self.names[name_hash]
+                f.write(NAME.pack(name_hash, posting, len(ids)))
+                posting += len(ids)
+            for name_hash in name_hashes:
+                for mbid in self.names[name_hash]:
+                    f.write(POSTING.pack(artist_ids[mbid]))
+            title = 0
+            for mbid in artists:
+                titles = self.titles[mbid]
+                f.write(ARTIST.pack(mbid, title, len(titles)))
+                title += len(titles)
+            for mbid in artists:
+                for title_hash in sorted(self.titles[mbid]):
+                    f.write(TITLE.pack(title_hash))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+
+class Artist_index():
+    """
+    Offline index of the MusicBrainz artists, built from a dump
+
+    The index file is memory-mapped: opening it is instantaneous, lookups are
+    binary searches which only read the needed pages, and the pages are
+    shared by all processes.
+    """
+    def __init__(self, path):
+        """
+        :param path: path of the index, written by build_index()
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, meta_size = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a musicbrainz index: " + path)
+        offset = HEADER.size
+        self.meta = json.loads(
+            self._mmap[offset:offset + meta_size].decode()
+        )
+        offset += meta_size
+        self.nb_names = self.meta["names"]
+        self.nb_artists = self.meta["artists"]
+        self._names = offset
+        self._postings = self._names + self.nb_names * NAME.size
+        self._artists = self._postings + self.meta["postings"] * POSTING.size
+        self._titles = self._artists + self.nb_artists * ARTIST.size
+
+    def close(self):
+        self._mmap.close()
+
+    def _find_name(self, name_hash):
+        """
+        Binary search of a name hash
+
+        :returns (first posting, count)
+        """
+        low, high = 0, self.nb_names
+        while low < high:
+            middle = (low + high) // 2
+            value, first, count = NAME.unpack_from(
+                self._mmap, self._names + middle * NAME.size
+            )
+            if value < name_hash:
+                low = middle + 1
+            elif value > name_hash:
+                high = middle
+            else:
+                return first, count
+        return 0, 0
+
+    def iter_names(self):
+        """
+        Yield every name hash, with the index of its artists
+        """
+        for i in range(self.nb_names):
+            name_hash, first, count = NAME.unpack_from(
+                self._mmap, self._names + i * NAME.size
+            )
+            yield name_hash, self._read_postings(first, count)
+
+    def _read_postings(self, first, count):
+        return [
+            POSTING.unpack_from(
+                self._mmap, self._postings + (first + i) * POSTING.size
+            )[0]
+            for i in range(count)
+        ]
+
+    def get_artist(self, i):
+        """
+        Get an artist of the index
+
+        :param i: index of the artist
+        :returns (mbid, titles): musicbrainz id (16 bytes) and hashes of the
+            release group titles
+        """
+        mbid, first, count = ARTIST.unpack_from(
+            self._mmap, self._artists + i * ARTIST.size
+        )
+        titles = [
+            TITLE.unpack_from(
+                self._mmap, self._titles + (first + j) * TITLE.size
+            )[0]
+            for j in range(count)
+        ]
+        return mbid, titles
+
+    def lookup(self, name):
+        """
+        Get the artists having a name, as name, sort name or alias
+
+        :param name: artist name
+        :returns candidates: list of (mbid, titles), with the musicbrainz id
+            as a string and the hashes of the release group titles
+        """
+        name = normalize_name(name)
+        if not name:
+            return []
+        first, count = self._find_name(text_hash(name))
+        return [(str(uuid.UUID(bytes=mbid)), titles)
+                for mbid, titles in map(self.get_artist,
+                                        self._read_postings(first, count))]
+
+    @staticmethod
+    def choose_candidate(candidates, albums):
+        """
+        Choose the musicbrainz id of an artist between the candidates of
+        lookup(), without any network request
+
+        When several artists have the name, the one who released the most
+        albums is chosen. It is not resolved if none released the albums, or
+        if several ones released as many.
+
+        :param candidates: result of lookup()
+        :param albums: titles of the albums of the artist
+        :returns mbid: musicbrainz id, or None if the index cannot resolve it
+        """
+        if len(candidates) == 1:
+            return candidates[0][0]
+        local_titles = {text_hash(t) for t in map(normalize_title, albums)
+                        if t}
+        scores = sorted(
+            ((len(local_titles.intersection(titles)), mbid)
+             for mbid, titles in candidates), reverse=True
+        )
+        if not scores or scores[0][0] == 0:
+            return None
+        if len(scores) > 1 and scores[1][0] == scores[0][0]:
+            return None
+        return scores[0][1]
+
+
+def build_index(dumps, path=MUSICBRAINZ_INDEX, refresh=False):
+    """
+    Build the offline index from MusicBrainz dumps
+
+    :param dumps: paths of the dumps of artists and release groups, see
+        read_dump()
+    :type dumps: list
+    :param path: path of the index
+    :param refresh: update the existing index, instead of building a new
+        one. Only the dumps which changed since the last build are read: their
+        artists replace the names of the indexed ones, and their release
+        groups are added.
+    :type refresh: boolean
+    """
+    builder = Index_builder()
+    if refresh and os.path.exists(path):
+        index = Artist_index(path)
+        builder.load(index)
+        index.close()
+    changed = not refresh
+    for dump in dumps:
+        print("Reading", dump, "...")
+        invalid = builder.invalid
+        if builder.add_dump(dump, refresh):
+            changed = True
+            if builder.invalid > invalid:
+                print(builder.invalid - invalid, "invalid line(s) skipped")
+        else:
+            print("Unchanged since the last build, skipped")
+    if not changed:
+        print("The index is up to date")
+        return
+    print("Writing the index...")
+    builder.write(path)
+    print(len(builder.titles), "artist(s),", len(builder.names),
+          "name(s) indexed in", path)
+
+
+def open_index(path=MUSICBRAINZ_INDEX):
+    """
+    Open the offline index, if it was built
+
+    :returns index: Artist_index, or None if there is no index
+    """
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        return Artist_index(path)
+    except Exception as e:
+        print("Error when opening the musicbrainz index", path)
+        print(e)
+        return None
@@ -0,0 +1,333 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+#: upper bounds (in seconds) of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+#: prefix of the names of the exported metrics
+PREFIX = "mpd_muspy"
+
+#: description of the counters, by name
+COUNTERS_HELP = {
+    "errors": "Requests which failed",
+    "retries": "Requests sent again after an error",
+    "throttled": "Requests throttled by the server",
+    "rate_limit_wait_seconds": "Time spent waiting for the rate limiter",
+}
+
+
+class Metrics():
+    """
+    Measures of a synchronization: duration of its phases, latency of the
+    requests to each service, retries and throttled requests, and maximum
+    depth of the queues
+
+    Each process has its own metrics. The workers send theirs to the parent
+    process with their results, see take() and merge().
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.start = time.time()
+            #: duration of the phases, in seconds
+            self.phases = Counter()
+            #: requests by (service, endpoint): buckets, sum, count and max
+            self.requests = dict()
+            #: counters by (name, service)
+            self.counters = Counter()
+            #: maximum depth of each queue
+            self.queues = dict()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Measure the duration of a phase of the synchronization
+
+        :param name: name of the phase
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                self.phases[name] += elapsed
+
+    def timed_phase(self, name):
+        """
+        Decorator measuring each call of a function as a phase
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def observe(self, service, endpoint, seconds):
+        """
+        Record the latency of a request
+
+        :param service: "mpd", "musicbrainz" or "muspy"
+        :param endpoint: command or API function called
+        :param seconds: duration of the request
+        """
+        with self._lock:
+            request = self.requests.get((service, endpoint))
+            if request is None:
+                request = [[0] * len(LATENCY_BUCKETS), 0.0, 0, 0.0]
+                self.requests[(service, endpoint)] = request
+            buckets = request[0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    buckets[i] += 1
+                    break
+            request[1] += seconds
+            request[2] += 1
+            request[3] = max(request[3], seconds)
+
+    @contextmanager
+    def request(self, service, endpoint):
+        """
+        Measure the latency of a request, and count it as an error if it
+        raises an exception
+
+        :param service: "mpd", "musicbrainz" or "muspy"
+        :param endpoint: command or API function called
+        """
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException:
+            self.count("errors", service)
+            raise
+        finally:
+            self.observe(service, endpoint, time.monotonic() - start)
+
+    def count(self, name, service, value=1):
+        """
+        Increment a counter, see COUNTERS_HELP
+
+        :param name: name of the counter
+        :param service: "mpd", "musicbrainz" or "muspy"
+        """
+        with self._lock:
+            self.counters[(name, service)] += value
+
+    def queue_depth(self, queue, depth):
+        """
+        Record the depth of a queue, to keep its maximum
+
+        :param queue: name of the queue
+        :param depth: number of items waiting in the queue
+        """
+        with self._lock:
+            self.queues[queue] = max(self.queues.get(queue, 0), depth)
+
+    def take(self):
+        """
+        Get the metrics recorded since the last call and reset them, to send
+        them to another process
+
+        :returns metrics: picklable metrics, to give to merge()
+        """
+        with self._lock:
+            snapshot = (self.phases, self.requests, self.counters,
+                        self.queues)
+            self.phases = Counter()
+            self.requests = dict()
+            self.counters = Counter()
+            self.queues = dict()
+        return snapshot
+
+    def merge(self, snapshot):
+        """
+        Add metrics recorded by another process
+
+        :param snapshot: metrics returned by take()
+        """
+        phases, requests, counters, queues = snapshot
+        with self._lock:
+            self.phases.update(phases)
+            self.counters.update(counters)
+            for key, (buckets, total, count, maximum) in requests.items():
+                request = self.requests.get(key)
+                if request is None:
+                    self.requests[key] = [list(buckets), total, count,
+                                          maximum]
+                    continue
+                request[0] = [a + b for a, b in zip(request[0], buckets)]
+                request[1] += total
+                request[2] += count
+                request[3] = max(request[3], maximum)
+            for queue, depth in queues.items():
+                self.queues[queue] = max(self.queues.get(queue, 0), depth)
+
+    def summary(self, success=True):
+        """
+        Summary of the metrics, to save as JSON
+
+        :param success: if the synchronization succeeded
+        :returns summary: dict
+        """
+        with self._lock:
+            requests = dict()
+            for (service, endpoint), request in self.requests.items():
+                buckets, total, count, maximum = request
+                requests.setdefault(service, dict())[endpoint] = {
+                    "count": count,
+                    "total_seconds": total,
+                    "mean_seconds": total / count if count else 0,
+                    "max_seconds": maximum,
+                    "buckets": dict(zip(map(str, LATENCY_BUCKETS),
+                                        buckets)),
+                }
+            counters = dict()
+            for (name, service), value in self.counters.items():
+                counters.setdefault(service, dict())[name] = value
+            return {
+                "timestamp": time.time(),
+                "success": success,
+                "duration_seconds": time.time() - self.start,
+                "phases": dict(self.phases),
+                "requests": requests,
+                "counters": counters,
+                "queues": dict(self.queues),
+            }
+
+    def prometheus(self, success=True):
+        """
+        Metrics in the text format of Prometheus, for the textfile collector
+        of the node exporter
+
+        :param success: if the synchronization succeeded
+        :returns text: str
+        """
+        summary = self.summary(success)
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append("# HELP {}_{} {}".format(PREFIX, name, help_text))
+            lines.append("# TYPE {}_{} {}".format(PREFIX, name, metric_type))
+            for suffix, labels, value in samples:
+                labels = ",".join('{}="{}"'.format(k, _escape(v))
+                                  for k, v in labels)
+                lines.append("{}_{}{}{} {}".format(
+                    PREFIX, name, suffix, "{" + labels + "}" if labels else "",
+                    value if isinstance(value, int) else repr(float(value))
+                ))
+
+        metric("last_run_timestamp_seconds", "gauge",
+               "Time of the end of the last synchronization",
+               [("", (), summary["timestamp"])])
+        metric("last_run_success", "gauge",
+               "1 if the last synchronization succeeded",
+               [("", (), int(success))])
+        metric("last_run_duration_seconds", "gauge",
+               "Duration of the last synchronization",
+               [("", (), summary["duration_seconds"])])
+        metric("phase_duration_seconds", "gauge",
+               "Duration of each phase of the last synchronization",
+               [("", (("phase", name), ), seconds)
+                for name, seconds in sorted(summary["phases"].items())])
+
+        # The metrics are measured again by each synchronization: they are
+        # exported as gauges, as counters and histograms have to only grow
+        with self._lock:
+            requests = sorted(self.requests.items())
+        by_latency = []
+        for (service, endpoint), (buckets, _, count, _) in requests:
+            labels = (("service", service), ("endpoint", endpoint))
+            cumulative = 0
+            for bound, nb in zip(LATENCY_BUCKETS, buckets):
+                cumulative += nb
+                by_latency.append(("", labels + (("le", str(bound)), ),
+                                   cumulative))
+            by_latency.append(("", labels + (("le", "+Inf"), ), count))
+        metric("last_run_requests", "gauge",
+               "Requests to each service during the last synchronization",
+               [("", (("service", service), ("endpoint", endpoint)), count)
+                for (service, endpoint), (_, _, count, _) in requests])
+        metric("last_run_requests_by_latency", "gauge",
+               "Requests of the last synchronization which took at most le "
+               "seconds", by_latency)
+        metric("last_run_request_duration_seconds", "gauge",
+               "Total latency of the requests of the last synchronization",
+               [("", (("service", service), ("endpoint", endpoint)), total)
+                for (service, endpoint), (_, total, _, _) in requests])
+        metric("last_run_request_duration_max_seconds", "gauge",
+               "Maximum latency of the requests of the last synchronization",
+               [("", (("service", service), ("endpoint", endpoint)), maximum)
+                for (service, endpoint), (_, _, _, maximum) in requests])
+
+        for name, help_text in COUNTERS_HELP.items():
+            metric("last_run_" + name, "gauge",
+                   help_text + " during the last synchronization", [
+                       ("", (("service", service), ), counters[name])
+                       for service, counters in sorted(
+                           summary["counters"].items()
+                       )
+                       if name in counters
+                   ])
+        metric("queue_depth_max", "gauge",
+               "Maximum number of items waiting in each queue",
+               [("", (("queue", name), ), depth)
+                for name, depth in sorted(summary["queues"].items())])
+        return "\n".join(lines) + "\n"
+
+    def export(self, json_path=None, prometheus_path=None, success=True):
+        """
+        Write the metrics in a JSON summary and in a Prometheus textfile
+
+        The files are replaced atomically, so they are never read half
+        written.
+
+        :param json_path: path of the JSON summary, None to skip it
+        :param prometheus_path: path of the Prometheus textfile (should end
+            with .prom), None to skip it
+        :param success: if the synchronization succeeded
+        """
+        if json_path:
+            _write_atomic(json_path,
+                          json.dumps(self.summary(success), indent=4))
+        if prometheus_path:
+            _write_atomic(prometheus_path, self.prometheus(success))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n"
+    )
+
+
+def _write_atomic(path, content):
+    path = os.path.expanduser(path)
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".metrics-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+#: metrics of this process
+metrics = Metrics()
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+import mpd
+import os
+import threading
+import time
+from contextlib import contextmanager
+from .metrics import metrics
+from .tools import get_config
+
+config = get_config()
+from config import SERVER, PORT
+try:
+    from config import MPD_POOL_SIZE
+except:
+    MPD_POOL_SIZE = 2
+try:
+    from config import MPD_TIMEOUT
+except:
+    MPD_TIMEOUT = 30
+try:
+    from config import MPD_CHECK_INTERVAL
+except:
+    # MPD closes the connections idle for more than 60s by default
+    MPD_CHECK_INTERVAL = 30
+
+#: errors after which a connection is not reusable
+CONNECTION_ERRORS = (mpd.ConnectionError, ConnectionError, TimeoutError)
+
+
+class Mpd_pool():
+    """
+    Pool of connections to MPD, opened by each process
+
+    Connections are opened on demand, up to `size` by process, and reused. A
+    connection unused for more than MPD_CHECK_INTERVAL seconds is checked with
+    a ping before being reused, and a broken connection is replaced by a new
+    one.
+
+    The pool can be sent to other processes: each one opens its own
+    connections. It can be used like a MPDClient, each command takes a
+    connection of the pool for its duration:
+
+        mpd_pool = Mpd_pool()
+        mpd_pool.stats()
+    """
+    def __init__(self, size=MPD_POOL_SIZE, timeout=MPD_TIMEOUT, host=SERVER,
+                 port=PORT):
+        """
+        :param size: maximum number of connections by process
+        :type size: int
+        :param timeout: timeout of the connection and of the commands, in
+            seconds. Idle commands do not timeout.
+        :param host: address of the MPD server
+        :param port: port of the MPD server
+        """
+        self.size = max(size, 1)
+        self.timeout = timeout
+        self.host = host
+        self.port = port
+        self._init_local()
+
+    def _init_local(self):
+        """
+        Initialize the connections of this process
+        """
+        self._pid = os.getpid()
+        #: unused connections, with the time they were released
+        self._idle = []
+        self._opened = 0
+        self._cond = threading.Condition()
+
+    def __getstate__(self):
+        return {"size": self.size, "timeout": self.timeout,
+                "host": self.host, "port": self.port}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_local()
+
+    def __getattr__(self, command):
+        """
+        Send a MPD command on a connection of the pool
+
+        The command is sent again on a new connection if the connection
+        breaks.
+        """
+        if command.startswith("_"):
+            raise AttributeError(command)
+
+        def send(*args):
+            for retry in (True, False):
+                try:
+                    with self.connection() as client, \
+                            metrics.request("mpd", command):
+                        return getattr(client, command)(*args)
+                except CONNECTION_ERRORS:
+                    if not retry:
+                        raise
+                    metrics.count("retries", "mpd")
+        return send
+
+    def stream(self, command, *args):
+        """
+        Send a MPD command on a connection of the pool, and yield the items
+        of its response while they are received
+
+        The connection is held until the whole response is read, and closed if
+        the iteration is stopped before. The command is sent again on a new
+        connection if the connection breaks before the first item.
+        """
+        for retry in (True, False):
+            started = False
+            try:
+                with self.connection() as client, \
+                        metrics.request("mpd", command):
+                    client.iterate = True
+                    try:
+                        for item in getattr(client, command)(*args):
+                            started = True
+                            yield item
+                    finally:
+                        client.iterate = False
+                return
+            except CONNECTION_ERRORS:
+                if started or not retry:
+                    raise
+                metrics.count("retries", "mpd")
+
+    def _open(self):
+        client = mpd.MPDClient()
+        client.timeout = self.timeout
+        client.idletimeout = None
+        client.connect(self.host, self.port)
+        return client
+
+    @staticmethod
+    def _close(client):
+        try:
+            client.disconnect()
+        except Exception:
+            pass
+
+    def _acquire(self):
+        """
+        Take a connection, checked if it was unused for a while, or open a new
+        one. Waits for a connection to be released if `size` are opened.
+        """
+        if self._pid != os.getpid():
+            # Connections inherited from the parent process are its own
+            self._init_local()
+        with self._cond:
+            while not self._idle and self._opened >= self.size:
+                self._cond.wait()
+            if self._idle:
+                client, released = self._idle.pop()
+            else:
+                client, released = None, None
+                self._opened += 1
+        try:
+            if client is None:
+                return self._open()
+            if time.monotonic() - released > MPD_CHECK_INTERVAL:
+                try:
+                    client.ping()
+                except CONNECTION_ERRORS:
+                    self._close(client)
+                    client = self._open()
+            return client
+        except BaseException:
+            self._discard(None)
+            raise
+
+    def _release(self, client):
+        with self._cond:
+            self._idle.append((client, time.monotonic()))
+            self._cond.notify()
+
+    def _discard(self, client):
+        if client is not None:
+            self._close(client)
+        with self._cond:
+            self._opened -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Take a connection of the pool, to send several commands on it
+
+        The connection is closed instead of being given back to the pool if a
+        command was interrupted by an error other than a MPD error.
+        """
+        client = self._acquire()
+        try:
+            yield client
+        except mpd.CommandError:
+            self._release(client)
+            raise
+        except BaseException:
+            self._discard(client)
+            raise
+        self._release(client)
+
+    def close(self):
+        """
+        Close the unused connections of this process
+        """
+        if self._pid != os.getpid():
+            return
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+            self._cond.notify_all()
+        for client, released in idle:
+            self._close(client)
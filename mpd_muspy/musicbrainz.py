@@ -0,0 +1,301 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+import functools
+import inspect
+import time
+from collections import Counter
+import musicbrainzngs
+import musicbrainzngs.musicbrainz
+from . import _release_name, _version
+from .cache import Response_cache
+from .exceptions import ThrottledException
+from .metrics import metrics
+from .tools import get_config
+from .workers import get_mp_context
+
+config = get_config()
+try:
+    from config import MUSICBRAINZ_SERVER
+except:
+    MUSICBRAINZ_SERVER = "musicbrainz.org"
+try:
+    from config import MUSICBRAINZ_HTTPS
+except:
+    MUSICBRAINZ_HTTPS = True
+
+musicbrainzngs.set_useragent(_release_name, _version)
+musicbrainzngs.set_hostname(MUSICBRAINZ_SERVER, use_https=MUSICBRAINZ_HTTPS)
+
+
+def _disable_library_retries():
+    """
+    Send each request of musicbrainzngs only once
+
+    musicbrainzngs retries by itself the throttled requests, without waiting
+    for the Retry-After delay nor for the other processes. The throttled
+    requests are left to the rate limiter instead, and the other transient
+    errors are retried by _call(). musicbrainzngs has no option for it, so its
+    internal reading function is wrapped, only if it still accepts a number of
+    retries: otherwise, musicbrainzngs keeps retrying by itself.
+
+    :returns disabled: True if the retries of musicbrainzngs are disabled
+    """
+    safe_read = getattr(musicbrainzngs.musicbrainz, "_safe_read", None)
+    try:
+        if "max_retries" not in inspect.signature(safe_read).parameters:
+            return False
+    except (TypeError, ValueError):
+        return False
+    musicbrainzngs.musicbrainz._safe_read = functools.partial(
+        safe_read, max_retries=1
+    )
+    return True
+
+
+_disable_library_retries()
+
+#: HTTP status codes returned by musicbrainz when it throttles the client
+THROTTLE_STATUS = (429, 503)
+
+#: maximum delay (in seconds) to wait after a throttled request, if
+#: musicbrainz does not send a Retry-After header
+MAX_BACKOFF = 64
+
+#: number of times a request is sent again after a network or server error
+ERROR_RETRIES = 3
+
+#: delay (in seconds) before retrying a request after an error, multiplied by
+#: the number of the retry
+ERROR_RETRY_DELAY = 2
+
+#: rate limiter used by the calls of this process
+_rate_limiter = None
+
+#: cache of the responses used by this process
+_cache = None
+
+
+class Rate_limiter():
+    """
+    Token bucket shared between processes
+
+    Tokens are added at `rate` by second, up to `burst`. Each request to
+    musicbrainz consumes a token, or waits for one. When musicbrainz throttles
+    a request, every process waits for the Retry-After delay, or for an
+    exponential backoff.
+    """
+    # indexes of the values in the shared state
+    _TOKENS, _LAST, _BLOCKED_UNTIL, _THROTTLED = range(4)
+
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: allowed requests by second
+        :type rate: float
+        :param burst: maximum number of requests sent at once
+        :type burst: int
+        """
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1)
+        # Created with the context of the workers, to be sent to them
+        self._state = get_mp_context().Array(
+            "d", [self.burst, time.monotonic(), 0, 0]
+        )
+
+    def acquire(self):
+        """
+        Wait until a request can be sent
+        """
+        while True:
+            with self._state.get_lock():
+                now = time.monotonic()
+                state = self._state
+                if now < state[self._BLOCKED_UNTIL]:
+                    wait = state[self._BLOCKED_UNTIL] - now
+                else:
+                    tokens = min(
+                        self.burst,
+                        state[self._TOKENS] +
+                        (now - state[self._LAST]) * self.rate
+                    )
+                    state[self._LAST] = now
+                    if tokens >= 1:
+                        state[self._TOKENS] = tokens - 1
+                        return
+                    state[self._TOKENS] = tokens
+                    wait = (1 - tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self, retry_after=None):
+        """
+        Block all processes after a throttled request
+
+        :param retry_after: delay asked by the server, in seconds
+        :type retry_after: float
+        :returns delay: delay before the next request
+        """
+        with self._state.get_lock():
+            state = self._state
+            state[self._THROTTLED] += 1
+            if retry_after is None:
+                retry_after = min(2 ** (state[self._THROTTLED] - 1),
+                                  MAX_BACKOFF)
+            state[self._BLOCKED_UNTIL] = max(state[self._BLOCKED_UNTIL],
+                                             time.monotonic() + retry_after)
+            state[self._TOKENS] = 0
+            return retry_after
+
+    def succeeded(self):
+        """
+        Reset the backoff after a successful request
+        """
+        if self._state[self._THROTTLED]:
+            with self._state.get_lock():
+                self._state[self._THROTTLED] = 0
+
+
+def set_rate_limiter(rate_limiter):
+    """
+    Pace the musicbrainz requests of this process with a shared rate limiter
+
+    Can be used as initializer of a multiprocessing pool.
+
+    :param rate_limiter: rate limiter shared by all processes
+    :type rate_limiter: Rate_limiter
+    """
+    global _rate_limiter
+    _rate_limiter = rate_limiter
+    # musicbrainzngs paces the requests by process
+    musicbrainzngs.set_rate_limit(rate_limiter is None)
+
+
+def set_cache(cache):
+    """
+    Cache the musicbrainz responses of this process
+
+    :param cache: cache shared by all processes
+    :type cache: Response_cache
+    """
+    global _cache
+    _cache = cache
+
+
+def get_cache_stats():
+    """
+    Get the hits and misses of the cache in this process
+
+    :returns stats: Counter with the keys "hits", "misses" and "evictions"
+    """
+    return Counter(_cache.stats) if _cache is not None else Counter()
+
+
+def _get_retry_after(exc):
+    """
+    Get the Retry-After delay of a failed request, in seconds
+    """
+    try:
+        return float(exc.cause.headers["Retry-After"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+def _is_transient(exc):
+    """
+    Check if a failed request can succeed if it is sent again
+
+    Network errors and server errors are transient, unlike the invalid
+    requests (ResponseError) and the authentication errors.
+    """
+    return isinstance(exc, musicbrainzngs.NetworkError)
+
+
+def _call(func, *args, **kwargs):
+    """
+    Call a function of musicbrainzngs, paced by the rate limiter
+
+    Requests which failed because of a network or a server error are sent
+    again, up to ERROR_RETRIES times.
+
+    :raises ThrottledException: if musicbrainz throttled the request
+    """
+    retries = 0
+    while True:
+        if _rate_limiter is not None:
+            start = time.monotonic()
+            _rate_limiter.acquire()
+            metrics.count("rate_limit_wait_seconds", "musicbrainz",
+                          time.monotonic() - start)
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except musicbrainzngs.WebServiceError as e:
+            metrics.observe("musicbrainz", func.__name__,
+                            time.monotonic() - start)
+            if getattr(e.cause, "code", None) in THROTTLE_STATUS:
+                metrics.count("throttled", "musicbrainz")
+                retry_after = _get_retry_after(e)
+                if _rate_limiter is not None:
+                    retry_after = _rate_limiter.throttled(retry_after)
+                raise ThrottledException(
+                    "Throttled by musicbrainz", retry_after=retry_after
+                )
+            if retries < ERROR_RETRIES and _is_transient(e):
+                retries += 1
+                metrics.count("retries", "musicbrainz")
+                time.sleep(retries * ERROR_RETRY_DELAY)
+                continue
+            metrics.count("errors", "musicbrainz")
+            raise
+        break
+    metrics.observe("musicbrainz", func.__name__, time.monotonic() - start)
+    if _rate_limiter is not None:
+        _rate_limiter.succeeded()
+    return result
+
+
+def _cached_call(key, func, *args, refresh=False, **kwargs):
+    """
+    Call a function of musicbrainzngs, or get the response from the cache
+
+    :param key: key of the request in the cache, see Response_cache.key()
+    :param func: function of musicbrainzngs
+    :param refresh: send the request even if the response is cached, and
+        replace it in the cache
+    :type refresh: bool
+    """
+    if _cache is None:
+        return _call(func, *args, **kwargs)
+    result = None if refresh else _cache.get(key)
+    if result is None:
+        result = _call(func, *args, **kwargs)
+        _cache.set(key, result)
+    return result
+
+
+def search_artists(query, limit=None, refresh=False):
+    """
+    Search artists on musicbrainz
+
+    :param query: artist name
+    :param limit: maximum number of results
+    :param refresh: do not use the cached response, like when searching
+        again an artist which was not found
+    """
+    func = musicbrainzngs.search_artists
+    return _cached_call(Response_cache.key(func.__name__, query, limit),
+                        func, query, limit=limit, refresh=refresh)
+
+
+def browse_release_groups(artist, limit=None, offset=0):
+    """
+    Browse the release groups of an artist on musicbrainz
+
+    :param artist: musicbrainz id of the artist
+    :param limit: maximum number of results, up to 100
+    :param offset: index of the first result, to get the next pages
+    """
+    func = musicbrainzngs.browse_release_groups
+    return _cached_call(
+        Response_cache.key(func.__name__, artist, limit, offset),
+        func, artist=artist, limit=limit, offset=offset
+    )
@@ -1,15 +1,31 @@
 #!/usr/bin/python
 # Author: Anthony Ruhier
 
-import urllib.request
-import mpd
-import requests
-import config
+import os
+import urllib.parse
+from collections import Counter
 from .exceptions import ArtistNotFoundException
+from .metrics import metrics
+from .mpd_pool import Mpd_pool
 from .tools import get_mbid, get_config
 
 config = get_config()
 from config import MUSPY_ADDR, MUSPY_USERNAME, MUSPY_PASSWORD, MUSPY_ID
+try:
+    from config import MUSPY_POOL_SIZE
+except:
+    MUSPY_POOL_SIZE = 10
+try:
+    from config import MUSPY_TIMEOUT
+except:
+    MUSPY_TIMEOUT = 30
+try:
+    from config import MUSPY_RETRIES
+except:
+    MUSPY_RETRIES = 3
+
+#: HTTP status codes of the requests to retry
+RETRY_STATUS = (429, 500, 502, 503, 504)
 
 
 class Muspy_api():
@@ -28,37 +44,108 @@ class Muspy_api():
     #: muspy user id
     user_id = None
 
-    #: MPDClient object
-    _mpdclient = None
+    #: HTTP sessions of this process, by (pid, username, password, verify)
+    _sessions = dict()
 
     def __init__(self, username=MUSPY_USERNAME, password=MUSPY_PASSWORD,
                  user_id=MUSPY_ID, *args, **kwargs):
         self.username = username
         self.password = password
         self.user_id = user_id
-        self._mpdclient = mpd.MPDClient()
         try:
             self._ssl_verify = not config.MUSPY_FORCE_SSL_ACCEPT
-            if not self._ssl_verify:
-                requests.packages.urllib3.disable_warnings()
         except:
             self._ssl_verify = True
 
+    @property
+    def session(self):
+        """
+        HTTP session with a pool of keep-alive connections to muspy
+
+        The session is shared by all Muspy_api objects of a process using the
+        same account. requests is only imported with the first session, not
+        by the commands which do not reach muspy.
+        """
+        key = (os.getpid(), self.username, self.password, self._ssl_verify)
+        session = self._sessions.get(key)
+        if session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            if not self._ssl_verify:
+                requests.packages.urllib3.disable_warnings()
+            session = requests.Session()
+            session.auth = (self.username, self.password)
+            session.verify = self._ssl_verify
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=MUSPY_POOL_SIZE,
+                max_retries=Retry(
+                    total=MUSPY_RETRIES, backoff_factor=0.5,
+                    status_forcelist=RETRY_STATUS,
+                    raise_on_status=False
+                )
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            # Sessions inherited from a parent process cannot be shared
+            for k in [k for k in self._sessions if k[0] != key[0]]:
+                del self._sessions[k]
+            self._sessions[key] = session
+        return session
+
+    def connection_stats(self):
+        """
+        Count the requests sent to muspy by this process, and the connections
+        opened for them
+
+        :returns stats: Counter with the keys "requests" and "connections"
+        """
+        stats = Counter()
+        adapter = self.session.get_adapter(self._muspy_api_url)
+        pools = adapter.poolmanager.pools
+        for pool_key in pools.keys():
+            pool = pools[pool_key]
+            stats["requests"] += pool.num_requests
+            stats["connections"] += pool.num_connections
+        return stats
+
+    def _send(self, method, url, endpoint):
+        """
+        Send a request to muspy, and record its latency and retries in the
+        metrics
+
+        :param endpoint: name of the request in the metrics
+        :raises requests.HTTPError: if muspy returns an error
+        """
+        with metrics.request("muspy", endpoint):
+            r = self.session.request(method, url, timeout=MUSPY_TIMEOUT)
+            retries = getattr(r.raw, "retries", None)
+            if retries is not None and retries.history:
+                metrics.count("retries", "muspy", len(retries.history))
+            r.raise_for_status()
+        return r
+
+    def artists_url(self, mbid=None):
+        """
+        URL of the artists followed by the user, or of one of them
+
+        :param mbid: MusicBrainz id of an artist
+        """
+        url = urllib.parse.urljoin(self._muspy_api_url,
+                                   "artists/" + self.user_id)
+        if mbid is not None:
+            url += "/" + str(mbid)
+        return url
+
     def add_artist_mbid(self, mbid):
         """
         Add artist by its MusicBrainz id to the muspy account
 
         :param mbid: MusicBrainz id of the artist
         """
+        import requests
         try:
-            requests.put(
-                urllib.request.urljoin(
-                    self._muspy_api_url,
-                    "artists/" + self.user_id + "/" + str(mbid)
-                ),
-                auth=(MUSPY_USERNAME, MUSPY_PASSWORD),
-                verify=self._ssl_verify,
-            )
+            self._send("PUT", self.artists_url(mbid), "add_artist")
         except requests.HTTPError:
             raise ArtistNotFoundException("Artist not found")
 
@@ -68,35 +155,49 @@ class Muspy_api():
 
         :param mbid: MusicBrainz id of the artist
         """
+        import requests
         try:
-            requests.delete(
-                urllib.request.urljoin(
-                    self._muspy_api_url,
-                    "artists/" + self.user_id + "/" + str(mbid)
-                ),
-                auth=(MUSPY_USERNAME, MUSPY_PASSWORD),
-                verify=self._ssl_verify,
-            )
+            self._send("DELETE", self.artists_url(mbid), "del_artist")
         except requests.HTTPError:
             raise ArtistNotFoundException(
                 "Artist is not indexed in the Muspy account"
             )
 
-    def add_artist(self, artist):
+    def _get_mbid(self, artist, mpdclient=None):
+        """
+        Get the musicbrainz id of an artist, see tools.get_mbid()
+
+        :param mpdclient: connections with mpd. If None, a pool is opened for
+            this search, and closed after it.
+        """
+        if mpdclient is not None:
+            return get_mbid(artist, mpdclient)
+        mpdclient = Mpd_pool(size=1)
+        try:
+            return get_mbid(artist, mpdclient)
+        finally:
+            mpdclient.close()
+
+    def add_artist(self, artist, mpdclient=None):
         """
         Add artist by its name to the muspy account
 
         :param artist: Artist name to add
+        :param mpdclient: connections with mpd, to compare the albums of
+            artists with the same name. Opened for this call if None.
+        :type mpdclient: Mpd_pool
         """
-        return self.add_artist_mbid(get_mbid(artist, self._mpdclient))
+        return self.add_artist_mbid(self._get_mbid(artist, mpdclient))
 
-    def del_artist(self, artist):
+    def del_artist(self, artist, mpdclient=None):
         """
         Delete artist by its name from the muspy account
 
         :param artist: Artist name to add
+        :param mpdclient: connections with mpd, see add_artist()
+        :type mpdclient: Mpd_pool
         """
-        return self.del_artist_mbid(get_mbid(artist, self._mpdclient))
+        return self.del_artist_mbid(self._get_mbid(artist, mpdclient))
 
     def get_artists(self):
         """
@@ -111,14 +212,8 @@ class Muspy_api():
 
         :returns artists: list of dicts
         """
-        r = requests.get(
-            urllib.request.urljoin(
-                self._muspy_api_url,
-                "artists/" + self.user_id
-            ),
-            auth=(MUSPY_USERNAME, MUSPY_PASSWORD),
-            verify=self._ssl_verify,
-        )
-        r.raise_for_status()
-        return [{"name": a["name"].lower(), "mbid": a["mbid"]}
+        r = self._send("GET", self.artists_url(), "get_artists")
+        return [{"name": a["name"].lower(), "mbid": a["mbid"],
+                 "sort_name": a.get("sort_name") or "",
+                 "disambiguation": a.get("disambiguation") or ""}
                 for a in r.json()]
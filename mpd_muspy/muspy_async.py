@@ -0,0 +1,372 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+import asyncio
+import concurrent.futures
+import threading
+import time
+from collections import Counter
+import aiohttp
+from .artist_db import Db_saver
+from .exceptions import ArtistNotFoundException
+from .metrics import metrics
+from .muspy_api import MUSPY_RETRIES, MUSPY_TIMEOUT, RETRY_STATUS, Muspy_api
+from .tools import get_config
+from .workers import print_progress
+
+config = get_config()
+try:
+    from config import MUSPY_MAX_IN_FLIGHT
+except:
+    MUSPY_MAX_IN_FLIGHT = 10
+
+
+class Muspy_async_api():
+    """
+    Asynchronous client of the muspy api, sending requests concurrently from
+    one process
+
+    It is used as an asynchronous context manager:
+
+        async with Muspy_async_api() as api:
+            await api.add_artist_mbid(mbid)
+    """
+    def __init__(self, max_in_flight=MUSPY_MAX_IN_FLIGHT, *args, **kwargs):
+        """
+        :param max_in_flight: maximum number of requests sent at the same time,
+            each one on its own keep-alive connection
+        :type max_in_flight: int
+
+        Other parameters are the ones of Muspy_api.
+        """
+        self._api = Muspy_api(*args, **kwargs)
+        self.max_in_flight = max_in_flight
+        self.stats = Counter()
+        self._session = None
+
+    async def __aenter__(self):
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_end.append(self._on_request_end)
+        trace_config.on_connection_create_end.append(
+            self._on_connection_create_end
+        )
+        self._session = aiohttp.ClientSession(
+            auth=aiohttp.BasicAuth(self._api.username, self._api.password),
+            connector=aiohttp.TCPConnector(
+                limit=self.max_in_flight,
+                ssl=None if self._api._ssl_verify else False
+            ),
+            timeout=aiohttp.ClientTimeout(total=MUSPY_TIMEOUT),
+            trace_configs=[trace_config],
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+
+    async def _on_request_end(self, session, context, params):
+        self.stats["requests"] += 1
+
+    async def _on_connection_create_end(self, session, context, params):
+        self.stats["connections"] += 1
+
+    async def _request(self, method, url, endpoint):
+        """
+        Send a request, retried after a connection or server error
+
+        :param endpoint: name of the request in the metrics
+        :raises aiohttp.ClientResponseError: if muspy returns an error
+        """
+        for retry in range(MUSPY_RETRIES + 1):
+            last_try = retry == MUSPY_RETRIES
+            delay = 0.5 * 2 ** retry
+            if retry:
+                metrics.count("retries", "muspy")
+            start = time.monotonic()
+            try:
+                async with self._session.request(method, url) as r:
+                    # Read the response to reuse the connection
+                    await r.read()
+                    if r.status >= 400:
+                        metrics.count("errors", "muspy")
+                    if r.status not in RETRY_STATUS or last_try:
+                        r.raise_for_status()
+                        return
+                    try:
+                        delay = float(r.headers["Retry-After"])
+                    except (KeyError, ValueError):
+                        pass
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                metrics.count("errors", "muspy")
+                if last_try:
+                    raise
+            finally:
+                metrics.observe("muspy", endpoint, time.monotonic() - start)
+            await asyncio.sleep(delay)
+
+    async def add_artist_mbid(self, mbid):
+        """
+        Add artist by its MusicBrainz id to the muspy account
+
+        :param mbid: MusicBrainz id of the artist
+        """
+        try:
+            await self._request("PUT", self._api.artists_url(mbid),
+                                "add_artist")
+        except aiohttp.ClientResponseError:
+            raise ArtistNotFoundException("Artist not found")
+
+    async def del_artist_mbid(self, mbid):
+        """
+        Delete artist by its MusicBrainz id of the muspy account
+
+        :param mbid: MusicBrainz id of the artist
+        """
+        try:
+            await self._request("DELETE", self._api.artists_url(mbid),
+                                "del_artist")
+        except aiohttp.ClientResponseError:
+            raise ArtistNotFoundException(
+                "Artist is not indexed in the Muspy account"
+            )
+
+
+async def _add_artist(api, artist, db_saver):
+    """
+    Add an artist on muspy and mark it in the database
+
+    :returns (name, error): artist name and error message
+    """
+    if "mbid" not in artist.keys():
+        return artist["name"], "Doesn't have a musicbrainz ID"
+    try:
+        await api.add_artist_mbid(artist["mbid"])
+    except Exception as e:
+        return artist["name"], "Error: " + str(e)
+    db_saver.update("mark_as_uploaded", artist["name"])
+    return artist["name"], ""
+
+
+async def _run_tasks(task, items, max_in_flight):
+    """
+    Run a task on each item, with at most max_in_flight tasks at the same time
+
+    :param task: coroutine function taking an item, and returning the name of
+        the item and an error message (empty if none)
+    :returns errors: number of failed tasks
+    """
+    items_iter = iter(items)
+    errors = 0
+    done = 0
+
+    async def worker():
+        nonlocal errors, done
+        # The iterator is shared by the workers, each one takes the next item
+        # when it is done with the previous one
+        for item in items_iter:
+            name, error = await task(item)
+            done += 1
+            print_progress(done, len(items), name, error)
+            if error:
+                errors += 1
+
+    await asyncio.gather(*(worker()
+                           for _ in range(min(max_in_flight, len(items)))))
+    return errors
+
+
+async def _add_artists(artists, artist_db, max_in_flight):
+    db_saver = Db_saver(artist_db)
+    async with Muspy_async_api(max_in_flight) as api:
+        try:
+            errors = await _run_tasks(
+                lambda artist: _add_artist(api, artist, db_saver), artists,
+                max_in_flight
+            )
+        finally:
+            db_saver.save()
+    return errors, api.stats
+
+
+async def _del_artists(artists, max_in_flight):
+    async def delete(artist):
+        try:
+            await api.del_artist_mbid(artist[1])
+        except Exception as e:
+            return artist[0], "Error: " + str(e)
+        return artist[0], ""
+
+    async with Muspy_async_api(max_in_flight) as api:
+        errors = await _run_tasks(delete, artists, max_in_flight)
+    return errors, api.stats
+
+
+def add_artists(artists, artist_db, max_in_flight=MUSPY_MAX_IN_FLIGHT):
+    """
+    Add artists on muspy and mark them in the artists database
+
+    The requests are sent concurrently by an event loop, which also updates the
+    database.
+
+    :param artists: list of artists to upload, with their musicbrainz id
+    :type artists: list of dict
+    :param artist_db: database of artists
+    :param max_in_flight: maximum number of requests sent at the same time
+    :returns (errors, stats): number of artists which failed to be uploaded,
+        and requests and connections to muspy
+    """
+    metrics.queue_depth("add_artist", len(artists))
+    return asyncio.run(_add_artists(artists, artist_db, max_in_flight))
+
+
+def del_artists(artists, max_in_flight=MUSPY_MAX_IN_FLIGHT):
+    """
+    Remove artists of muspy
+
+    :param artists: list of artists name and musicbrainz id
+    :type artists: list of tuple
+    :param max_in_flight: maximum number of requests sent at the same time
+    :returns (errors, stats): number of artists which failed to be removed,
+        and requests and connections to muspy
+    """
+    metrics.queue_depth("del_artist", len(artists))
+    return asyncio.run(_del_artists(artists, max_in_flight))
+
+
+class Upload_stream():
+    """
+    Add artists on muspy while they are produced by another stage
+
+    The artists are sent through a bounded queue to an event loop running in
+    a thread, which uploads them concurrently and marks them in the database.
+    put() blocks while the queue is full, so a slow upload slows down the
+    producer instead of buffering every artist.
+    """
+    #: marks the end of the stream in the queue
+    _END = None
+
+    def __init__(self, artist_db, db_lock=None,
+                 max_in_flight=MUSPY_MAX_IN_FLIGHT, queue_size=None):
+        """
+        :param artist_db: database of artists
+        :param db_lock: lock to hold when writing the database, if it is
+            written by other threads
+        :type db_lock: threading.Lock
+        :param max_in_flight: maximum number of requests sent at the same time
+        :param queue_size: maximum number of artists waiting to be uploaded,
+            4 times max_in_flight by default
+        """
+        self.max_in_flight = max_in_flight
+        self.queue_size = queue_size or 4 * max_in_flight
+        self.total = 0
+        self.done = 0
+        self.errors = 0
+        self.stats = Counter()
+        self._db_saver = Db_saver(artist_db, db_lock)
+        #: exception which stopped the event loop
+        self._exception = None
+        self._loop = None
+        self._queue = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def _run_loop(self):
+        try:
+            asyncio.run(self._run())
+        except BaseException as e:
+            # Raised again by put() and close()
+            self._exception = e
+            self._ready.set()
+
+    async def _run(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(self.queue_size)
+        self._ready.set()
+        async with Muspy_async_api(self.max_in_flight) as api:
+            try:
+                await asyncio.gather(*(self._worker(api)
+                                       for _ in range(self.max_in_flight)))
+            finally:
+                self._db_saver.save()
+            self.stats = api.stats
+
+    async def _worker(self, api):
+        while True:
+            artist = await self._queue.get()
+            if artist is self._END:
+                # Let the other workers see the end of the stream
+                await self._queue.put(self._END)
+                return
+            # An error on one artist, like when saving the database, does not
+            # stop the uploads of the others
+            try:
+                name, error = await _add_artist(api, artist,
+                                                self._db_saver)
+            except Exception as e:
+                name, error = artist["name"], "Error: " + str(e)
+            self.done += 1
+            if error:
+                self.errors += 1
+            try:
+                print_progress(self.done, self.total, name, error, "Upload")
+            except OSError:
+                # Like a closed output, which does not stop the uploads
+                pass
+
+    def _check_running(self):
+        """
+        :raises: the exception which stopped the event loop, if it stopped
+            before the end of the stream. The queue may not even exist.
+        """
+        if self._exception is not None or not self._thread.is_alive():
+            self._raise_stopped()
+
+    def _put(self, item):
+        """
+        Put an item in the queue from this thread, and wait while the queue is
+        full
+
+        The coroutine is only created once the event loop is known to run.
+        """
+        self._check_running()
+        try:
+            return asyncio.run_coroutine_threadsafe(
+                self._queue.put(item), self._loop
+            ).result()
+        except (RuntimeError, asyncio.CancelledError,
+                concurrent.futures.CancelledError):
+            # The loop stopped while waiting
+            self._thread.join()
+            self._raise_stopped()
+
+    def _raise_stopped(self):
+        if self._exception is not None:
+            raise self._exception
+        raise RuntimeError("The upload stream is closed")
+
+    def put(self, artist):
+        """
+        Queue an artist to upload, and wait if the queue is full
+
+        :param artist: artist name and musicbrainz id
+        :type artist: dict
+        """
+        self._check_running()
+        self.total += 1
+        metrics.queue_depth("upload", self._queue.qsize())
+        self._put(artist)
+
+    def close(self):
+        """
+        Wait until all queued artists are uploaded
+
+        :returns (errors, stats): number of artists which failed to be
+            uploaded, and requests and connections to muspy
+        """
+        self._put(self._END)
+        self._thread.join()
+        if self._exception is not None:
+            raise self._exception
+        return self.errors, self.stats
@@ -1,132 +1,353 @@
 #!/usr/bin/python
 # Author: Anthony Ruhier
 
-import multiprocessing
+import appdirs
+import hashlib
+import os
+import time
+from contextlib import nullcontext
+from . import _release_name
+from .artist_db import Db_saver
+from .cache import Response_cache
+from .exceptions import ArtistNotFoundException, ThrottledException
+from .metrics import metrics
 from .muspy_api import Muspy_api
-from .tools import chunks, get_mbid, mpd_get_artists, get_config
+from .tools import (
+    get_known_mpd_albums, get_mbid, mpd_get_mbids, mpd_iter_artists,
+    mpd_get_db_update, get_config, normalize_name
+)
+from .workers import Work_queue, get_context
 
 config = get_config()
 try:
     from config import FULLSYNC
 except:
     FULLSYNC = False
+try:
+    from config import MUSICBRAINZ_RATE_LIMIT
+except:
+    MUSICBRAINZ_RATE_LIMIT = 1
+try:
+    from config import MUSICBRAINZ_BURST
+except:
+    MUSICBRAINZ_BURST = 1
+try:
+    from config import MUSICBRAINZ_MAX_RETRIES
+except:
+    MUSICBRAINZ_MAX_RETRIES = 10
+try:
+    from config import MUSICBRAINZ_CACHE_TTL
+except:
+    MUSICBRAINZ_CACHE_TTL = 30 * 24 * 3600
+try:
+    from config import MUSICBRAINZ_CACHE_SIZE
+except:
+    MUSICBRAINZ_CACHE_SIZE = 100 * 1024 * 1024
+try:
+    from config import MUSICBRAINZ_WORKERS
+except:
+    # The requests to musicbrainz are paced by a rate limiter shared between
+    # the processes, more processes only hide the latency of the requests
+    MUSICBRAINZ_WORKERS = 3
+try:
+    from config import MUSICBRAINZ_RETRY_DELAY
+except:
+    MUSICBRAINZ_RETRY_DELAY = 24 * 3600
+try:
+    from config import MUSICBRAINZ_ERROR_RETRY_DELAY
+except:
+    MUSICBRAINZ_ERROR_RETRY_DELAY = 3600
+try:
+    from config import MUSICBRAINZ_MAX_RETRY_DELAY
+except:
+    MUSICBRAINZ_MAX_RETRY_DELAY = 90 * 24 * 3600
 
-# After multiple tests, it appears that this value is the best compromise to
-# avoid HTTP error 400 with the musicbrainz api
-NB_MULTIPROCESS = 3
-
-
-def process_task(lst_without_mbid, artists_nb, artist_db, lock, counter,
-                 error_nb, muspy_artists, mpdclient):
-    """
-    Function launched by each process
-
-    Add artists on muspy and marks it in the artists database.
-    Tries to get the mbid from the list muspy_artists, because it is very fast.
-    If it cannot find it, search on musicbrainz.
-
-    :param lst_without_mbid: list of artists, splited for each process, that
-        don't have a musicbrainz id
-    :type artists: list
-    :param artists_nb: total artists to upload. Different of
-        len(lst_without_mbid), here it is the total number of artists of all
-        processes
-    :type artists_nb: int
-    :param artist_db: database of artists, in the shared memory
-    :type artist_db: SyncManager.Artist_db()
-    :param lock: lock shared between the processes
-    :type lock: multiprocessing.Lock
-    :param counter: integer in the shared memory
-    :type counter: multiprocessing.Value("i")
-    :param muspy_artists: list of artists already on the muspy account
+MUSICBRAINZ_CACHE = os.path.join(
+    appdirs.user_cache_dir(_release_name), "musicbrainz.sqlite"
+)
+
+
+def build_muspy_index(muspy_artists):
+    """
+    Index the artists of the muspy account by their normalized names
+
+    Artists are indexed by name, and then by sort name ("Beatles, The" is also
+    indexed as "The Beatles") and by "name (disambiguation)", without
+    overriding a name. A name shared by different artists is ambiguous and is
+    indexed with a None id.
+
+    :param muspy_artists: artists already on the muspy account
     :type muspy_artists: list of dict
-    :param mpdclient:
+    :returns index: dict of normalized name: musicbrainz id
+    """
+    index = dict()
+
+    def index_name(name, mbid, reserved=()):
+        name = normalize_name(name)
+        if name and name not in reserved:
+            index[name] = mbid if index.get(name, mbid) == mbid else None
+
+    for ma in muspy_artists:
+        index_name(ma["name"], ma["mbid"])
+    names = frozenset(index)
+    for ma in muspy_artists:
+        sort_name = ma.get("sort_name", "")
+        aliases = [sort_name, ]
+        if ", " in sort_name:
+            aliases.append(" ".join(reversed(sort_name.split(", ", 1))))
+        if ma.get("disambiguation"):
+            aliases.append(
+                "{} ({})".format(ma["name"], ma["disambiguation"])
+            )
+        for alias in aliases:
+            index_name(alias, ma["mbid"], names)
+    return index
+
+
+def open_cache():
+    """
+    Open the cache of the musicbrainz responses
+
+    :returns cache: Response_cache object, or None if the cache is disabled
+    """
+    if not MUSICBRAINZ_CACHE_TTL:
+        return None
+    return Response_cache(MUSICBRAINZ_CACHE, MUSICBRAINZ_CACHE_TTL,
+                          MUSICBRAINZ_CACHE_SIZE)
+
+
+def init_process(rate_limiter, cache):
+    """
+    Initializer of the processes searching on musicbrainz
+
+    :param rate_limiter: rate limiter shared by all processes
+    :type rate_limiter: Rate_limiter
+    :param cache: cache of the musicbrainz responses, or None to disable it
+    :type cache: Response_cache
+    """
+    from .musicbrainz import set_cache, set_rate_limiter
+    set_rate_limiter(rate_limiter)
+    set_cache(cache)
+
+
+def print_cache_stats(stats):
+    """
+    Print the hits and misses of the musicbrainz cache
+
+    :param stats: results of process_task
+    :type stats: Counter
+    """
+    print("Musicbrainz cache:", stats["hits"], "hit(s),", stats["misses"],
+          "miss(es),", stats["evictions"], "eviction(s)")
+
+
+def postpone_lookup(db_saver, artist, status):
+    """
+    Postpone the next search of an artist on musicbrainz after a failure
+
+    Artists not found are searched again after MUSICBRAINZ_RETRY_DELAY, and
+    after MUSICBRAINZ_ERROR_RETRY_DELAY for other errors, which are usually
+    temporary. The delay doubles with each failure, up to
+    MUSICBRAINZ_MAX_RETRY_DELAY.
+
+    :param db_saver: database of local artists
+    :type db_saver: Db_saver
+    :param artist: artist name
+    :param status: cause of the failure, "not_found" or "error"
     """
-    for artist in lst_without_mbid:
-        error = ""
+    if status == "not_found":
+        delay = MUSICBRAINZ_RETRY_DELAY
+    else:
+        delay = MUSICBRAINZ_ERROR_RETRY_DELAY
+    db_saver.update("mark_lookup_failed", artist, status, delay,
+                    MUSICBRAINZ_MAX_RETRY_DELAY)
+
+
+def resolve_artist(item):
+    """
+    Task of the workers of fetch_missing_mbid()
+
+    Search on musicbrainz the mbid of an artist. The result is applied on
+    the artists database by the process owning it. The mpd connections are
+    taken in the worker context.
+
+    :param item: artist name, its albums in the mpd database or None to
+        fetch them from mpd, and if the cached responses of musicbrainz are
+        skipped because a previous search failed
+    :type item: tuple
+    :returns (artist, error, stats, mbid, status): artist name, error
+        message, hits and misses of the musicbrainz cache in this task, the id
+        found, and the status of the lookup ("found", "not_found" or "error")
+    """
+    from .musicbrainz import get_cache_stats
+    artist, albums, refresh = item
+    stats = get_cache_stats()
+    error = ""
+    mbid = None
+    status = "found"
+    throttled = 0
+    while True:
         try:
-            mbid = None
-            for ma in muspy_artists:
-                if ma["name"] == artist:
-                    mbid = ma["mbid"]
-                    break
+            mbid = get_mbid(artist, get_context("mpdclient"), albums,
+                            refresh)
             if mbid is None:
-                mbid = get_mbid(artist, mpdclient)
-            if mbid is not None:
-                with lock:
-                    artist_db.set_mbid(artist, mbid)
-                    artist_db.save()
+                raise ArtistNotFoundException("Artist not found")
+        except ThrottledException as e:
+            throttled += 1
+            if throttled <= MUSICBRAINZ_MAX_RETRIES:
+                # The rate limiter makes every process wait before the next
+                # request
+                metrics.count("retries", "musicbrainz")
+                continue
+            error = "Error: " + str(e)
+            status = "error"
+        except ArtistNotFoundException as e:
+            error = "Error: " + str(e)
+            status = "not_found"
         except Exception as e:
             error = "Error: " + str(e)
-            with lock:
-                error_nb.value += 1
-        finally:
-            with lock:
-                counter.value += 1
-            print("[", counter.value, "/", artists_nb, "]:", artist.title())
-            if error:
-                print(error)
+            status = "error"
+        break
+    return artist, error, get_cache_stats() - stats, mbid, status
 
 
-def fetch_missing_mbid(artist_db, muspy_artists, mpdclient):
+@metrics.timed_phase("fetch_missing_mbid")
+def fetch_missing_mbid(artist_db, muspy_index, mpdclient, mpd_changed=True,
+                       in_process=False, on_resolved=None, db_lock=None):
     """
     Initialize the synchronization in several process
 
-    :param artist_db: Artist_db() object in the shared memory
-    :type artist_db: SyncManager.Artist_db
-    :param muspy_artists: artists already on the muspy account
-    :type muspy_artists: list of dict
-    :param mpdclient: client for mpd
-    :type mpdclient: SyncManager.MPDClient
+    The ids are first taken from the mpd tags and the muspy account. Only the
+    remaining artists are searched on musicbrainz, in several process, and
+    only if they are due: artists which failed to be found are searched again
+    after a delay, see postpone_lookup().
+
+    :param artist_db: database of local artists, only written by this
+        process
+    :param muspy_index: artists already on the muspy account, indexed by name
+    :type muspy_index: dict
+    :param mpdclient: connections with mpd, opened by each process
+    :type mpdclient: Mpd_pool
+    :param mpd_changed: if False, the artists without id were already searched
+        in the mpd tags during the last synchronization
+    :type mpd_changed: bool
+    :param in_process: search on musicbrainz in the current process, which
+        has to be initialized with init_process()
+    :type in_process: bool
+    :param on_resolved: function called with the artist name and its id, as
+        soon as an id is found
+    :param db_lock: lock to hold when writing the database, if other
+        threads write it at the same time
+    :type db_lock: threading.Lock
     """
     # Get all artists name that don't have an musicbrainz id
-    lst_without_mbid = [a["name"]
-                        for a in artist_db.get_artists(fields=("mbid",))
-                        if not ("mbid" in a.keys() and a["mbid"] is not None)]
-
-    manager = multiprocessing.Manager()
-    lock = manager.Lock()
-    error = manager.Value("i", 0)
-    counter = manager.Value("i", 0)
-    artists_nb = len(lst_without_mbid)
-    artists_nb_by_split = int(artists_nb / NB_MULTIPROCESS)
-    pool = multiprocessing.Pool()
+    lst_without_mbid = artist_db.get_artists_without_mbid()
+
+    # Tagged libraries already have most of the ids in MPD, which avoids
+    # querying musicbrainz
+    if mpd_changed:
+        tagged_mbids = mpd_get_mbids(mpdclient)
+        lst_tagged = [a for a in lst_without_mbid if a in tagged_mbids]
+        if lst_tagged:
+            with db_lock or nullcontext():
+                for artist in lst_tagged:
+                    artist_db.set_mbid(artist, tagged_mbids[artist])
+                artist_db.save()
+            if on_resolved is not None:
+                for artist in lst_tagged:
+                    on_resolved(artist, tagged_mbids[artist])
+            lst_without_mbid = [a for a in lst_without_mbid
+                                if a not in tagged_mbids]
+        print(len(lst_tagged), "musicbrainz id(s) found in the mpd tags")
+
+    # Getting the id from the muspy account is very fast
+    lst_on_muspy = []
+    with db_lock or nullcontext():
+        for artist in lst_without_mbid:
+            mbid = muspy_index.get(normalize_name(artist))
+            if mbid is not None:
+                artist_db.set_mbid(artist, mbid)
+                lst_on_muspy.append(artist)
+        if lst_on_muspy:
+            artist_db.save()
+    if lst_on_muspy:
+        lst_on_muspy = set(lst_on_muspy)
+        lst_without_mbid = [a for a in lst_without_mbid
+                            if a not in lst_on_muspy]
+    print(len(lst_on_muspy), "musicbrainz id(s) found in the muspy account")
+
+    # Do not spend requests on the artists which recently failed to be found.
+    # The ones found above are not in the database without id anymore.
+    postponed = len(lst_without_mbid)
+    lst_without_mbid = artist_db.get_artists_without_mbid(due=time.time())
+    postponed -= len(lst_without_mbid)
+    if postponed:
+        print(postponed, "artist(s) not found recently, searched again later")
+    if not lst_without_mbid:
+        return 0
+
+    # The workers only search the ids, this process applies their results
+    context = {"mpdclient": mpdclient}
+    if in_process:
+        # The rate limiter and the cache of this process are already set
+        work_queue = Work_queue(0, context)
+    else:
+        from .musicbrainz import Rate_limiter
+        rate_limiter = Rate_limiter(MUSICBRAINZ_RATE_LIMIT, MUSICBRAINZ_BURST)
+        work_queue = Work_queue(MUSICBRAINZ_WORKERS, context, init_process,
+                                (rate_limiter, open_cache()))
+    albums = get_known_mpd_albums(lst_without_mbid)
+    # The cached responses of the artists which failed to be found are the
+    # ones of the failed searches: musicbrainz is searched again
+    failed = set(artist_db.get_artists_without_mbid(failed=True))
+
+    db_saver = Db_saver(artist_db, db_lock)
+
+    def on_result(result):
+        artist, error, stats, mbid, status = result
+        if mbid is None:
+            postpone_lookup(db_saver, artist, status)
+            return
+        db_saver.update("set_mbid", artist, mbid)
+        if on_resolved is not None:
+            on_resolved(artist, mbid)
 
     try:
-        for l in chunks(lst_without_mbid, artists_nb_by_split):
-            pool.apply_async(
-                process_task,
-                kwds={"lst_without_mbid": l,
-                      "artists_nb": artists_nb, "artist_db": artist_db,
-                      "lock": lock, "counter": counter, "error_nb": error,
-                      "muspy_artists": muspy_artists, "mpdclient": mpdclient}
-            )
-        pool.close()
-        pool.join()
-    except KeyboardInterrupt as e:
-        pool.terminate()
-        pool.join()
-        raise e
-    return error.value
+        error, stats = work_queue.run(
+            resolve_artist,
+            [(a, albums.get(a), a in failed) for a in lst_without_mbid],
+            on_result
+        )
+    finally:
+        db_saver.save()
+    work_queue.print_utilisation()
+    if MUSICBRAINZ_CACHE_TTL:
+        print_cache_stats(stats)
+    return error
 
 
-def update_artists_from_muspy(artist_db, muspy_artists):
+@metrics.timed_phase("update_artists_from_muspy")
+def update_artists_from_muspy(artist_db, muspy_artists, skip=()):
     """
     Update the uploaded state of artists from the ones already on the muspy
     account.
 
     :param artist_db: database of local artists
     :param muspy_artists: list of artists already on the muspy account
+    :param skip: artists being uploaded, which are not on the account yet
+    :type skip: set
     :return remove_of_muspy: list of artists that should be removed of muspy to
                              get a full synchronisation with the local mpd
     """
-    local_artists = artist_db.get_artists(fields=("mbid", "uploaded",))
+    local_artists = artist_db.iter_artists(fields=("mbid", "uploaded",))
     muspy_mbid_list = {ma["mbid"] for ma in muspy_artists}
     # usefull for fullsync
     uniq_local_artists = set()
     for la in local_artists:
         try:
             uniq_local_artists.add(la["mbid"])
+            if la["name"] in skip:
+                continue
             if la["mbid"] in muspy_mbid_list and la["uploaded"] is False:
                 artist_db.mark_as_uploaded(la["name"])
             elif la["mbid"] not in muspy_mbid_list and la["uploaded"] is True:
@@ -144,16 +365,118 @@ def update_artists_from_muspy(artist_db, muspy_artists):
     return remove_of_muspy
 
 
-def presync(artist_db, mpdclient):
-    print("Get mpd artists...")
-    artists = mpd_get_artists(mpdclient)
-    artists_added, artists_removed = artist_db.merge(artists)
+def muspy_fingerprint(muspy_artists):
+    """
+    Fingerprint of the artists followed on the muspy account
+
+    :param muspy_artists: list of artists already on the muspy account
+    :returns fingerprint: hash of the sorted musicbrainz ids
+    """
+    mbids = sorted(ma["mbid"] for ma in muspy_artists)
+    return hashlib.sha1("\n".join(mbids).encode()).hexdigest()
+
+
+def update_muspy_fingerprint(sync_state, error, changed):
+    """
+    Take the fingerprint of the muspy account again in the state to save,
+    once the artists are uploaded and removed
+
+    If some artists failed to be synchronized, the fingerprint is cleared: the
+    next synchronization has to compare the database with the muspy account
+    again.
+
+    :param sync_state: state returned by presync()
+    :param error: number of artists which failed to be uploaded or removed
+    :param changed: if some artists were uploaded or removed of muspy
+    """
+    if error:
+        sync_state["muspy_fingerprint"] = None
+    elif changed:
+        try:
+            muspy_artists = Muspy_api().get_artists()
+        except Exception as e:
+            print("Cannot get the artists of the muspy account:", e)
+            sync_state["muspy_fingerprint"] = None
+        else:
+            sync_state["muspy_fingerprint"] = muspy_fingerprint(
+                muspy_artists
+            )
+
+
+@metrics.timed_phase("presync")
+def presync(artist_db, mpdclient, force=False, uploader=None, db_lock=None):
+    """
+    Prepare the synchronization
+
+    The time of the last update of the mpd database and a fingerprint of the
+    muspy account are compared with the ones of the last synchronization, to
+    skip the steps that would not change anything, unless some artists are due
+    to be searched again on musicbrainz.
+
+    With an uploader, the artists are sent to it as soon as their id is
+    found, and are not returned in the artists to upload.
+
+    :param artist_db: database of local artists
+    :param mpdclient: connections with mpd
+    :type mpdclient: Mpd_pool
+    :param force: do all steps, even if nothing changed
+    :param uploader: stream uploading artists on muspy, which writes the
+        database at the same time
+    :type uploader: muspy_async.Upload_stream
+    :param db_lock: lock to hold when writing the database, shared with the
+        uploader
+    :type db_lock: threading.Lock
+    :returns (non_uploaded_artists, remove_of_muspy, sync_state): artists to
+        upload, artists to remove of muspy, and the state to save in the
+        database once synchronized (see Artist_db.set_meta())
+    """
+    sync_state = {"mpd_db_update": mpd_get_db_update(mpdclient)}
+    mpd_changed = (
+        force or sync_state["mpd_db_update"] is None or
+        sync_state["mpd_db_update"] != artist_db.get_meta("mpd_db_update")
+    )
+    lookups_due = bool(artist_db.get_artists_without_mbid(due=time.time()))
+    if mpd_changed:
+        print("Get mpd artists...")
+        # Only the albums of the artists to search are kept
+        artists_added, artists_removed = artist_db.merge(mpd_iter_artists(
+            mpdclient, lambda artist: artist_db.get_mbid(artist) is None
+        ))
+    else:
+        print("MPD database unchanged since the last synchronization")
+        artists_added, artists_removed = 0, 0
 
     mapi = Muspy_api()
     muspy_artists = mapi.get_artists()
+    sync_state["muspy_fingerprint"] = muspy_fingerprint(muspy_artists)
+    muspy_changed = (sync_state["muspy_fingerprint"] !=
+                     artist_db.get_meta("muspy_fingerprint"))
+    if not (mpd_changed or muspy_changed or lookups_due):
+        print("Muspy account unchanged since the last synchronization")
+        # Only the artists which failed to be uploaded are left
+        non_uploaded_artists = [
+            a for a in artist_db.iter_artists(fields=("mbid",), uploaded=False)
+            if "mbid" in a
+        ]
+        print(len(non_uploaded_artists), "artist(s) non uploaded on muspy")
+        return non_uploaded_artists, [], sync_state
 
     print("Fetch the missing musicbrainz ids...")
-    error = fetch_missing_mbid(artist_db, muspy_artists, mpdclient)
+    muspy_index = build_muspy_index(muspy_artists)
+    uploading = set()
+    if uploader is not None:
+        muspy_mbids = {ma["mbid"] for ma in muspy_artists}
+
+        def on_resolved(artist, mbid):
+            if mbid not in muspy_mbids:
+                uploader.put({"name": artist, "mbid": mbid})
+                uploading.add(artist)
+    else:
+        on_resolved = None
+
+    error = fetch_missing_mbid(artist_db, muspy_index, mpdclient,
+                               mpd_changed, on_resolved=on_resolved,
+                               db_lock=db_lock)
     print()
     if error:
         print("Done with", error, "error(s)\n")
@@ -162,14 +485,22 @@ def presync(artist_db, mpdclient):
 
     # Update the uploaded status of artists in the db with the muspy account
     print("Pre-synchronization with muspy...")
-    remove_of_muspy = update_artists_from_muspy(artist_db, muspy_artists)
-    artist_db.save()
+    with db_lock or nullcontext():
+        remove_of_muspy = update_artists_from_muspy(artist_db, muspy_artists,
+                                                    uploading)
+        artist_db.save()
 
-    non_uploaded_artists = artist_db.get_artists(fields=("mbid",),
-                                                 uploaded=False)
+    # The uploader marks the artists as uploaded meanwhile
+    with db_lock or nullcontext():
+        non_uploaded_artists = [
+            a for a in artist_db.iter_artists(fields=("mbid",),
+                                              uploaded=False)
+            if a["name"] not in uploading
+        ]
     print()
-    print(len(non_uploaded_artists), "artist(s) non uploaded on muspy")
-    print(len(artists_added), "artist(s) added")
-    print(len(artists_removed), "artist(s) removed")
+    print(len(non_uploaded_artists) + len(uploading),
+          "artist(s) non uploaded on muspy")
+    print(artists_added, "artist(s) added")
+    print(artists_removed, "artist(s) removed")
 
-    return non_uploaded_artists, remove_of_muspy
+    return non_uploaded_artists, remove_of_muspy, sync_state
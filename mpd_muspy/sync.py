@@ -2,183 +2,312 @@
 # Author: Anthony Ruhier
 
 import appdirs
+import importlib.util
 import os
-import mpd
-import multiprocessing
-from multiprocessing.managers import BaseManager
+import threading
+from collections import Counter
 from . import _release_name
-from .artist_db import Artist_db
+from .artist_db import Artist_db, Db_saver, convert_db
+from .artist_db_sqlite import Artist_db_sqlite
+from .metrics import metrics
+from .mpd_pool import Mpd_pool
 from .muspy_api import Muspy_api
-from .presync import presync
-from .tools import chunks, get_config
+from .presync import presync, update_muspy_fingerprint
+from .tools import get_config
+from .workers import Work_queue
 
 config = get_config()
 from config import ARTISTS_JSON
+try:
+    from config import ARTISTS_DB_BACKEND
+except:
+    ARTISTS_DB_BACKEND = "json"
+try:
+    from config import ARTISTS_SQLITE
+except:
+    ARTISTS_SQLITE = "artists.sqlite"
+try:
+    from config import ARTISTS_BINARY
+except:
+    ARTISTS_BINARY = "artists.bin"
+try:
+    from config import MUSPY_WORKERS
+except:
+    MUSPY_WORKERS = 5
+try:
+    from config import MUSPY_ASYNC
+except:
+    MUSPY_ASYNC = True
+try:
+    from config import SYNC_PIPELINE
+except:
+    SYNC_PIPELINE = True
+try:
+    from config import METRICS_JSON
+except:
+    METRICS_JSON = os.path.join(appdirs.user_data_dir(_release_name),
+                                "metrics.json")
+try:
+    from config import METRICS_PROMETHEUS
+except:
+    METRICS_PROMETHEUS = None
 
 ARTISTS_JSON = os.path.join(
     appdirs.user_data_dir(_release_name), ARTISTS_JSON
 )
-NB_MULTIPROCESS = 5
+ARTISTS_SQLITE = os.path.join(
+    appdirs.user_data_dir(_release_name), ARTISTS_SQLITE
+)
+ARTISTS_BINARY = os.path.join(
+    appdirs.user_data_dir(_release_name), ARTISTS_BINARY
+)
 
 
-class SyncManager(BaseManager):
-    pass
+def add_artist(artist):
+    """
+    Task of the workers of start_pool_add()
 
+    Add an artist on muspy. It is marked as uploaded in the artists database
+    by the process owning it.
 
-SyncManager.register('Artist_db', Artist_db)
-SyncManager.register('MPDClient', mpd.MPDClient)
+    :param artist: artist to upload, with its musicbrainz id
+    :type artist: dict
+    :returns (name, error, stats): artist name, error message, and requests
+        and connections to muspy of this task
+    """
+    muspy_api = Muspy_api()
+    stats = muspy_api.connection_stats()
+    error = ""
+    try:
+        if "mbid" in artist.keys():
+            muspy_api.add_artist_mbid(artist["mbid"])
+        else:
+            error = "Doesn't have a musicbrainz ID"
+    except Exception as e:
+        error = "Error: " + str(e)
+    return artist["name"], error, muspy_api.connection_stats() - stats
 
 
-def process_add_artists(artists, artists_nb, artist_db, lock, error_nb,
-                        counter):
+def del_artist(artist):
     """
-    Function launched by each process to add artists on muspy
+    Task of the workers of start_pool_del()
 
-    Add artists on muspy and marks it in the artists database.
+    Remove an artist of muspy.
 
-    :param artists: list of artists split for this process
-    :type artists: list
-    :param artists_nb: total artists to upload. Different of len(artists), here
-                       it is the total number of artists of all processes.
-    :type artists_nb: int
-    :param artist_db: database of artists, in the shared memory
-    :type artist_db: SyncManager.Artist_db()
-    :param lock: lock shared between the processes
-    :type lock: multiprocessing.Lock
-    :param counter: integer in the shared memory
-    :type counter: multiprocessing.Value("i")
+    :param artist: artist name and musicbrainz id
+    :type artist: tuple
+    :returns (name, error, stats): artist name, error message, and requests
+        and connections to muspy of this task
     """
     muspy_api = Muspy_api()
-    for artist in artists:
-        error = ""
-        try:
-            if "mbid" in artist.keys():
-                muspy_api.add_artist_mbid(artist["mbid"])
-                with lock:
-                    artist_db.mark_as_uploaded(artist["name"])
-                    artist_db.save()
-            else:
-                error = "Doesn't have a musicbrainz ID"
-                with lock:
-                    error_nb.value += 1
-        except Exception as e:
-            error = "Error: " + str(e)
-            with lock:
-                error_nb.value += 1
-        finally:
-            with lock:
-                counter.value += 1
-            print("[", counter.value, "/", artists_nb, "]:",
-                  artist["name"].title())
-            if error:
-                print(error)
+    stats = muspy_api.connection_stats()
+    error = ""
+    try:
+        muspy_api.del_artist_mbid(artist[1])
+    except Exception as e:
+        error = "Error: " + str(e)
+    return artist[0], error, muspy_api.connection_stats() - stats
+
 
+def print_connection_stats(stats):
+    """
+    Print the number of requests sent to muspy, and of connections opened for
+    them
 
-def process_del_artists(artists, artists_nb, lock, error_nb, counter):
+    :param stats: results of add_artist or del_artist
+    :type stats: Counter
     """
-    Function launched by each process to add artists on muspy
+    print("Muspy:", stats["requests"], "request(s) over",
+          stats["connections"], "connection(s)")
 
-    Add artists on muspy and marks it in the artists database.
 
-    :param artists: list of artists split for this process
-    :type artists: list
-    :param artists_nb: total artists to upload. Different of len(artists), here
-                       it is the total number of artists of all processes.
-    :type artists_nb: int
-    :param artist_db: database of artists, in the shared memory
-    :type artist_db: SyncManager.Artist_db()
-    :param lock: lock shared between the processes
-    :type lock: multiprocessing.Lock
-    :param counter: integer in the shared memory
-    :type counter: multiprocessing.Value("i")
+def import_muspy_async():
     """
-    muspy_api = Muspy_api()
-    for artist in artists:
-        error = ""
-        try:
-            muspy_api.del_artist_mbid(artist[1])
-        except Exception as e:
-            error = "Error: " + str(e)
-            with lock:
-                error_nb.value += 1
-        finally:
-            with lock:
-                counter.value += 1
-            print("[", counter.value, "/", artists_nb, "]:",
-                  artist[0].title())
-            if error:
-                print(error)
+    Import the asynchronous muspy client, if it is enabled
 
+    :returns module: the muspy_async module, or None if it is disabled or
+        aiohttp is not installed
+    """
+    if not MUSPY_ASYNC:
+        return None
+    try:
+        from . import muspy_async
+    except ImportError:
+        print("aiohttp is not installed, using processes to reach muspy")
+        return None
+    return muspy_async
 
-def start_pool_del(remove_of_muspy):
+
+class Lazy_upload_stream():
     """
-    Initialize the synchronization in several process to remove of muspy
+    Upload stream started with the first artist to upload
 
-    :param non_uploaded_artists: list of artists name to upload
-    :type non_uploaded_artists: list
-    :param artist_db: Artist_db() object in the shared memory
-    :type artist_db: SyncManager.Artist_db
+    The asynchronous muspy client, and its event loop, are only loaded if
+    something has to be uploaded. See muspy_async.Upload_stream.
     """
-    manager = multiprocessing.Manager()
-    lock = manager.Lock()
-    error = manager.Value("i", 0)
-    counter = manager.Value("i", 0)
-    artists_nb = len(remove_of_muspy)
-    artists_nb_by_split = int(artists_nb / NB_MULTIPROCESS)
-    pool = multiprocessing.Pool()
+    def __init__(self, artist_db, db_lock=None):
+        """
+        :param artist_db: database of artists
+        :param db_lock: lock to hold when writing the database
+        :type db_lock: threading.Lock
+        """
+        self._artist_db = artist_db
+        self._db_lock = db_lock
+        self._stream = None
 
-    try:
-        for l in chunks(remove_of_muspy, artists_nb_by_split):
-            pool.apply_async(
-                process_del_artists,
-                kwds={"artists": l, "artists_nb": artists_nb,
-                      "lock": lock, "error_nb": error,
-                      "counter": counter}
-            )
-        pool.close()
-    except Exception as e:
-        pool.terminate()
-        raise e
-    finally:
-        pool.join()
-    return error.value
+    @property
+    def total(self):
+        return self._stream.total if self._stream is not None else 0
+
+    def put(self, artist):
+        """
+        Queue an artist to upload, see muspy_async.Upload_stream.put()
+        """
+        if self._stream is None:
+            from .muspy_async import Upload_stream
+            self._stream = Upload_stream(self._artist_db, self._db_lock)
+        self._stream.put(artist)
+
+    def close(self):
+        """
+        Wait until all queued artists are uploaded
+
+        :returns (errors, stats): number of artists which failed to be
+            uploaded, and requests and connections to muspy
+        """
+        if self._stream is None:
+            return 0, Counter()
+        return self._stream.close()
+
+
+def open_upload_stream(artist_db, db_lock=None):
+    """
+    Start uploading the artists on muspy as soon as their musicbrainz id is
+    found, if SYNC_PIPELINE is enabled
+
+    :param artist_db: database of artists
+    :param db_lock: lock to hold when writing the database
+    :type db_lock: threading.Lock
+    :returns uploader: Lazy_upload_stream object, or None if the artists
+        have to be uploaded after the presync
+    """
+    if not (SYNC_PIPELINE and MUSPY_ASYNC):
+        return None
+    # Checked without importing it, which is only done to upload artists
+    if importlib.util.find_spec("aiohttp") is None:
+        print("aiohttp is not installed, using processes to reach muspy")
+        return None
+    return Lazy_upload_stream(artist_db, db_lock)
 
 
-def start_pool_add(non_uploaded_artists, artist_db):
+@metrics.timed_phase("start_pool_del")
+def start_pool_del(remove_of_muspy, workers=MUSPY_WORKERS):
+    """
+    Initialize the synchronization in several process to remove of muspy
+
+    With MUSPY_ASYNC, the requests are sent concurrently by an event loop in
+    this process instead.
+
+    :param remove_of_muspy: list of artists name and musicbrainz id to remove
+    :type remove_of_muspy: list
+    :param workers: number of processes, 0 to remove them one by one in this
+        process
+    :type workers: int
+    :returns error: number of artists which failed to be removed
+    """
+    muspy_async = import_muspy_async() if workers else None
+    if muspy_async is not None:
+        error, stats = muspy_async.del_artists(remove_of_muspy)
+    else:
+        work_queue = Work_queue(workers)
+        error, stats = work_queue.run(del_artist, remove_of_muspy)
+        work_queue.print_utilisation()
+    print_connection_stats(stats)
+    return error
+
+
+@metrics.timed_phase("start_pool_add")
+def start_pool_add(non_uploaded_artists, artist_db, workers=MUSPY_WORKERS):
     """
     Initialize the synchronization in several process to add artist on muspy
 
-    :param non_uploaded_artists: list of artists name to upload
+    With MUSPY_ASYNC, the requests are sent concurrently by an event loop in
+    this process instead. In both cases, the database is only updated by this
+    process.
+
+    :param non_uploaded_artists: list of artists to upload, with their
+        musicbrainz id
     :type non_uploaded_artists: list
-    :param artist_db: Artist_db() object in the shared memory
-    :type artist_db: SyncManager.Artist_db
+    :param artist_db: database of artists
+    :param workers: number of processes, 0 to upload them one by one in this
+        process
+    :type workers: int
+    :returns error: number of artists which failed to be uploaded
+    """
+    muspy_async = import_muspy_async() if workers else None
+    if muspy_async is not None:
+        error, stats = muspy_async.add_artists(non_uploaded_artists,
+                                               artist_db)
+    else:
+        db_saver = Db_saver(artist_db)
+
+        def on_result(result):
+            if not result[1]:
+                db_saver.update("mark_as_uploaded", result[0])
+
+        work_queue = Work_queue(workers)
+        try:
+            error, stats = work_queue.run(add_artist, non_uploaded_artists,
+                                          on_result)
+        finally:
+            db_saver.save()
+        work_queue.print_utilisation()
+    print_connection_stats(stats)
+    return error
+
+
+def export_metrics(success=True):
     """
-    manager = multiprocessing.Manager()
-    lock = manager.Lock()
-    error = manager.Value("i", 0)
-    counter = manager.Value("i", 0)
-    artists_nb = len(non_uploaded_artists)
-    artists_nb_by_split = int(artists_nb / NB_MULTIPROCESS)
-    pool = multiprocessing.Pool()
+    Write the metrics of the synchronization in METRICS_JSON and
+    METRICS_PROMETHEUS, if they are set
 
+    :param success: if the synchronization succeeded
+    """
     try:
-        for l in chunks(non_uploaded_artists, artists_nb_by_split):
-            pool.apply_async(
-                process_add_artists,
-                kwds={"artists": l, "artists_nb": artists_nb,
-                      "artist_db": artist_db, "lock": lock, "error_nb": error,
-                      "counter": counter}
-            )
-        pool.close()
-        pool.join()
-    except Exception as e:
-        pool.terminate()
-        pool.join()
-        raise e
-    return error.value
+        metrics.export(METRICS_JSON, METRICS_PROMETHEUS, success)
+    except OSError as e:
+        print("Cannot write the metrics:", e)
+
+
+def open_artist_db(clean=False):
+    """
+    Open the artists database with the backend selected in the configuration
+
+    The database is owned by this process: the workers send their results
+    back instead of writing it.
 
+    :param clean: drop the content of the database
+    :type clean: boolean
+    """
+    artists = {} if clean else None
+    if ARTISTS_DB_BACKEND == "sqlite":
+        return Artist_db_sqlite(ARTISTS_SQLITE, artists=artists,
+                                jsonpath=ARTISTS_JSON)
+    binary = ARTISTS_DB_BACKEND == "binary"
+    path, other_path = ARTISTS_JSON, ARTISTS_BINARY
+    if binary:
+        path, other_path = other_path, path
+    if (not clean and not os.path.exists(path) and
+            os.path.exists(other_path)):
+        print("Converting the database to", path, "...")
+        convert_db(other_path, path, binary)
+    artist_db = Artist_db(jsonpath=path, artists=artists, binary=binary)
+    if clean:
+        artist_db.save()
+    return artist_db
 
-def run(clean=False):
+
+def run(clean=False, force=False, retry_lookups=False):
     """
     Run synchronization. If clean parameter is specified, remove everything in
     the current database, to start on a clean one.
@@ -186,35 +315,71 @@ def run(clean=False):
     :param clean: boolean about if starting a clean synchronization (drop the
         db) or not.
     :type clean: boolean
+    :param force: synchronize everything, even if mpd and the muspy account
+        did not change since the last synchronization
+    :type force: boolean
+    :param retry_lookups: search on musicbrainz all the artists without id,
+        even the ones which recently failed to be found
+    :type retry_lookups: boolean
     """
-    process_manager = SyncManager()
-    process_manager.start()
-    if clean:
-        artist_db = process_manager.Artist_db(
-            jsonpath=ARTISTS_JSON, artists={})
+    metrics.reset()
+    artist_db = open_artist_db(clean)
+    if retry_lookups:
+        artist_db.reset_lookups()
         artist_db.save()
-    else:
-        artist_db = process_manager.Artist_db(jsonpath=ARTISTS_JSON)
-    mpdclient = process_manager.MPDClient()
+    # Each process opens its own connections to MPD
+    mpdclient = Mpd_pool()
+    # Written by the uploader thread and by this one
+    db_lock = threading.Lock() if artist_db.needs_lock() else None
+    uploader = open_upload_stream(artist_db, db_lock)
     try:
-        non_uploaded_artists, remove_of_muspy = presync(artist_db, mpdclient)
+        non_uploaded_artists, remove_of_muspy, sync_state = presync(
+            artist_db, mpdclient, force, uploader, db_lock
+        )
 
-        print("\n   Start syncing\n =================\n")
-        error = start_pool_add(non_uploaded_artists, artist_db)
+        error = 0
+        if uploader is not None:
+            # Waits for the artists found by the presync to be uploaded too
+            with metrics.phase("upload_stream"):
+                for artist in non_uploaded_artists:
+                    uploader.put(artist)
+                error, stats = uploader.close()
+            if uploader.total:
+                print_connection_stats(stats)
+            non_uploaded_nb = uploader.total
+        else:
+            non_uploaded_nb = len(non_uploaded_artists)
+            if non_uploaded_artists:
+                print("\n   Start syncing\n =================\n")
+                error = start_pool_add(non_uploaded_artists, artist_db)
     except Exception as e:
-        artist_db.save()
+        if uploader is not None:
+            uploader.close()
+        artist_db.close()
+        mpdclient.close()
+        export_metrics(success=False)
         raise e
+    mpdclient.close()
 
     if len(remove_of_muspy):
         print("\nRemoving of Muspy artists who do not exist in mpd "
               "anymore...\n")
         error += start_pool_del(remove_of_muspy)
     msg = ("Done: " +
-           str(len(non_uploaded_artists) + len(remove_of_muspy) -
-               len(artist_db.get_artists(uploaded=False))) +
+           str(non_uploaded_nb + len(remove_of_muspy) -
+               artist_db.count_artists(uploaded=False)) +
            " artist(s) updated")
     if error:
         msg += " with " + str(error) + " errors"
+    if not (non_uploaded_nb or remove_of_muspy):
+        msg = "Done: nothing to synchronize"
     print()
     print(msg)
-    process_manager.shutdown()
+    # Saved with the database, to skip the next synchronization if nothing
+    # changes
+    update_muspy_fingerprint(sync_state, error,
+                             non_uploaded_nb or remove_of_muspy)
+    for key, value in sync_state.items():
+        artist_db.set_meta(key, value)
+    artist_db.close()
+    export_metrics()
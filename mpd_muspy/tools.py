@@ -1,16 +1,40 @@
 
 import appdirs
-from importlib.machinery import SourceFileLoader
+import importlib.util
+import itertools
 import mpd
-import musicbrainzngs
 import os
+import re
+import sys
+import unicodedata
 
-from . import _release_name, _version
+from . import _release_name
 from .exceptions import ArtistNotFoundException
 
+#: configuration module, loaded by get_config()
+_config = None
+
 
 def get_config():
-    return SourceFileLoader("config", get_config_path()).load_module()
+    """
+    Load the configuration file, once by process
+
+    It is registered as the "config" module, so every module can import its
+    options with `from config import OPTION`.
+    """
+    global _config
+    if _config is None:
+        spec = importlib.util.spec_from_file_location("config",
+                                                      get_config_path())
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["config"] = module
+        try:
+            spec.loader.exec_module(module)
+        except BaseException:
+            del sys.modules["config"]
+            raise
+        _config = module
+    return _config
 
 
 def get_config_path():
@@ -30,25 +54,39 @@ def get_config_path():
 
 
 config = get_config()
-from config import SERVER, PORT
 try:
     from config import USE_ALBUMARTIST
 except:
     USE_ALBUMARTIST = False
+try:
+    from config import MUSICBRAINZ_CANDIDATES
+except:
+    MUSICBRAINZ_CANDIDATES = 5
+try:
+    from config import MUSICBRAINZ_MAX_BROWSE_REQUESTS
+except:
+    MUSICBRAINZ_MAX_BROWSE_REQUESTS = 8
 
-musicbrainzngs.set_useragent(_release_name, _version)
+#: albums of each artist of the mpd database, filled by mpd_iter_artists()
+_mpd_albums = dict()
 
+#: offline index of musicbrainz, opened by get_offline_index(). False until
+#: it is opened.
+_offline_index = False
 
-def chunks(l, n):
-    """
-    Yield successive n-sized chunks from l.
+#: musicbrainz ids are UUIDs. Some taggers join multiple ids in one value with
+#: "/" or ";", so extract them instead of trusting the tag value as is
+MBID_REGEX = re.compile(
+    r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}",
+    re.IGNORECASE
+)
 
-    :param l: list to split
-    :param n: number of elements wanted in each list split
-    """
-    n = 1 if n <= 0 else n
-    for i in range(0, len(l), n):
-        yield l[i:i+n]
+#: edition details at the end of an album title, like " (Remastered)" or
+#: " [Deluxe Edition]"
+TITLE_SUFFIX_REGEX = re.compile(r"(\s*[(\[][^()\[\]]*[)\]])+\s*$")
+
+#: number of release groups by page when browsing musicbrainz (maximum 100)
+BROWSE_PAGE_SIZE = 100
 
 
 def del_chars_from_string(s, chars_to_del):
@@ -66,86 +104,306 @@ def del_chars_from_string(s, chars_to_del):
     return s
 
 
-def mpd_get_artists(mpdclient):
+def normalize_name(name):
+    """
+    Normalize a name to compare it with others written differently
+
+    Unicode compatibility characters are replaced, the case is folded and the
+    whitespaces are collapsed.
+
+    :param name: name to normalize
+    """
+    return " ".join(unicodedata.normalize("NFKC", name).casefold().split())
+
+
+def normalize_title(title):
     """
-    Get artists from MPD
+    Normalize an album title to compare it with the release groups of
+    musicbrainz
 
-    :param mpdclient: connection with MPD
-    :type mpdclient: mpd.MPDClient()
+    The edition details are removed, see TITLE_SUFFIX_REGEX, unless the title
+    is only made of them.
+
+    :param title: album title to normalize
     """
-    mpdclient.connect(SERVER, PORT)
+    return (normalize_name(TITLE_SUFFIX_REGEX.sub("", title)) or
+            normalize_name(title))
+
+
+def mpd_iter_artists(mpdclient, keep_albums=None):
+    """
+    Yield the artists of MPD while its response is received
+
+    The names are normalized (lowercased) on the fly. The artists are grouped
+    by MPD, so an artist is yielded once, unless several names have the same
+    normalized name.
+
+    The albums of every artist are fetched in the same request, and kept in
+    memory for get_mpd_albums(), once the response is fully read.
+
+    :param mpdclient: connections with MPD
+    :type mpdclient: Mpd_pool or mpd.MPDClient()
+    :param keep_albums: function telling if the albums of an artist will be
+        needed, like for the artists without musicbrainz id. Every album is
+        kept if None.
+    :type keep_albums: function
+    """
+    global _mpd_albums
     tag_field = "albumartist" if USE_ALBUMARTIST else "artist"
-    artists = set()
+    # mpd.MPDClient reads the whole response at once
+    stream = getattr(mpdclient, "stream", None)
+    if not callable(stream):
+        def stream(command, *args):
+            return getattr(mpdclient, command)(*args)
+
+    artists_albums = dict()
+    previous = None
     try:
-        for entry in mpdclient.list(tag_field):
-            artist = entry[tag_field].lower()
-            if artist:
-                artists.add(artist)
-    except mpd.ConnectionError:
-        mpdclient.connect(SERVER, PORT)
-        for entry in mpdclient.list(tag_field):
-            artist = entry[tag_field].lower()
-            if artist:
-                artists.add(artist)
-    return artists
+        entries = iter(stream("list", "album", "group", tag_field))
+        # "group" is only supported since MPD 0.21, which fails before the
+        # first entry
+        entries = itertools.chain((next(entries), ), entries)
+    except StopIteration:
+        entries = ()
+    except mpd.CommandError:
+        entries = stream("list", tag_field)
+    for entry in entries:
+        artist = entry.get(tag_field, "")
+        if not artist:
+            continue
+        artist = artist.lower()
+        if artist != previous:
+            previous = artist
+            yield artist
+        if keep_albums is not None and not keep_albums(artist):
+            continue
+        albums = artists_albums.setdefault(artist, set())
+        album = entry.get("album", "")
+        if isinstance(album, str):
+            album = (album, )
+        albums.update(a for a in album if a)
+    _mpd_albums = {artist: tuple(sorted(albums))
+                   for artist, albums in artists_albums.items()}
+
+
+def mpd_get_db_update(mpdclient):
+    """
+    Get the time of the last update of the mpd database
+
+    :param mpdclient: connections with MPD
+    :type mpdclient: Mpd_pool or mpd.MPDClient()
+    :returns db_update: unix timestamp, as a string, or None if unknown
+    """
+    return mpdclient.stats().get("db_update")
+
+
+def mpd_get_mbids(mpdclient):
+    """
+    Get the musicbrainz ids of artists from the tags of the MPD database
+
+    All ids are fetched in one request, grouped by artist. The ids that
+    belong to another artist are discarded (see _mbid_owners()), and an
+    artist is resolved only if one id remains. Otherwise, like for
+    collaborations or conflicting tags, it is left to the musicbrainz search.
+
+    :param mpdclient: connections with MPD
+    :type mpdclient: Mpd_pool or mpd.MPDClient()
+    :returns mbids: dict of artist name: musicbrainz id
+    """
+    tag_field = "albumartist" if USE_ALBUMARTIST else "artist"
+    mbid_field = "musicbrainz_" + tag_field + "id"
+    try:
+        entries = mpdclient.list(mbid_field, "group", tag_field)
+    except mpd.CommandError:
+        # "group" is only supported since MPD 0.21
+        return dict()
+
+    artists_mbids = dict()
+    for entry in entries:
+        names = entry.get(tag_field, "")
+        values = entry.get(mbid_field, "")
+        if isinstance(names, str):
+            names = [names, ]
+        if isinstance(values, str):
+            values = [values, ]
+        mbids = {mbid.lower()
+                 for v in values for mbid in MBID_REGEX.findall(v)}
+        for name in names:
+            if name and mbids:
+                artists_mbids.setdefault(name.lower(), set()).update(mbids)
+
+    owners = _mbid_owners(artists_mbids)
+    resolved = dict()
+    for artist, mbids in artists_mbids.items():
+        mbids = {mbid for mbid in mbids
+                 if owners.get(mbid, artist) == artist}
+        if len(mbids) == 1:
+            resolved[artist] = next(iter(mbids))
+    return resolved
+
+
+def _mbid_owners(artists_mbids):
+    """
+    Find the artist owning each musicbrainz id of the mpd tags
+
+    An id tagged alone on an artist belongs to it. When several artists are
+    tagged alone with the same id, like "b" and the collaboration "a feat. b"
+    tagged only with the id of b, it belongs to the one whose name is in the
+    names of the others. If there is none, the id belongs to nobody.
+
+    :param artists_mbids: dict of artist name: set of musicbrainz ids
+    :returns owners: dict of musicbrainz id: artist name, or None if the id
+        is owned by several artists. The ids which are never tagged alone
+        are missing.
+    """
+    tagged_alone = dict()
+    for artist, mbids in artists_mbids.items():
+        if len(mbids) == 1:
+            tagged_alone.setdefault(next(iter(mbids)), []).append(artist)
+
+    owners = dict()
+    for mbid, artists in tagged_alone.items():
+        candidates = [
+            a for a in artists
+            if all((" " + a + " ") in (" " + other + " ") for other in artists)
+        ]
+        owners[mbid] = candidates[0] if len(candidates) == 1 else None
+    return owners
 
 
 def get_mpd_albums(artist, mpdclient):
     """
     Get list of albums in the mpd database for an artist
 
+    The albums fetched by mpd_iter_artists() are used if the artist is known,
+    otherwise MPD is queried.
+
     :param artist: artist name to filter
-    :param mpdclient: connector with the mpd server
-    :type mpdclient: mpd.MPDClient()
+    :param mpdclient: connections with the mpd server
+    :type mpdclient: Mpd_pool or mpd.MPDClient()
     """
     try:
-        mpdclient.status()
-    except mpd.ConnectionError:
-        mpdclient.connect(SERVER, PORT)
+        return list(_mpd_albums[artist])
+    except KeyError:
+        pass
     # The mpd module is using case sensitive filters in list(). Artist has to
     # be spelled correctly
     tag_field = "albumartist" if USE_ALBUMARTIST else "artist"
     try:
-        artist_cs = mpdclient.search(tag_field, artist)[0]["artist"]
+        artist_cs = mpdclient.search(tag_field, artist)[0][tag_field]
     except IndexError:
         raise ArtistNotFoundException("Artist is not in the mpd database")
-    return mpdclient.list("album", tag_field, artist_cs)
+    return [a["album"] if isinstance(a, dict) else a
+            for a in mpdclient.list("album", tag_field, artist_cs)]
+
 
+def get_known_mpd_albums(artists):
+    """
+    Get the albums fetched by mpd_iter_artists() for a list of artists
 
-def get_mbid(artist, mpdclient):
+    :param artists: artist names
+    :returns albums: dict of artist name: albums, for the known artists
+    """
+    return {a: _mpd_albums[a] for a in artists if a in _mpd_albums}
+
+
+def match_candidates(candidates, albums,
+                     max_requests=MUSICBRAINZ_MAX_BROWSE_REQUESTS):
+    """
+    Choose the candidate artist who released the most albums of a list
+
+    The release groups of each candidate are browsed on musicbrainz, page by
+    page, and their titles are compared with the albums. Candidates are
+    checked in order, which also breaks the ties, and the search stops as soon
+    as one released all the albums.
+
+    :param candidates: musicbrainz ids of the candidates, best ones first
+    :type candidates: list
+    :param albums: titles of the albums of the artist
+    :type albums: list
+    :param max_requests: maximum number of requests sent to musicbrainz
+    :returns mbid: id of the best candidate, or None if no album matched
+    """
+    from .musicbrainz import browse_release_groups
+    titles = {normalize_title(album) for album in albums}
+    titles.discard("")
+    best_mbid, best_score = None, 0
+    requests = 0
+    for mbid in candidates:
+        matched = set()
+        offset = 0
+        while requests < max_requests and len(matched) < len(titles):
+            requests += 1
+            result = browse_release_groups(mbid, BROWSE_PAGE_SIZE, offset)
+            release_groups = result["release-group-list"]
+            matched.update(titles.intersection(
+                normalize_title(rg["title"]) for rg in release_groups
+            ))
+            offset += len(release_groups)
+            if (not release_groups or
+                    offset >= result.get("release-group-count", 0)):
+                break
+        if len(matched) > best_score:
+            best_mbid, best_score = mbid, len(matched)
+        if best_score == len(titles) or requests >= max_requests:
+            break
+    return best_mbid
+
+
+def get_offline_index():
+    """
+    Get the offline index of musicbrainz of this process, see mb_index
+
+    :returns index: Artist_index, or None if it was not built
+    """
+    global _offline_index
+    if _offline_index is False:
+        from .mb_index import open_index
+        _offline_index = open_index()
+    return _offline_index
+
+
+def get_mbid(artist, mpdclient, albums=None, refresh=False):
     """
     Get the musicbrainz id of an artist
 
-    Search the artist id from the album we have in the mpd database to be
-    almost sure the result is good.
+    When several artists have this name, the one who released the albums of
+    the mpd database is chosen, to be almost sure the result is good.
+
+    The offline index is used first, if it was built. Musicbrainz is only
+    searched for the names it cannot resolve.
 
     :param artist: artist name to get the id
+    :param mpdclient: connector with the mpd server
+    :param albums: albums of the artist in the mpd database. Fetched with
+        get_mpd_albums() if None.
+    :type albums: list
+    :param refresh: search musicbrainz again instead of using the cached
+        response, when a previous search failed
+    :type refresh: bool
     """
+    index = get_offline_index()
+    if index is not None:
+        candidates = index.lookup(artist)
+        if len(candidates) > 1 and albums is None:
+            albums = get_mpd_albums(artist, mpdclient)
+        mbid = index.choose_candidate(candidates, albums or ())
+        if mbid is not None:
+            return mbid
+
+    from .musicbrainz import search_artists
     ignore_chars = ["/", "\\", "!", "?"]
     LIMIT_NB_ARTIST = 15
-    result = musicbrainzngs.search_artists(
+    result = search_artists(
         del_chars_from_string(artist, ignore_chars),
-        LIMIT_NB_ARTIST)
+        LIMIT_NB_ARTIST, refresh=refresh)
     if result["artist-count"] == 0:
         raise ArtistNotFoundException("Artist not found")
     artists_prop = [a["id"] for a in result["artist-list"]]
     if result["artist-count"] == 1:
         return artists_prop[0]
 
-    # Tries to get the artist id of one of our album of this artist
-    albums = get_mpd_albums(artist, mpdclient)
-    # We don't want to test all choices returned by musicbrainz for an album,
-    # so we will keep only the LIMIT_NB_ALBUM'th first ones.
-    LIMIT_NB_ALBUM = 10
-    for album in albums:
-        try:
-            result = musicbrainzngs.search_releases(
-                del_chars_from_string(album, ignore_chars),
-                limit=LIMIT_NB_ALBUM)["release-list"]
-            for i in result:
-                artist_id = i["artist-credit"][0]["artist"]["id"]
-                if artist_id in artists_prop:
-                    return artist_id
-        except:
-            pass
-    return artists_prop[0]
+    if albums is None:
+        albums = get_mpd_albums(artist, mpdclient)
+    mbid = match_candidates(artists_prop[:MUSICBRAINZ_CANDIDATES], albums)
+    return mbid if mbid is not None else artists_prop[0]
@@ -0,0 +1,208 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+import functools
+import os
+import time
+from collections import Counter
+from .metrics import metrics
+from .tools import get_config
+
+config = get_config()
+try:
+    from config import WORKERS_START_METHOD
+except:
+    WORKERS_START_METHOD = "forkserver"
+
+#: modules imported once by the fork server, before it forks the workers
+PRELOAD = ["mpd_muspy.presync", "mpd_muspy.musicbrainz", "mpd_muspy.sync"]
+
+#: objects shared by the tasks of a worker, set by init_worker()
+_context = dict()
+
+#: multiprocessing context of the workers, set by get_mp_context()
+_mp_context = None
+
+
+def get_mp_context():
+    """
+    Get the multiprocessing context used to start the workers
+
+    With the "forkserver" method, the workers are forked from a server
+    process which imported the modules of the tasks once, instead of from
+    the main process with its threads and connections.
+
+    :returns context: multiprocessing context of WORKERS_START_METHOD, or the
+        default one if this method is not available
+    """
+    global _mp_context
+    if _mp_context is None:
+        # Only imported when workers are started, not by the
+        # synchronizations with nothing to do
+        import multiprocessing
+        try:
+            _mp_context = multiprocessing.get_context(WORKERS_START_METHOD)
+        except ValueError:
+            _mp_context = multiprocessing.get_context()
+        if _mp_context.get_start_method() == "forkserver":
+            _mp_context.set_forkserver_preload(PRELOAD)
+    return _mp_context
+
+
+def init_worker(context, initializer=None, initargs=(), in_worker=True):
+    """
+    Initializer of the workers of a Work_queue
+
+    :param context: objects used by the tasks, see get_context()
+    :type context: dict
+    :param initializer: function to call at the start of the worker
+    :param initargs: arguments of initializer
+    :param in_worker: if False, the tasks run in the current process
+    """
+    _context.clear()
+    _context.update(context)
+    if in_worker:
+        # Only the metrics of the tasks of this worker are sent back, not the
+        # ones inherited from the parent process
+        metrics.reset()
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def get_context(key):
+    """
+    Get an object of the worker context
+
+    :param key: name of the object, given in the context of the Work_queue
+    """
+    return _context[key]
+
+
+def print_progress(done, total, name, error="", stage=None):
+    """
+    Print the progression of a task
+
+    :param done: number of items processed
+    :param total: total number of items
+    :param name: name of the processed item
+    :param error: error message of the item, if it failed
+    :param stage: name of the stage, when several ones run at the same time
+    """
+    if stage is not None:
+        print(stage, "[", done, "/", total, "]:", name.title())
+    else:
+        print("[", done, "/", total, "]:", name.title())
+    if error:
+        print(error)
+
+
+def _timed_call(func, item, send_metrics=False):
+    """
+    Call a task and measure how long it kept the worker busy
+
+    :param send_metrics: return the metrics recorded by the task, to merge
+        them in the parent process
+    """
+    start = time.monotonic()
+    result = func(item)
+    snapshot = metrics.take() if send_metrics else None
+    return os.getpid(), time.monotonic() - start, result, snapshot
+
+
+class Work_queue():
+    """
+    Distribute tasks to a pool of workers, one item at a time
+
+    Workers take the next item of the queue as soon as they are done with the
+    previous one, so a worker stuck with slow items does not leave the others
+    idle.
+
+    Tasks take one item and return a tuple starting with (name, error, stats):
+    the name of the item, an error message (empty if none) and a Counter of
+    statistics.
+    """
+    def __init__(self, workers, context=None, initializer=None,
+                 initargs=()):
+        """
+        :param workers: number of processes. With 0, the tasks are run in the
+            current process.
+        :type workers: int
+        :param context: objects used by the tasks, see get_context()
+        :type context: dict
+        :param initializer: function to call at the start of each process
+        :param initargs: arguments of initializer
+        """
+        self.workers = workers
+        self.context = context or dict()
+        self.initializer = initializer
+        self.initargs = initargs
+        self.processes = 0
+        self.busy = Counter()
+        self.tasks = Counter()
+        self.elapsed = 0
+
+    def _imap(self, func, items):
+        """
+        Yield the results of func on each item, as they are done
+        """
+        if not self.workers:
+            init_worker(self.context, in_worker=False)
+            yield from map(functools.partial(_timed_call, func), items)
+            return
+        task = functools.partial(_timed_call, func, send_metrics=True)
+        processes = min(self.workers, len(items))
+        self.processes = max(self.processes, processes)
+        with get_mp_context().Pool(
+            processes=processes, initializer=init_worker,
+            initargs=(self.context, self.initializer, self.initargs)
+        ) as pool:
+            yield from pool.imap_unordered(task, items, chunksize=1)
+
+    def run(self, func, items, on_result=None):
+        """
+        Run a task on each item, and print the progression
+
+        :param func: task, taking an item. Has to be a module-level function
+            to be sent to the workers.
+        :param items: items to process
+        :type items: list
+        :param on_result: function called in this process with the result of
+            each task, as soon as it is done
+        :returns (errors, stats): number of failed tasks, and the sum of the
+            stats returned by the tasks
+        """
+        errors = 0
+        stats = Counter()
+        start = time.monotonic()
+        metrics.queue_depth(func.__name__, len(items))
+        for done, (pid, busy, result, snapshot) in enumerate(
+                self._imap(func, items), 1):
+            name, error, task_stats = result[:3]
+            if snapshot is not None:
+                metrics.merge(snapshot)
+            if on_result is not None:
+                on_result(result)
+            self.busy[pid] += busy
+            self.tasks[pid] += 1
+            stats += task_stats
+            print_progress(done, len(items), name, error)
+            if error:
+                errors += 1
+        self.elapsed += time.monotonic() - start
+        return errors, stats
+
+    def print_utilisation(self):
+        """
+        Print the share of time each worker spent running tasks
+        """
+        if not (self.processes and self.elapsed):
+            return
+        workers = [
+            "{:.0%} ({} task(s))".format(self.busy[pid] / self.elapsed,
+                                         self.tasks[pid])
+            for pid in sorted(self.busy, key=self.busy.get, reverse=True)
+        ]
+        workers += ["0%"] * (self.processes - len(workers))
+        print("{} worker(s) in {:.1f}s, busy: {}".format(
+            self.processes, self.elapsed, ", ".join(workers)
+        ))
@@ -29,8 +29,8 @@ setup(
     keywords="mpd",
     packages=["mpd_muspy", ],
     install_requires=[
-        "appdirs", "argparse", "python-mpd2", "musicbrainzngs", "requests",
-        "urllib3"
+        "aiohttp", "appdirs", "argparse", "python-mpd2", "musicbrainzngs",
+        "requests", "urllib3"
     ],
     entry_points={
         'console_scripts': [
@@ -0,0 +1,28 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+"""
+Tests of mpd_muspy
+
+The modules of mpd_muspy load their configuration when they are imported, so
+a default configuration is written in a temporary directory first, with the
+data and cache directories:
+
+    python -m unittest
+"""
+
+import atexit
+import os
+import shutil
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TMP_DIR = tempfile.mkdtemp(prefix="mpd-muspy-tests-")
+atexit.register(shutil.rmtree, TMP_DIR, True)
+
+for xdg in ("CONFIG", "DATA", "CACHE"):
+    os.environ["XDG_{}_HOME".format(xdg)] = os.path.join(TMP_DIR, xdg.lower())
+os.makedirs(os.path.join(TMP_DIR, "config", "mpd-muspy"))
+shutil.copy(os.path.join(REPO_DIR, "config.py.default"),
+            os.path.join(TMP_DIR, "config", "mpd-muspy", "config.py"))
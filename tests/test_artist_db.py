@@ -0,0 +1,436 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from mpd_muspy import artist_db
+from mpd_muspy.artist_db import Artist_db, convert_db
+from mpd_muspy.artist_db_sqlite import Artist_db_sqlite
+
+MBID = "0383dadf-2a4e-4d10-a46a-e9e041da8eb3"
+
+
+class Backend_scenarios():
+    """
+    Scenarios run against every backend of the artists database
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def open_db(self):
+        raise NotImplementedError
+
+    def reopen(self, db):
+        db.close()
+        return self.open_db()
+
+    def test_merge(self):
+        db = self.open_db()
+        db.add(["Foo", "Bar"])
+        db.mark_as_uploaded("Foo")
+        self.assertEqual(db.merge(["Foo", "Baz", "Qux", "Baz"]), (2, 1))
+        self.assertEqual(sorted(db.get_artists()), ["Baz", "Foo", "Qux"])
+        self.assertEqual(db.get_artists(uploaded=True), ["Foo"])
+        self.assertEqual(db.merge(iter(["Foo", "Baz", "Qux"])), (0, 0))
+        # The temporary table of sqlite is emptied between merges
+        self.assertEqual(db.merge(["Foo"]), (0, 2))
+
+        db = self.reopen(db)
+        self.assertEqual(db.get_artists(), ["Foo"])
+        self.assertEqual(db.count_artists(uploaded=True), 1)
+
+    def test_merge_counts(self):
+        with mock.patch.object(artist_db.config, "IGNORE_LIST", ["Ignored"]):
+            db = self.open_db()
+        db.add(["Foo", "Bar", "ignored"])
+        # The ignored artists are neither added nor removed
+        self.assertEqual(db.merge(["Foo", "Baz", "ignored", "Baz"]), (1, 1))
+        self.assertEqual(db.merge(["Foo", "Baz"]), (0, 0))
+        self.assertEqual(db.merge([]), (0, 2))
+        self.assertEqual(db.merge(["Foo", "Bar"]), (2, 0))
+        self.assertEqual(sorted(db.get_artists()), ["Bar", "Foo"])
+        self.assertEqual(db.count_artists(), 2)
+
+    def test_artists_without_mbid(self):
+        db = self.open_db()
+        db.add(["Foo", "Bar", "Baz", "Qux"])
+        db.set_mbid("Foo", MBID)
+        db.mark_lookup_failed("Bar", "not_found", 3600, 7200)
+        db.mark_lookup_failed("Baz", "error", 0, 0)
+        now = time.time()
+        self.assertEqual(sorted(db.get_artists_without_mbid()),
+                         ["Bar", "Baz", "Qux"])
+        self.assertEqual(sorted(db.get_artists_without_mbid(due=now)),
+                         ["Baz", "Qux"])
+        self.assertEqual(sorted(db.get_artists_without_mbid(failed=True)),
+                         ["Bar", "Baz"])
+        self.assertEqual(db.get_artists_without_mbid(due=now, failed=True),
+                         ["Baz"])
+
+        db = self.reopen(db)
+        self.assertEqual(db.get_artists_without_mbid(due=now, failed=True),
+                         ["Baz"])
+        self.assertEqual(db.get_mbid("Foo"), MBID)
+
+    def test_reset_lookups(self):
+        db = self.open_db()
+        db.add(["Foo", "Bar"])
+        db.mark_lookup_failed("Foo", "not_found", 3600, 7200)
+        db.mark_lookup_failed("Foo", "not_found", 3600, 7200)
+        db.reset_lookups()
+        self.assertEqual(sorted(db.get_artists_without_mbid(due=time.time())),
+                         ["Bar", "Foo"])
+        # The status is kept, only the delay is forgotten
+        self.assertEqual(db.get_artists_without_mbid(failed=True), ["Foo"])
+        artist = db.get_artists(
+            fields=("lookup_status", "lookup_attempts", "next_lookup")
+        )[0]
+        self.assertEqual(artist.get("lookup_status"), "not_found")
+        self.assertFalse(artist.get("lookup_attempts"))
+        self.assertIsNone(artist.get("next_lookup"))
+
+    def test_meta(self):
+        db = self.open_db()
+        self.assertIsNone(db.get_meta("sync_state"))
+        db.add("Foo")
+        db.set_meta("sync_state", {"mpd": [1, 2], "muspy": "abc"})
+        db = self.reopen(db)
+        self.assertEqual(db.get_meta("sync_state"),
+                         {"mpd": [1, 2], "muspy": "abc"})
+        db.set_meta("sync_state", None)
+        db = self.reopen(db)
+        self.assertIsNone(db.get_meta("sync_state"))
+
+
+class Test_json_backend(Backend_scenarios, unittest.TestCase):
+    journal = False
+
+    def open_db(self):
+        db = Artist_db(jsonpath=os.path.join(self.tmp.name, "artists.json"),
+                       journal=self.journal)
+        self.addCleanup(db.close)
+        return db
+
+    def test_migrate_old_json(self):
+        path = os.path.join(self.tmp.name, "artists.json")
+        with open(path, "w") as f:
+            json.dump({"Foo": {"uploaded": True, "mbid": MBID,
+                               "removed_field": 1},
+                       "Bar": {"uploaded": False}}, f)
+        db = self.open_db()
+        self.assertEqual(db.get_artists(uploaded=True), ["Foo"])
+        self.assertEqual(db.get_artists_without_mbid(due=time.time()),
+                         ["Bar"])
+        self.assertEqual(db.get_mbid("Foo"), MBID)
+
+
+class Test_journal_backend(Test_json_backend):
+    journal = True
+
+
+class Test_binary_backend(Backend_scenarios, unittest.TestCase):
+    def open_db(self):
+        db = Artist_db(jsonpath=os.path.join(self.tmp.name, "artists.bin"),
+                       journal=False, binary=True)
+        self.addCleanup(db.close)
+        return db
+
+
+class Test_sqlite_backend(Backend_scenarios, unittest.TestCase):
+    def open_db(self, **kwargs):
+        db = Artist_db_sqlite(os.path.join(self.tmp.name, "artists.sqlite"),
+                              **kwargs)
+        self.addCleanup(db.close)
+        return db
+
+    def test_migrate_old_schema(self):
+        conn = sqlite3.connect(os.path.join(self.tmp.name, "artists.sqlite"))
+        conn.executescript("""
+            CREATE TABLE artists (
+                name TEXT PRIMARY KEY NOT NULL,
+                uploaded INTEGER NOT NULL DEFAULT 0,
+                mbid TEXT,
+                lookup_status TEXT
+            );
+            INSERT INTO artists (name, lookup_status) VALUES ('Foo', 'error');
+        """)
+        conn.close()
+        db = self.open_db()
+        self.assertEqual(db.get_artists_without_mbid(failed=True), ["Foo"])
+        db.mark_lookup_failed("Foo", "error", 3600, 7200)
+        self.assertEqual(db.get_artists_without_mbid(due=time.time()), [])
+        self.assertEqual(db.get_artists(fields=("lookup_attempts", )),
+                         [{"name": "Foo", "lookup_attempts": 1}])
+
+    def test_import_json(self):
+        jsonpath = os.path.join(self.tmp.name, "artists.json")
+        json_db = Artist_db(jsonpath=jsonpath, artists={
+            "Foo": {"uploaded": True, "mbid": MBID},
+            "Bar": {"uploaded": False, "lookup_status": "not_found"},
+        }, journal=False)
+        json_db.close()
+        with mock.patch("builtins.print"):
+            db = self.open_db(jsonpath=jsonpath)
+        self.assertEqual(db.get_artists(uploaded=True), ["Foo"])
+        self.assertEqual(db.get_mbid("Foo"), MBID)
+        self.assertEqual(db.get_artists_without_mbid(failed=True), ["Bar"])
+        # Only imported into a new database
+        db.remove("Bar")
+        db.close()
+        db = self.open_db(jsonpath=jsonpath)
+        self.assertEqual(db.get_artists(), ["Foo"])
+
+
+class Test_indexes(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patcher = mock.patch.object(artist_db.config, "IGNORE_LIST",
+                                    ["Ignored"])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def open_db(self, binary=False, artists=None):
+        name = "artists.bin" if binary else "artists.json"
+        db = Artist_db(jsonpath=os.path.join(self.tmp.name, name),
+                       artists=artists, journal=False, binary=binary)
+        self.addCleanup(db.close)
+        return db
+
+    def assert_indexes(self, db):
+        """
+        Check the indexes kept up to date against the ones built again
+        """
+        indexes = (db._non_uploaded, db._without_mbid, db._ignored)
+        db._build_indexes()
+        self.assertEqual(indexes,
+                         (db._non_uploaded, db._without_mbid, db._ignored))
+
+    def test_updated_by_changes(self):
+        db = self.open_db()
+        db.merge(["Foo", "Bar", "Baz", "ignored"])
+        self.assert_indexes(db)
+        self.assertEqual(list(db._non_uploaded), ["Foo", "Bar", "Baz"])
+        db.set_mbid("Foo", MBID)
+        db.mark_as_uploaded("Foo")
+        db.mark_as_uploaded("Bar")
+        self.assert_indexes(db)
+        self.assertEqual(list(db._non_uploaded), ["Baz"])
+        self.assertEqual(list(db._without_mbid), ["Bar", "Baz"])
+        db.set_mbid("Foo", None)
+        db.mark_as_non_uploaded("Bar")
+        db.merge(["Foo", "Bar", "ignored"])
+        self.assert_indexes(db)
+        self.assertEqual(list(db._non_uploaded), ["Bar"])
+        self.assertEqual(list(db._without_mbid), ["Foo", "Bar"])
+
+    def test_snapshot_loaded(self):
+        self.open_db(binary=True, artists={
+            "Foo": {"uploaded": True, "mbid": MBID},
+            "Bar": {"uploaded": False},
+            "ignored": {"uploaded": False},
+        }).close()
+        db = self.open_db(binary=True)
+        self.assertIsNone(db._records)
+        self.assertEqual(db._ignored, {"ignored"})
+        self.assertEqual(db.get_artists_without_mbid(), ["Bar"])
+        self.assertEqual(db.count_artists(uploaded=False), 1)
+        db.mark_as_uploaded("Bar")
+        self.assertIsNotNone(db._records)
+        self.assert_indexes(db)
+        self.assertEqual(list(db._non_uploaded), ["ignored"])
+        self.assertEqual(db.count_artists(uploaded=False), 0)
+
+    def test_count_with_ignored(self):
+        for binary in (False, True):
+            db = self.open_db(binary, artists={
+                "Foo": {"uploaded": True},
+                "Bar": {"uploaded": False},
+                "ignored": {"uploaded": False},
+            })
+            db.save()
+            db = self.open_db(binary)
+            # Counted from the snapshot, then from the records
+            for _ in range(2):
+                self.assertEqual(db.count_artists(), 2)
+                self.assertEqual(db.count_artists(uploaded=True), 1)
+                self.assertEqual(db.count_artists(uploaded=False), 1)
+                db.mark_as_non_uploaded("Foo")
+                db.mark_as_uploaded("Foo")
+            db.mark_as_uploaded("ignored")
+            self.assertEqual(db.count_artists(uploaded=True), 1)
+            self.assertEqual(db.count_artists(uploaded=False), 1)
+            self.assertEqual(db.get_artists(uploaded=False), ["Bar"])
+
+
+class Test_journal(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "artists.json")
+
+    def open_db(self):
+        db = Artist_db(jsonpath=self.path, journal=True)
+        self.addCleanup(db.close)
+        return db
+
+    def crash(self, db):
+        """
+        Stop the journal writer without compacting, like a killed process
+        """
+        db._journal.close()
+        db._journal = None
+
+    def test_replay_after_crash(self):
+        db = self.open_db()
+        db.add(["Foo", "Bar", "Baz"])
+        db.set_mbid("Foo", MBID)
+        db.mark_as_uploaded("Bar")
+        db.remove("Baz")
+        self.crash(db)
+        self.assertFalse(os.path.exists(self.path))
+
+        db = self.open_db()
+        self.assertEqual(db.get_artists(), ["Foo", "Bar"])
+        self.assertEqual(db.get_mbid("Foo"), MBID)
+        self.assertEqual(db.get_artists(uploaded=True), ["Bar"])
+        self.assertEqual(db.get_artists_without_mbid(), ["Bar"])
+
+    def test_torn_tail_truncated(self):
+        db = self.open_db()
+        db.add(["Foo", "Bar"])
+        self.crash(db)
+        journal_path = self.path + ".journal"
+        valid_size = os.path.getsize(journal_path)
+        with open(journal_path, "ab") as f:
+            f.write(b'["set","Foo","mbid","0383da')
+
+        db = self.open_db()
+        self.assertEqual(db.get_artists(), ["Foo", "Bar"])
+        self.assertIsNone(db.get_mbid("Foo"))
+        self.assertEqual(os.path.getsize(journal_path), valid_size)
+        self.assertEqual(db._journal.size, valid_size)
+
+        # The next records follow the last valid one
+        db.mark_as_uploaded("Foo")
+        self.crash(db)
+        db = self.open_db()
+        self.assertEqual(db.get_artists(uploaded=True), ["Foo"])
+
+    def test_compact(self):
+        db = self.open_db()
+        db.add(["Foo", "Bar"])
+        db.set_mbid("Foo", MBID)
+        db.compact()
+        self.assertEqual(os.path.getsize(self.path + ".journal"), 0)
+        self.assertEqual(db._journal.size, 0)
+        db.remove("Bar")
+        self.crash(db)
+
+        db = self.open_db()
+        self.assertEqual(db.get_artists(), ["Foo"])
+        self.assertEqual(db.get_mbid("Foo"), MBID)
+
+    def test_save_compacts_large_journal(self):
+        db = self.open_db()
+        db.add("Foo")
+        db._journal.flush()
+        with mock.patch.object(artist_db, "JOURNAL_MIN_COMPACT_SIZE", 1024):
+            db.save()
+            self.assertGreater(db._journal.size, 0)
+            db.add(["Artist {}".format(i) for i in range(100)])
+            db._journal.flush()
+            db.save()
+        self.assertEqual(db._journal.size, 0)
+        self.assertEqual(db.count_artists(), 101)
+        self.crash(db)
+
+        db = self.open_db()
+        self.assertEqual(db.count_artists(), 101)
+
+
+
+class Test_binary_snapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.json_path = os.path.join(self.tmp.name, "artists.json")
+        self.bin_path = os.path.join(self.tmp.name, "artists.bin")
+
+    def open_db(self, binary=True):
+        db = Artist_db(jsonpath=self.bin_path if binary else self.json_path,
+                       journal=True, binary=binary)
+        self.addCleanup(db.close)
+        return db
+
+    def write_bin(self):
+        db = Artist_db(jsonpath=self.bin_path, journal=False, binary=True,
+                       artists={"Foo": {"uploaded": False},
+                                "Bar": {"uploaded": False, "mbid": MBID}})
+        db.close()
+
+    def test_convert_round_trip(self):
+        db = self.open_db(binary=False)
+        db.add(["Foo", "Bar"])
+        db.set_meta("mpd_db_update", 1)
+        db.close()
+
+        convert_db(self.json_path, self.bin_path, True)
+        self.assertFalse(os.path.exists(self.json_path))
+        self.assertTrue(os.path.exists(self.json_path + ".bak"))
+        db = self.open_db()
+        self.assertEqual(db.get_artists(), ["Foo", "Bar"])
+        self.assertEqual(db.get_meta("mpd_db_update"), 1)
+        db.set_mbid("Foo", MBID)
+        db.remove("Bar")
+        db.set_meta("mpd_db_update", 2)
+        db.close()
+
+        # The changes made with the binary backend are converted back
+        convert_db(self.bin_path, self.json_path, False)
+        self.assertFalse(os.path.exists(self.bin_path))
+        db = self.open_db(binary=False)
+        self.assertEqual(db.get_artists(), ["Foo"])
+        self.assertEqual(db.get_mbid("Foo"), MBID)
+        self.assertEqual(db.get_meta("mpd_db_update"), 2)
+
+    def test_snapshot_closed_when_replaced(self):
+        self.write_bin()
+        db = self.open_db()
+        snapshot = db._snapshot
+        db.mark_as_uploaded("Foo")
+        self.assertFalse(snapshot._mmap.closed)
+        db.compact()
+        self.assertTrue(snapshot._mmap.closed)
+        self.assertIsNone(db._snapshot)
+        self.assertEqual(db.get_artists(uploaded=True), ["Foo"])
+
+    def test_snapshot_closed_with_db(self):
+        self.write_bin()
+        db = self.open_db()
+        snapshot = db._snapshot
+        self.assertEqual(db.count_artists(), 2)
+        db.close()
+        self.assertTrue(snapshot._mmap.closed)
+
+    def test_iteration_while_read(self):
+        self.write_bin()
+        db = self.open_db()
+        artists = []
+        # The first change reads every artist of the snapshot
+        for artist in db.iter_artists(fields=("mbid", )):
+            db.mark_as_uploaded(artist["name"])
+            artists.append(artist["name"])
+        self.assertEqual(artists, ["Foo", "Bar"])
+        self.assertEqual(db.count_artists(uploaded=True), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+import os
+import tempfile
+import unittest
+
+from mpd_muspy.artist_db import _Artist_record
+from mpd_muspy.artist_snapshot import (
+    MAX_LOOKUP_ATTEMPTS, Artist_snapshot, write_snapshot
+)
+
+
+class Test_snapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def write(self, artists):
+        path = os.path.join(self.tmp.name, "artists.bin")
+        with open(path, "wb") as f:
+            write_snapshot(f, {
+                name: _Artist_record.from_dict(fields)
+                for name, fields in artists.items()
+            })
+        snapshot = Artist_snapshot(path)
+        self.addCleanup(snapshot.close)
+        return snapshot
+
+    def test_lookup_attempts_clamped(self):
+        snapshot = self.write({
+            "unknown": {"uploaded": False, "lookup_status": "not_found",
+                        "lookup_attempts": 70000, "next_lookup": 1.5e9},
+            "retried": {"uploaded": False, "lookup_status": "error",
+                        "lookup_attempts": 3, "next_lookup": 1.5e9},
+        })
+        self.assertEqual(snapshot.get("unknown").lookup_attempts,
+                         MAX_LOOKUP_ATTEMPTS)
+        self.assertEqual(snapshot.get("retried").lookup_attempts, 3)
+        self.assertEqual(snapshot.get("unknown").next_lookup, 1.5e9)
+
+
+if __name__ == "__main__":
+    unittest.main()
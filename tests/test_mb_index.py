@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+import json
+import os
+import tempfile
+import unittest
+
+from mpd_muspy.mb_index import Index_builder, read_dump
+
+MBID = "b10bbbfc-cf9e-42e0-be17-e2c3e1d2600d"
+
+
+class Test_read_dump(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def write_dump(self, lines):
+        path = os.path.join(self.tmp.name, "dump")
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        return path
+
+    def test_invalid_tsv_rows_skipped(self):
+        path = self.write_dump([
+            "1\t{}\tThe Beatles\tBeatles, The".format(MBID),
+            "2\tnot-an-mbid\tSomeone\tSomeone",
+            "3\t" + MBID[:10],
+        ])
+        records = list(read_dump(path))
+        self.assertEqual(records[0],
+                         ("artist", MBID, ["The Beatles", "Beatles, The"]))
+        self.assertEqual([r[0] for r in records[1:]],
+                         ["invalid", "invalid"])
+
+    def test_build_with_invalid_lines(self):
+        path = self.write_dump([
+            json.dumps({"id": MBID, "name": "The Beatles",
+                        "sort-name": "Beatles, The"}),
+            json.dumps({"title": "Abbey Road", "artist-credit": [
+                {"artist": {"id": MBID}}
+            ]}),
+            json.dumps({"id": "not-an-mbid", "name": "Someone"}),
+            '{"id": "' + MBID,
+        ])
+        builder = Index_builder()
+        self.assertTrue(builder.add_dump(path))
+        self.assertEqual(builder.invalid, 2)
+        self.assertEqual(len(builder.titles), 1)
+        self.assertEqual(len(builder.titles[bytes.fromhex(
+            MBID.replace("-", "")
+        )]), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
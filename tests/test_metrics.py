@@ -0,0 +1,48 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+import unittest
+
+from mpd_muspy.metrics import Metrics
+
+
+class Test_prometheus(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.observe("muspy", "add_artist", 0.03)
+        self.metrics.observe("muspy", "add_artist", 2)
+        self.metrics.count("retries", "muspy", 2)
+
+    def samples(self):
+        lines = self.metrics.prometheus().splitlines()
+        types = {line.split()[2]: line.split()[3]
+                 for line in lines if line.startswith("# TYPE")}
+        values = dict(line.rsplit(" ", 1)
+                      for line in lines if not line.startswith("#"))
+        return types, values
+
+    def test_reset_values_exported_as_gauges(self):
+        types, values = self.samples()
+        self.assertEqual(set(types.values()), {"gauge"})
+        self.assertEqual(values['mpd_muspy_last_run_requests'
+                                '{service="muspy",endpoint="add_artist"}'],
+                         "2")
+        self.assertEqual(values['mpd_muspy_last_run_retries'
+                                '{service="muspy"}'], "2")
+
+    def test_values_of_the_last_run(self):
+        self.metrics.reset()
+        self.metrics.observe("muspy", "add_artist", 0.03)
+        _, values = self.samples()
+        self.assertEqual(values['mpd_muspy_last_run_requests'
+                                '{service="muspy",endpoint="add_artist"}'],
+                         "1")
+        self.assertEqual(values['mpd_muspy_last_run_requests_by_latency'
+                                '{service="muspy",endpoint="add_artist",'
+                                'le="0.05"}'], "1")
+        self.assertNotIn('mpd_muspy_last_run_retries{service="muspy"}',
+                         values)
+
+
+if __name__ == "__main__":
+    unittest.main()
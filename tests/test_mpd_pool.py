@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+import unittest
+from unittest import mock
+
+import mpd
+from mpd_muspy import mpd_pool
+from mpd_muspy.mpd_pool import Mpd_pool
+
+
+class Fake_client():
+    """
+    MPDClient raising the errors queued in `failures` on its next commands
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        self.connected = False
+        self.pings = 0
+        self.commands = 0
+
+    def connect(self, host, port):
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+    def _send(self):
+        if not self.connected:
+            raise mpd.ConnectionError("Not connected")
+        if self.failures:
+            raise self.failures.pop(0)
+
+    def ping(self):
+        self.pings += 1
+        self._send()
+
+    def status(self):
+        self.commands += 1
+        self._send()
+        return {"state": "stop"}
+
+
+class Test_mpd_pool(unittest.TestCase):
+    def setUp(self):
+        self.failures = []
+        self.clients = []
+        self.now = 1000.
+
+        def open_client():
+            client = Fake_client(self.failures)
+            self.clients.append(client)
+            return client
+
+        for patcher in (
+            mock.patch.object(mpd_pool.mpd, "MPDClient", open_client),
+            mock.patch.object(mpd_pool.time, "monotonic",
+                              lambda: self.now),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.pool = Mpd_pool(size=2)
+        self.addCleanup(self.pool.close)
+
+    def test_connection_reused(self):
+        self.pool.status()
+        self.pool.status()
+        self.assertEqual(len(self.clients), 1)
+        self.assertEqual(self.clients[0].commands, 2)
+        self.assertEqual(self.clients[0].pings, 0)
+
+    def test_ping_after_check_interval(self):
+        self.pool.status()
+        self.now += mpd_pool.MPD_CHECK_INTERVAL / 2
+        self.pool.status()
+        self.assertEqual(self.clients[0].pings, 0)
+        self.now += mpd_pool.MPD_CHECK_INTERVAL + 1
+        self.pool.status()
+        self.assertEqual(self.clients[0].pings, 1)
+        self.assertEqual(len(self.clients), 1)
+
+    def test_broken_connection_replaced_after_ping(self):
+        self.pool.status()
+        self.now += mpd_pool.MPD_CHECK_INTERVAL + 1
+        self.failures.append(mpd.ConnectionError("Connection lost"))
+        self.pool.status()
+        self.assertEqual(len(self.clients), 2)
+        self.assertFalse(self.clients[0].connected)
+        self.assertEqual(self.clients[1].commands, 1)
+        self.assertEqual(self.pool._opened, 1)
+
+    def test_single_retry(self):
+        self.pool.status()
+        self.failures.append(ConnectionResetError())
+        self.assertEqual(self.pool.status(), {"state": "stop"})
+        self.assertEqual(len(self.clients), 2)
+        self.assertFalse(self.clients[0].connected)
+
+        self.failures.extend([TimeoutError(), TimeoutError()])
+        with self.assertRaises(TimeoutError):
+            self.pool.status()
+        self.assertEqual(len(self.clients), 3)
+        self.assertEqual(self.pool._opened, 0)
+        # The next command opens a new connection
+        self.pool.status()
+        self.assertEqual(self.pool._opened, 1)
+
+    def test_command_error_not_retried(self):
+        self.failures.append(mpd.CommandError("Unknown command"))
+        with self.assertRaises(mpd.CommandError):
+            self.pool.status()
+        self.assertEqual(len(self.clients), 1)
+        # The connection is still usable
+        self.assertTrue(self.clients[0].connected)
+        self.assertEqual(len(self.pool._idle), 1)
+
+    def test_close(self):
+        with self.pool.connection() as client:
+            self.pool.status()
+            self.pool.close()
+            # Only the unused connections are closed
+            self.assertTrue(client.connected)
+            self.assertFalse(self.clients[1].connected)
+            self.assertEqual(self.pool._opened, 1)
+        self.pool.close()
+        self.assertFalse(client.connected)
+        self.assertEqual(self.pool._opened, 0)
+        # Usable again after being closed
+        self.pool.status()
+        self.assertEqual(len(self.clients), 3)
+
+    def test_close_in_other_process(self):
+        self.pool.status()
+        with mock.patch.object(mpd_pool.os, "getpid",
+                               return_value=self.pool._pid + 1):
+            self.pool.close()
+        self.assertTrue(self.clients[0].connected)
+        self.assertEqual(self.pool._opened, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+import unittest
+import urllib.error
+from unittest import mock
+
+import musicbrainzngs
+from mpd_muspy import musicbrainz
+from mpd_muspy.exceptions import ThrottledException
+
+
+def http_error(code):
+    return urllib.error.HTTPError("https://musicbrainz.org/ws/2/artist",
+                                  code, "Error", {}, None)
+
+
+class Fake_request():
+    """
+    Function of musicbrainzngs failing with a list of errors, then returning
+    a result
+    """
+    __name__ = "search_artists"
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return {"artist-count": 0, "artist-list": []}
+
+
+@mock.patch.object(musicbrainz, "ERROR_RETRY_DELAY", 0)
+@mock.patch.object(musicbrainz, "_rate_limiter", None)
+class Test_call(unittest.TestCase):
+    def test_library_retries_disabled(self):
+        safe_read = musicbrainzngs.musicbrainz._safe_read
+        self.assertEqual(safe_read.keywords, {"max_retries": 1})
+
+    def test_server_error_retried(self):
+        request = Fake_request(
+            musicbrainzngs.NetworkError("retried 1 times", http_error(500)),
+            musicbrainzngs.NetworkError("retried 1 times", http_error(502)),
+        )
+        musicbrainz._call(request)
+        self.assertEqual(request.calls, 3)
+
+    def test_network_error_retried(self):
+        request = Fake_request(musicbrainzngs.NetworkError(
+            cause=urllib.error.URLError("Connection refused")
+        ))
+        musicbrainz._call(request)
+        self.assertEqual(request.calls, 2)
+
+    def test_retries_exhausted(self):
+        errors = [musicbrainzngs.NetworkError(cause=http_error(500))
+                  for _ in range(musicbrainz.ERROR_RETRIES + 1)]
+        request = Fake_request(*errors)
+        with self.assertRaises(musicbrainzngs.NetworkError):
+            musicbrainz._call(request)
+        self.assertEqual(request.calls, musicbrainz.ERROR_RETRIES + 1)
+
+    def test_invalid_request_not_retried(self):
+        request = Fake_request(musicbrainzngs.ResponseError(
+            cause=http_error(400)
+        ))
+        with self.assertRaises(musicbrainzngs.ResponseError):
+            musicbrainz._call(request)
+        self.assertEqual(request.calls, 1)
+
+    def test_throttled_not_retried(self):
+        request = Fake_request(
+            musicbrainzngs.NetworkError("retried 1 times", http_error(503))
+        )
+        with self.assertRaises(ThrottledException):
+            musicbrainz._call(request)
+        self.assertEqual(request.calls, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+import io
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+from mpd_muspy import muspy_async
+
+
+class Fake_db():
+    """
+    Artists database failing to mark some artists as uploaded
+    """
+    def __init__(self, failing=(), fail_save=False):
+        self.failing = failing
+        self.fail_save = fail_save
+        self.uploaded = []
+
+    def mark_as_uploaded(self, artist):
+        if artist in self.failing:
+            raise OSError("No space left on device")
+        self.uploaded.append(artist)
+
+    def save(self):
+        if self.fail_save:
+            raise OSError("No space left on device")
+
+
+async def add_artist_mbid(self, mbid):
+    pass
+
+
+@mock.patch.object(muspy_async.Muspy_async_api, "add_artist_mbid",
+                   add_artist_mbid)
+class Test_upload_stream(unittest.TestCase):
+    def upload(self, artist_db, nb):
+        stream = muspy_async.Upload_stream(artist_db, max_in_flight=2)
+        with redirect_stdout(io.StringIO()):
+            for i in range(nb):
+                stream.put({"name": "artist {}".format(i), "mbid": str(i)})
+            return stream.close()
+
+    def test_db_error_counted(self):
+        artist_db = Fake_db(failing=("artist 3", ))
+        errors, _ = self.upload(artist_db, 10)
+        self.assertEqual(errors, 1)
+        self.assertEqual(len(artist_db.uploaded), 9)
+
+    def test_loop_error_raised(self):
+        with self.assertRaises(OSError):
+            self.upload(Fake_db(fail_save=True), 3)
+
+    def test_loop_not_started(self):
+        def run(coro):
+            coro.close()
+            raise MemoryError
+
+        with mock.patch.object(muspy_async.asyncio, "run", run):
+            stream = muspy_async.Upload_stream(Fake_db(), max_in_flight=2)
+        with self.assertRaises(MemoryError):
+            stream.put({"name": "artist", "mbid": "0"})
+        self.assertEqual(stream.total, 0)
+        with self.assertRaises(MemoryError):
+            stream.close()
+
+    def test_put_after_close(self):
+        stream = muspy_async.Upload_stream(Fake_db(), max_in_flight=2)
+        stream.close()
+        with self.assertRaises(RuntimeError):
+            stream.put({"name": "artist", "mbid": "0"})
+
+
+if __name__ == "__main__":
+    unittest.main()
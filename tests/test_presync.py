@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+import io
+import os
+import tempfile
+import time
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+import musicbrainzngs
+from mpd_muspy import musicbrainz, presync
+from mpd_muspy.artist_db import Artist_db
+from mpd_muspy.cache import Response_cache
+
+
+class Fake_search():
+    """
+    search_artists of musicbrainzngs, which does not find any artist
+    """
+    __name__ = "search_artists"
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, query, limit=None):
+        self.calls += 1
+        return {"artist-count": 0, "artist-list": []}
+
+
+class Test_retry_lookups(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        cache = Response_cache(os.path.join(self.tmp.name, "cache.sqlite"),
+                               ttl=30 * 24 * 3600, max_size=1024 * 1024)
+        presync.init_process(None, cache)
+        self.addCleanup(presync.init_process, None, None)
+        self.artist_db = Artist_db(
+            jsonpath=os.path.join(self.tmp.name, "artists.json"),
+            artists={"unknown artist": {"uploaded": False}}, journal=False
+        )
+        self.search = Fake_search()
+        patcher = mock.patch.object(musicbrainzngs, "search_artists",
+                                    self.search)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch(self):
+        with redirect_stdout(io.StringIO()):
+            presync.fetch_missing_mbid(self.artist_db, {}, None,
+                                       mpd_changed=False, in_process=True)
+
+    def test_first_search_cached(self):
+        musicbrainz.search_artists("unknown artist", 15)
+        self.fetch()
+        self.assertEqual(self.search.calls, 1)
+
+    def test_retry_not_cached(self):
+        self.fetch()
+        self.assertEqual(self.search.calls, 1)
+        self.assertEqual(
+            self.artist_db.get_artists_without_mbid(failed=True),
+            ["unknown artist"]
+        )
+        # Not due yet
+        self.fetch()
+        self.assertEqual(self.search.calls, 1)
+        with mock.patch.object(time, "time",
+                               return_value=time.time() + 2 * 24 * 3600):
+            self.fetch()
+        self.assertEqual(self.search.calls, 2)
+
+    def test_reset_lookups_not_cached(self):
+        self.fetch()
+        self.artist_db.reset_lookups()
+        self.fetch()
+        self.assertEqual(self.search.calls, 2)
+
+
+
+class Test_muspy_fingerprint(unittest.TestCase):
+    def setUp(self):
+        self.muspy_artists = [{"name": "foo", "mbid": "b"},
+                              {"name": "bar", "mbid": "a"}]
+        patcher = mock.patch.object(presync, "Muspy_api")
+        self.api = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.api.return_value.get_artists.return_value = self.muspy_artists
+        self.sync_state = {"mpd_db_update": 1, "muspy_fingerprint": "old"}
+
+    def test_taken_after_changes(self):
+        presync.update_muspy_fingerprint(self.sync_state, 0, True)
+        self.assertEqual(self.sync_state["muspy_fingerprint"],
+                         presync.muspy_fingerprint(self.muspy_artists))
+
+    def test_kept_without_changes(self):
+        presync.update_muspy_fingerprint(self.sync_state, 0, False)
+        self.assertEqual(self.sync_state["muspy_fingerprint"], "old")
+        self.api.assert_not_called()
+
+    def test_cleared_after_errors(self):
+        presync.update_muspy_fingerprint(self.sync_state, 2, True)
+        self.assertIsNone(self.sync_state["muspy_fingerprint"])
+        self.assertEqual(self.sync_state["mpd_db_update"], 1)
+        self.api.assert_not_called()
+
+    def test_cleared_if_muspy_fails(self):
+        self.api.return_value.get_artists.side_effect = OSError
+        with redirect_stdout(io.StringIO()):
+            presync.update_muspy_fingerprint(self.sync_state, 0, True)
+        self.assertIsNone(self.sync_state["muspy_fingerprint"])
+
+
+if __name__ == "__main__":
+    unittest.main()
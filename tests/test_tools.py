@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# Author: Anthony Ruhier
+
+import unittest
+
+import mpd
+from mpd_muspy.tools import mpd_get_mbids
+
+A = "a1a1a1a1-0000-4000-8000-000000000001"
+B = "b2b2b2b2-0000-4000-8000-000000000002"
+C = "c3c3c3c3-0000-4000-8000-000000000003"
+
+
+class Fake_mpd():
+    """
+    MPD client answering `list musicbrainz_artistid group artist`
+    """
+    def __init__(self, entries):
+        self.entries = entries
+
+    def list(self, *args):
+        if self.entries is None:
+            raise mpd.CommandError("unknown command")
+        return [{"artist": artist, "musicbrainz_artistid": mbids}
+                for artist, mbids in self.entries]
+
+
+class Test_mpd_get_mbids(unittest.TestCase):
+    def get_mbids(self, entries):
+        return mpd_get_mbids(Fake_mpd(entries))
+
+    def test_tagged_artist(self):
+        self.assertEqual(self.get_mbids([("A", A), ("B", B.upper())]),
+                         {"a": A, "b": B})
+
+    def test_ids_joined_in_one_value(self):
+        # The collaboration is tagged with both ids, which belong to the
+        # artists tagged alone with them
+        self.assertEqual(
+            self.get_mbids([("A", A), ("B", B), ("A feat. B", A + "/" + B)]),
+            {"a": A, "b": B}
+        )
+
+    def test_collaboration_with_one_id(self):
+        self.assertEqual(
+            self.get_mbids([("B", B), ("A feat. B", B)]),
+            {"b": B}
+        )
+
+    def test_collaboration_without_owner(self):
+        self.assertEqual(
+            self.get_mbids([("A feat. B", B), ("C feat. B", B)]),
+            {}
+        )
+
+    def test_conflicting_tags(self):
+        # Tagged with two ids, none of them belonging to another artist
+        self.assertEqual(self.get_mbids([("A", [A, C])]), {})
+
+    def test_conflict_resolved_by_owner(self):
+        # One of the ids belongs to another artist
+        self.assertEqual(
+            self.get_mbids([("A", [A, C]), ("C", C)]),
+            {"a": A, "c": C}
+        )
+
+    def test_old_mpd(self):
+        self.assertEqual(self.get_mbids(None), {})
+
+
+if __name__ == "__main__":
+    unittest.main()